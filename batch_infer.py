@@ -0,0 +1,218 @@
+"""
+batch_infer.py
+Offline batch inference: answer every prompt in a JSONL file, many at a time.
+
+    python batch_infer.py prompts.jsonl --out answers.jsonl
+    python batch_infer.py requests.jsonl --field body --out answers.jsonl --batch-size 32
+
+Each input line is a JSON object with an "id" (or "request_id"; the line number otherwise) and
+one of: "prompt" (used as is), "messages" (OpenAI-style chat), "question" / "text" / "body", or
+the field named by --field (a question, wrapped in the KyleBot prompt).
+
+- prompts are read a window at a time, sorted by token length and cut into batches of similar
+  length, so little of each left-padded batch is padding
+- each batch runs one model.generate; rows stop at the turn boundary like the chat front ends,
+  and the n-gram ban / repetition penalty skip each row's left padding (beam_batching.py), so a
+  prompt gets the same reply as on its own (--check verifies it on the first batch)
+- results are appended to --out (and flushed) after every batch; running the same command again
+  after a crash skips the ids already in --out
+"""
+
+import argparse, itertools, json, logging, os, sys, time
+
+import torch
+from transformers import LogitsProcessorList, StoppingCriteriaList
+
+from beam_batching import NoRepeatNGram, RepetitionPenalty
+from model_utils import load_model
+from prompting import build_prompt, clean_response, messages_to_prompt, turn_markers
+from stopping import TurnBoundaryStop
+
+log = logging.getLogger(__name__)
+
+QUESTION_FIELDS = ("question", "text", "body")
+
+
+def record_prompt(record, name="KyleBot", field=None):
+    """The KyleBot prompt for one input record"""
+    if field:
+        return build_prompt([], record[field], name)
+    if "prompt" in record:
+        return record["prompt"]
+    if "messages" in record:
+        return messages_to_prompt(record["messages"], name)
+    for key in QUESTION_FIELDS:
+        if key in record:
+            return build_prompt([], record[key], name)
+    raise KeyError(f"no prompt field (expected prompt, messages or one of {', '.join(QUESTION_FIELDS)})")
+
+def read_records(path, done=(), name="KyleBot", field=None):
+    """(id, prompt) for every record of a JSONL file whose id is not in `done`"""
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record_id = str(record.get("id", record.get("request_id", line_number)))
+            if record_id in done:
+                continue
+            try:
+                yield record_id, record_prompt(record, name, field)
+            except KeyError as exc:
+                raise ValueError(f"{path}:{line_number}: {exc.args[0]}") from None
+
+def load_done(path):
+    """
+    Ids already answered in an earlier run's output. A line cut off by a crash is removed, so
+    new results start on a line of their own.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    return {str(json.loads(line)["id"]) for line in data.splitlines() if line.strip()}
+
+
+def length_buckets(records, tokenizer, window=1024, batch_size=16, max_batch_tokens=8192, max_prompt_tokens=None):
+    """
+    Batches of (id, prompt_ids) with similar prompt lengths: `window` records are read at a
+    time and sorted by length. A batch holds at most batch_size prompts and, once padded to its
+    longest prompt, at most max_batch_tokens tokens.
+    """
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, window))
+        if not chunk:
+            return
+        encoded = []
+        # One batch call: the fast tokenizer encodes the whole window in parallel
+        for (record_id, _), ids in zip(chunk, tokenizer([prompt for _, prompt in chunk])["input_ids"]):
+            if max_prompt_tokens and len(ids) > max_prompt_tokens:
+                ids = ids[-max_prompt_tokens:]   # keep the end: the question being answered
+            encoded.append((record_id, ids))
+        encoded.sort(key=lambda item: len(item[1]))
+        batch = []
+        for item in encoded:
+            # Sorted ascending, so the new prompt is the longest: it sets the padded width
+            if batch and (len(batch) == batch_size or (len(batch) + 1) * len(item[1]) > max_batch_tokens):
+                yield batch
+                batch = []
+            batch.append(item)
+        if batch:
+            yield batch
+
+
+def generate_batch(model, tokenizer, batch, name="KyleBot", **gen_kwargs):
+    """One left-padded model.generate over a batch of (id, prompt_ids) -> result dicts"""
+    width = max(len(ids) for _, ids in batch)
+    pad = tokenizer.eos_token_id
+    input_ids = torch.tensor([[pad] * (width - len(ids)) + ids for _, ids in batch], device=model.device)
+    attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for _, ids in batch],
+                                  device=model.device)
+    stop = TurnBoundaryStop(tokenizer, turn_markers(name), max_chars=500)
+    # Passed as processors, not as no_repeat_ngram_size / repetition_penalty: generate()'s own
+    # ones would treat the padding as text
+    offsets = torch.tensor([width - len(ids) for _, ids in batch], device=model.device)
+    processors = LogitsProcessorList()
+    penalty = gen_kwargs.pop("repetition_penalty", 1.0)
+    if penalty != 1.0:
+        processors.append(RepetitionPenalty(penalty, offsets))
+    ngram_size = gen_kwargs.pop("no_repeat_ngram_size", 0)
+    if ngram_size:
+        processors.append(NoRepeatNGram(ngram_size, offsets))
+    with torch.no_grad():
+        outputs = model.generate(input_ids=input_ids, attention_mask=attention_mask, pad_token_id=pad,
+                                 logits_processor=processors, stopping_criteria=StoppingCriteriaList([stop]),
+                                 **gen_kwargs)
+    # Finished rows are padded with the end-of-text token
+    rows = [row[:row.index(pad)] if pad in row else row for row in outputs[:, width:].tolist()]
+    results = []
+    for (record_id, ids), generated, text in zip(batch, rows, tokenizer.batch_decode(rows, skip_special_tokens=True)):
+        results.append({
+            "id": record_id,
+            "response": clean_response(text, name),
+            "prompt_tokens": len(ids),
+            "completion_tokens": len(generated),
+            "finish_reason": "length" if len(generated) >= gen_kwargs["max_new_tokens"] else "stop",
+        })
+    return results
+
+def check_batch(model, tokenizer, batch, results, name="KyleBot", **gen_kwargs):
+    """Ids whose batched result differs from answering the prompt alone (deterministic methods only)"""
+    return [result["id"] for item, result in zip(batch, results)
+            if generate_batch(model, tokenizer, [item], name, **gen_kwargs)[0] != result]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer every prompt in a JSONL file, in batches")
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("--out", required=True, help="JSONL results (appended to; finished ids are skipped)")
+    parser.add_argument("--field", help="answer this field of each record (e.g. body)")
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--name", default="KyleBot", help="persona used in the system prompt")
+    parser.add_argument("--method", default="greedy", choices=["greedy", "sampling", "beam"])
+    parser.add_argument("--max-new-tokens", type=int, default=100)
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--num-beams", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-batch-tokens", type=int, default=8192, help="padded prompt tokens per batch")
+    parser.add_argument("--window", type=int, default=1024, help="prompts sorted by length together")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true",
+                        help="also answer the first batch one prompt at a time and stop if a reply differs")
+    parser.add_argument("--int8", action="store_true", help="dynamic int8 quantization (CPU only)")
+    parser.add_argument("--bf16", action="store_true", help="bfloat16 weights (CPUs with native bf16)")
+    parser.add_argument("--snapshot", action="store_true", help="load from a local snapshot in ~/.cache/kylebot")
+    args = parser.parse_args()
+    if args.check and args.method == "sampling":
+        parser.error("--check compares deterministic replies: use --method greedy or beam")
+    logging.basicConfig(level=logging.INFO)
+
+    done = load_done(args.out)
+    if done:
+        log.info(f"Resuming: {len(done)} prompts already answered in {args.out}")
+    tokenizer, model = load_model(args.model, int8=args.int8, bf16=args.bf16, snapshot=args.snapshot)
+    torch.manual_seed(args.seed)
+    gen_kwargs = {"max_new_tokens": args.max_new_tokens}
+    if args.method == "sampling":
+        gen_kwargs.update(do_sample=True, temperature=args.temperature, top_k=args.top_k)
+    elif args.method == "beam":
+        gen_kwargs.update(do_sample=False, num_beams=args.num_beams, no_repeat_ngram_size=2,
+                          repetition_penalty=1.2)
+    else:
+        gen_kwargs["do_sample"] = False
+    context = getattr(model.config, "n_positions", None) or getattr(model.config, "max_position_embeddings", 1024)
+
+    records = read_records(args.input, done, args.name, args.field)
+    batches = length_buckets(records, tokenizer, args.window, args.batch_size, args.max_batch_tokens,
+                             max_prompt_tokens=context - args.max_new_tokens)
+    start = time.perf_counter()
+    answered = prompt_tokens = padded_tokens = new_tokens = 0
+    with open(args.out, "a") as out:
+        for batch in batches:
+            results = generate_batch(model, tokenizer, batch, args.name, **gen_kwargs)
+            if args.check:
+                args.check = False
+                mismatched = check_batch(model, tokenizer, batch, results, args.name, **gen_kwargs)
+                if mismatched:
+                    sys.exit(f"❌ Batched replies differ from single-prompt ones for ids {', '.join(mismatched)}")
+                log.info(f"Check: {len(batch)} batched replies match single-prompt ones")
+            out.write("".join(json.dumps(result) + "\n" for result in results))
+            out.flush()
+            os.fsync(out.fileno())
+            answered += len(results)
+            prompt_tokens += sum(len(ids) for _, ids in batch)
+            padded_tokens += len(batch) * max(len(ids) for _, ids in batch)
+            new_tokens += sum(result["completion_tokens"] for result in results)
+            elapsed = time.perf_counter() - start
+            log.info(f"{answered} answered | {new_tokens / elapsed:.1f} tokens/s | "
+                     f"padding {1 - prompt_tokens / padded_tokens:.1%} of prompt tokens")
+    print(f"✅ {answered} prompts answered in {time.perf_counter() - start:.1f}s -> {args.out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+"""
+batching.py
+Continuous batching for concurrent chats: every in-flight prompt shares one forward pass per
+decoding step. New requests join (after their own prefill) and finished ones leave between steps,
+so a slow 200-token answer never blocks a quick one queued behind it.
+"""
+
+import logging, queue, threading, time
+from concurrent.futures import Future
+
+import torch
+import torch.nn.functional as F
+
+from metrics import BATCH_SIZE, PHASE_SECONDS, QUEUE_DEPTH, phase
+from model_utils import cache_from_tensors, cache_to_tensors
+from prompting import encode_prompt
+
+log = logging.getLogger(__name__)
+
+
+def sample_next_tokens(logits, temperature, top_k, do_sample, generator=None):
+    """
+    Pick one token per row, each row with its own settings.
+    - logits: [batch, vocab] scores for the next position
+    - temperature / top_k / do_sample: [batch] tensors (top_k=0 means no top-k filter)
+    - generator: torch.Generator to sample with (default: the global RNG)
+    Greedy rows take the argmax; sampling rows apply temperature then top-k, like model.generate.
+    """
+    greedy = logits.argmax(dim=-1)
+    if not bool(do_sample.any()):
+        return greedy
+    scores = logits / temperature.clamp(min=1e-5).unsqueeze(-1)
+    k_max = min(int(top_k.max()), scores.shape[-1])
+    if k_max > 0:
+        top_vals = scores.topk(k_max, dim=-1).values
+        kth = top_vals.gather(1, (top_k.clamp(1, k_max) - 1).unsqueeze(-1))
+        kth = torch.where(top_k.unsqueeze(-1) > 0, kth, torch.full_like(kth, float("-inf")))
+        scores = scores.masked_fill(scores < kth, float("-inf"))
+    sampled = torch.multinomial(F.softmax(scores.float(), dim=-1), 1, generator=generator).squeeze(-1)
+    return torch.where(do_sample, sampled, greedy)
+
+
+def _left_pad(tensor, length, dim, value=0):
+    """Pad `tensor` on the left along `dim` so that size(dim) == length."""
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape); shape[dim] = missing
+    return torch.cat([tensor.new_full(shape, value), tensor], dim=dim)
+
+
+def decode_forked(model, prompt_ids, temperature, top_k, do_sample, max_new_tokens, stops=None,
+                  eos_token_id=None, past=None, generator=None):
+    """
+    Decode several continuations of one prompt as one batch: the prompt is prefilled once (after
+    `past`, keys/values covering its first ids, e.g. from SessionKVCache.lookup) and its keys/values
+    are shared by every row. temperature / top_k / do_sample / max_new_tokens / stops (one
+    StoppingCriteria or None) are per-row lists; rows leave the batch as they finish.
+    Returns ([{"ids", "logprob", "seconds"} per row], per-layer past covering the prompt), where
+    logprob is the model's log-probability of the row's tokens (before temperature / top-k).
+    generator: torch.Generator the rows sample with, e.g. seeded for a repeatable run
+    """
+    n = len(temperature)
+    device = model.device
+    stops = stops or [None] * n
+    n_cached = past[0][0].shape[2] if past is not None else 0
+    rows = [{"ids": [], "logprob": 0.0, "seconds": 0.0} for _ in range(n)]
+    temperature = torch.tensor([float(t) for t in temperature], device=device)
+    top_k = torch.tensor([int(k or 0) for k in top_k], device=device)
+    do_sample = torch.tensor([bool(d) for d in do_sample], device=device)
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        out = model(input_ids=torch.tensor([prompt_ids[n_cached:]], device=device),
+                    past_key_values=cache_from_tensors(past) if past is not None else None, use_cache=True)
+        prompt_past = cache_to_tensors(out.past_key_values)
+        logits = out.logits[:, -1].expand(n, -1)
+        # expand() shares the prompt's keys/values between the rows; the first step's concatenation copies them
+        past = [(k.expand(n, -1, -1, -1), v.expand(n, -1, -1, -1)) for k, v in prompt_past]
+        active = list(range(n))   # row index of each batch row
+        while True:
+            tokens = sample_next_tokens(logits, temperature, top_k, do_sample, generator)
+            logprobs = F.log_softmax(logits.float(), dim=-1).gather(1, tokens.unsqueeze(-1)).squeeze(-1).tolist()
+            tokens = tokens.tolist()
+            keep = []
+            for batch_row, (row, token) in enumerate(zip(active, tokens)):
+                result = rows[row]
+                done = token == eos_token_id
+                if not done:
+                    result["ids"].append(token)
+                    result["logprob"] += logprobs[batch_row]
+                    done = len(result["ids"]) >= max_new_tokens[row]
+                if stops[row] is not None:
+                    done = bool(stops[row](torch.tensor([prompt_ids + result["ids"]]), None).all()) or done
+                if done:
+                    result["seconds"] = time.perf_counter() - start
+                else:
+                    keep.append(batch_row)
+            if not keep:
+                break
+            if len(keep) < len(active):   # finished rows leave the batch
+                index = torch.tensor(keep, device=device)
+                past = [(k.index_select(0, index), v.index_select(0, index)) for k, v in past]
+                temperature, top_k, do_sample = (t.index_select(0, index) for t in (temperature, top_k, do_sample))
+                active = [active[i] for i in keep]
+                tokens = [tokens[i] for i in keep]
+            out = model(input_ids=torch.tensor(tokens, device=device).view(-1, 1),
+                        past_key_values=cache_from_tensors(past), use_cache=True)
+            logits = out.logits[:, -1]
+            past = cache_to_tensors(out.past_key_values)
+    return rows, prompt_past
+
+
+class BatchRequest:
+    """One prompt waiting for (or taking part in) batched decoding, with its own sampling params."""
+
+    def __init__(self, prompt_ids, max_new_tokens=50, temperature=1.0, top_k=0, do_sample=False,
+                 session_id=None, streamer=None, stopping_criteria=None):
+        self.prompt_ids = list(prompt_ids)
+        self.session_id = session_id
+        self.streamer = streamer     # optional HF-style streamer: put(prompt), put(token)..., end()
+        self.stopping_criteria = stopping_criteria   # optional HF StoppingCriteria(List)
+        self.cancelled = False
+        self.stopped = False
+        self.max_new_tokens = int(max_new_tokens)
+        self.temperature = float(temperature)
+        self.top_k = int(top_k or 0)
+        self.do_sample = bool(do_sample)
+        self.generated = []
+        self.future = Future()
+
+    def push_token(self, token):
+        self.generated.append(token)
+        if self.streamer is not None:
+            try:
+                self.streamer.put(torch.tensor([token]))
+            except Exception:   # the listener went away (e.g. streaming.GenerationCancelled)
+                self.cancelled = True
+        if self.stopping_criteria is not None:
+            ids = torch.tensor([self.prompt_ids + self.generated])
+            self.stopped = bool(self.stopping_criteria(ids, None).all())
+
+    def is_finished(self, eos_token_id):
+        return self.cancelled or self.stopped or self.generated[-1] == eos_token_id or len(self.generated) >= self.max_new_tokens
+
+
+class ContinuousBatcher:
+    """
+    Request scheduler around a causal LM.
+
+    Callers (any thread) submit prompts; a single background thread owns the model and runs
+    the decode loop. The batch KV cache is kept left-padded: joining rows are padded to the
+    current width, and columns that only hold padding are trimmed once their rows leave.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=32, kv_cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.kv_cache = kv_cache   # optional kv_cache.SessionKVCache shared with the direct path
+        self.eos_token_id = tokenizer.eos_token_id
+        self.device = next(model.parameters()).device
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closing = False
+        self._reset_batch()
+
+    # ---- public API -------------------------------------------------
+    def submit(self, prompt, max_new_tokens=50, temperature=1.0, top_k=0, do_sample=False,
+               session_id=None, streamer=None, stopping_criteria=None):
+        """
+        Queue a prompt; returns a Future resolving to the generated text (prompt excluded).
+        `streamer` and `stopping_criteria` work as in model.generate(): the streamer receives
+        tokens as they come, the criteria are checked after every token.
+        """
+        with phase("tokenize"):
+            prompt_ids = encode_prompt(self.tokenizer, prompt)
+        request = BatchRequest(prompt_ids, max_new_tokens, temperature, top_k, do_sample,
+                               session_id, streamer, stopping_criteria)
+        if streamer is not None:
+            streamer.put(torch.tensor(prompt_ids))
+        self._ensure_worker()
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, prompt, **params):
+        """Blocking helper: submit and wait for the text."""
+        return self.submit(prompt, **params).result()
+
+    def close(self):
+        """Stop the worker once the requests already queued are done (it holds the model)"""
+        self._queue.put(None)
+
+    @property
+    def active_requests(self):
+        return len(self._active)
+
+    # ---- worker ----------------------------------------------------
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._closing = False
+                self._thread = threading.Thread(target=self._run, name="kylebot-batcher", daemon=True)
+                self._thread.start()
+
+    def _reset_batch(self):
+        self._active = []      # BatchRequest per batch row
+        self._past = None      # per-layer (key, value), [rows, heads, seq, head_dim]
+        self._mask = None      # [rows, seq] attention mask (0 = left padding)
+
+    def _run(self):
+        # Grad mode is thread-local, so the worker must switch it off itself
+        with torch.no_grad():
+            while not (self._closing and not self._active):
+                try:
+                    self._admit(block=not self._active)
+                    QUEUE_DEPTH.set(self._queue.qsize(), queue="batcher")
+                    BATCH_SIZE.set(len(self._active))
+                    if self._active:
+                        self._step()
+                except Exception as exc:  # fail the affected requests, keep serving new ones
+                    log.exception("batched decoding step failed")
+                    for request in self._active:
+                        if not request.future.done():
+                            request.future.set_exception(exc)
+                    self._reset_batch()
+
+    def _admit(self, block):
+        """Move queued requests into the running batch (prefill them together)."""
+        joining = []
+        try:
+            if block:
+                joining.append(self._queue.get())
+            while len(self._active) + len(joining) < self.max_batch_size:
+                joining.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        if None in joining:   # close()
+            self._closing = True
+            joining = [request for request in joining if request is not None]
+        if not joining:
+            return
+
+        # Requests with reusable KV state (their session's last turn, or the shared system-prompt
+        # prefix) prefill only their new suffix; requests continuing from the same state are
+        # prefilled together, as are requests starting from scratch
+        groups = {}
+        for request in joining:
+            past, n_cached = (self.kv_cache.lookup(request.session_id, request.prompt_ids)
+                              if self.kv_cache is not None else (None, 0))
+            key = (past[0][0].data_ptr(), n_cached) if past is not None else None
+            groups.setdefault(key, (past, n_cached, []))[2].append(request)
+        for past, n_cached, requests in groups.values():
+            try:
+                self._prefill(requests, past, n_cached)
+            except Exception as exc:  # fail this group only: the running batch is untouched
+                log.exception("batched prefill failed")
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(exc)
+                if any(request in self._active for request in requests):
+                    raise   # failed after joining the batch: _run resets it
+
+    def _prefill(self, requests, past=None, n_cached=0):
+        """
+        Prompt forward pass for `requests`, all continuing from `past` (covering their first
+        n_cached ids), then join the batch. Suffixes are left-padded, so with a cached prefix the
+        padding sits between prefix and suffix; the attention mask and position ids skip it.
+        """
+        width = max(len(r.prompt_ids) - n_cached for r in requests)
+        ids = torch.full((len(requests), width), self.eos_token_id, dtype=torch.long)
+        mask = torch.zeros((len(requests), n_cached + width), dtype=torch.long)
+        mask[:, :n_cached] = 1
+        for row, request in enumerate(requests):
+            suffix = request.prompt_ids[n_cached:]
+            ids[row, width - len(suffix):] = torch.tensor(suffix)
+            mask[row, n_cached + width - len(suffix):] = 1
+        ids, mask = ids.to(self.device), mask.to(self.device)
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)[:, n_cached:]
+        if past is not None:
+            past = cache_from_tensors([(k.expand(len(requests), -1, -1, -1), v.expand(len(requests), -1, -1, -1))
+                                       for k, v in past])
+        start = time.perf_counter()
+        out = self.model(input_ids=ids, attention_mask=mask, position_ids=position_ids,
+                         past_key_values=past, use_cache=True)
+        for _ in requests:   # every request in the group waited for the whole forward pass
+            PHASE_SECONDS.observe(time.perf_counter() - start, phase="prefill")
+        self._merge(requests, cache_to_tensors(out.past_key_values), mask)
+        self._pick_tokens(out.logits[:, -1, :], first_row=len(self._active) - len(requests))
+
+    def _merge(self, joining, past, mask):
+        """Append freshly prefilled rows to the running batch, left-padding whichever side is shorter."""
+        if not self._active:
+            self._active, self._past, self._mask = list(joining), past, mask
+            return
+        width = max(self._mask.shape[1], mask.shape[1])
+        self._past = [
+            (torch.cat([_left_pad(k0, width, 2), _left_pad(k1, width, 2)]),
+             torch.cat([_left_pad(v0, width, 2), _left_pad(v1, width, 2)]))
+            for (k0, v0), (k1, v1) in zip(self._past, past)
+        ]
+        self._mask = torch.cat([_left_pad(self._mask, width, 1), _left_pad(mask, width, 1)])
+        self._active.extend(joining)
+
+    def _step(self):
+        """One decoding step for every active row."""
+        last = torch.tensor([[r.generated[-1]] for r in self._active], device=self.device)
+        self._mask = torch.cat([self._mask, self._mask.new_ones((len(self._active), 1))], dim=1)
+        start = time.perf_counter()
+        out = self.model(
+            input_ids=last, past_key_values=cache_from_tensors(self._past),
+            attention_mask=self._mask, position_ids=self._mask.sum(-1, keepdim=True) - 1,
+            use_cache=True
+        )
+        for _ in self._active:   # one token for every row
+            PHASE_SECONDS.observe(time.perf_counter() - start, phase="decode")
+        self._past = cache_to_tensors(out.past_key_values)
+        self._pick_tokens(out.logits[:, -1, :])
+
+    def _pick_tokens(self, logits, first_row=0):
+        """Choose the next token for rows[first_row:], then retire finished requests."""
+        rows = self._active[first_row:]
+        tokens = sample_next_tokens(
+            logits,
+            torch.tensor([r.temperature for r in rows], device=logits.device),
+            torch.tensor([r.top_k for r in rows], device=logits.device),
+            torch.tensor([r.do_sample for r in rows], device=logits.device),
+        )
+        for request, token in zip(rows, tokens.tolist()):
+            request.push_token(token)
+        self._retire()
+
+    def _save_session(self, row, request):
+        """Hand the row's KV state (prompt + all but the last generated token) to the session cache."""
+        if self.kv_cache is None or request.session_id is None:
+            return
+        real = self._mask[row].nonzero().squeeze(-1)   # skip padding columns
+        covered = request.prompt_ids + request.generated[:-1]
+        past = [(k[row:row + 1, :, real], v[row:row + 1, :, real]) for k, v in self._past]
+        self.kv_cache.store(request.session_id, covered, past)
+
+    def _retire(self):
+        keep, finished = [], []
+        for row, request in enumerate(self._active):
+            if request.is_finished(self.eos_token_id):
+                self._save_session(row, request)
+                finished.append(request)
+            else:
+                keep.append(row)
+        if finished:
+            # Requests finishing on the same step are detokenized in one batch call
+            with phase("detokenize"):
+                texts = self.tokenizer.batch_decode(
+                    [[t for t in r.generated if t != self.eos_token_id] for r in finished], skip_special_tokens=True
+                )
+            for request, text in zip(finished, texts):
+                request.future.set_result(text)
+                if request.streamer is not None:
+                    request.streamer.end()
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._reset_batch()
+            return
+        index = torch.tensor(keep, device=self._mask.device)
+        self._active = [self._active[i] for i in keep]
+        self._mask = self._mask.index_select(0, index)
+        # Drop leading columns that are now padding for every remaining row
+        start = int((self._mask.cumsum(-1) == 0).sum(-1).min())
+        self._mask = self._mask[:, start:]
+        self._past = [(k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+                      for k, v in self._past]
@@ -0,0 +1,300 @@
+"""
+beam_batching.py
+Beam search for many requests at once: every queued request's beams are decoded together in one
+left-padded model.generate, instead of 5 beams per request one request after another.
+
+Requests are batched when they share their beam settings (max_new_tokens, num_beams,
+no_repeat_ngram_size, repetition_penalty). The n-gram ban and the repetition penalty run as
+tensor ops over the whole batch and skip each row's left padding, so a request gets the same
+beams as when it runs on its own through model.generate.
+
+    python beam_batching.py --requests 8          # per-token overhead before / after
+"""
+
+import argparse, logging, queue, threading, time
+from concurrent.futures import Future
+
+import torch
+import torch.nn.functional as F
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+from metrics import QUEUE_DEPTH, phase
+from prompting import encode_prompt
+from stopping import DecodeTimer
+
+log = logging.getLogger(__name__)
+
+
+def _row_offsets(pad_lengths, rows):
+    """[requests] left padding -> [rows]: each request owns rows // requests consecutive rows (its beams)"""
+    return pad_lengths.repeat_interleave(rows // len(pad_lengths))
+
+
+class NoRepeatNGram(LogitsProcessor):
+    """
+    no_repeat_ngram_size for a left-padded batch: bans every token that would repeat an n-gram
+    of its own row. All windows of all rows are compared with each row's last n - 1 tokens in
+    one tensor op; windows that start in a row's padding never match.
+    """
+
+    def __init__(self, ngram_size, pad_lengths=None):
+        self.ngram_size = ngram_size
+        self.pad_lengths = pad_lengths   # [requests] tensor, or None without padding
+
+    def __call__(self, input_ids, scores):
+        n = self.ngram_size
+        length = input_ids.shape[1]
+        if length < n:
+            return scores
+        windows = input_ids.unfold(1, n, 1)                          # [rows, length - n + 1, n]
+        prefix = input_ids[:, length - n + 1:].unsqueeze(1)          # the n - 1 tokens being continued
+        matches = (windows[..., :-1] == prefix).all(dim=-1)          # [rows, length - n + 1]
+        if self.pad_lengths is not None:
+            starts = torch.arange(windows.shape[1], device=input_ids.device)
+            matches &= starts >= _row_offsets(self.pad_lengths, input_ids.shape[0]).unsqueeze(1)
+        vocab_size = scores.shape[-1]
+        # Windows that do not match write into a spare column instead of a real token
+        banned = torch.zeros(scores.shape[0], vocab_size + 1, dtype=torch.bool, device=scores.device)
+        banned.scatter_(1, torch.where(matches, windows[..., -1].clamp(max=vocab_size), vocab_size), True)
+        return scores.masked_fill(banned[:, :vocab_size], float("-inf"))
+
+
+class RepetitionPenalty(LogitsProcessor):
+    """repetition_penalty for a left-padded batch: the padding does not count as earlier text"""
+
+    def __init__(self, penalty, pad_lengths=None):
+        self.penalty = penalty
+        self.pad_lengths = pad_lengths
+
+    def __call__(self, input_ids, scores):
+        vocab_size = scores.shape[-1]
+        tokens = input_ids.clamp(max=vocab_size)
+        if self.pad_lengths is not None:
+            positions = torch.arange(input_ids.shape[1], device=input_ids.device)
+            padding = positions < _row_offsets(self.pad_lengths, input_ids.shape[0]).unsqueeze(1)
+            tokens = tokens.masked_fill(padding, vocab_size)
+        # Padding (and ids past the output vocab) is penalized in a spare column that is dropped
+        scores = F.pad(scores, (0, 1))
+        score = scores.gather(1, tokens)
+        score = torch.where(score < 0, score * self.penalty, score / self.penalty)
+        return scores.scatter(1, tokens, score)[:, :vocab_size]
+
+
+class _RequestStops(StoppingCriteria):
+    """Each request's own stopping criteria, called on its rows without the left padding"""
+
+    def __init__(self, criteria, pad_lengths):
+        self.criteria = criteria          # per request: a StoppingCriteria(List) or None
+        self.pad_lengths = pad_lengths    # per request: ints
+
+    def __call__(self, input_ids, scores=None, **kwargs):
+        rows = input_ids.shape[0] // len(self.criteria)
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for i, (criteria, pad) in enumerate(zip(self.criteria, self.pad_lengths)):
+            if criteria is not None:
+                done[i * rows:(i + 1) * rows] = criteria(input_ids[i * rows:(i + 1) * rows, pad:], None)
+        return done
+
+
+class BeamRequest:
+    """One prompt waiting for batched beam search."""
+
+    def __init__(self, prompt_ids, params, stopping_criteria=None):
+        self.prompt_ids = list(prompt_ids)
+        self.params = params   # (max_new_tokens, num_beams, no_repeat_ngram_size, repetition_penalty)
+        self.stopping_criteria = stopping_criteria
+        self.future = Future()
+
+
+class BeamBatcher:
+    """
+    Beam search scheduler around a causal LM, the beam counterpart of batching.ContinuousBatcher.
+
+    Callers (any thread) submit prompts; a background thread takes every queued request with
+    the same settings as the oldest one (up to max_batch_size) and runs them as one model.generate.
+    Beam search returns all beams at the end, so requests join between batches, not mid-decode.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size   # requests per batch: num_beams rows each
+        self.eos_token_id = tokenizer.eos_token_id
+        self.device = next(model.parameters()).device
+        self._queue = queue.Queue()
+        self._waiting = []     # drained from the queue, waiting for a batch with their settings
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closing = False
+
+    # ---- public API -------------------------------------------------
+    def submit(self, prompt, max_new_tokens=50, num_beams=5, no_repeat_ngram_size=2, repetition_penalty=1.2,
+               stopping_criteria=None):
+        """
+        Queue a prompt; returns a Future resolving to the text of the best beam (prompt excluded).
+        `stopping_criteria` is checked on this request's beams only, as in model.generate().
+        """
+        with phase("tokenize"):
+            prompt_ids = encode_prompt(self.tokenizer, prompt)
+        params = (max_new_tokens, num_beams, no_repeat_ngram_size or 0, float(repetition_penalty or 1.0))
+        request = BeamRequest(prompt_ids, params, stopping_criteria)
+        self._ensure_worker()
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, prompt, **params):
+        """Blocking helper: submit and wait for the text."""
+        return self.submit(prompt, **params).result()
+
+    def close(self):
+        """Stop the worker once the requests already queued are done (it holds the model)"""
+        self._queue.put(None)
+
+    # ---- worker ----------------------------------------------------
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._closing = False
+                self._thread = threading.Thread(target=self._run, name="kylebot-beam-batcher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        # Grad mode is thread-local, so the worker must switch it off itself
+        with torch.no_grad():
+            while True:
+                requests = self._next_batch()
+                if not requests:   # closed, nothing left to do
+                    return
+                QUEUE_DEPTH.set(self._queue.qsize() + len(self._waiting), queue="beam")
+                try:
+                    self._generate(requests)
+                except Exception as exc:  # fail this batch, keep serving new ones
+                    log.exception("batched beam search failed")
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(exc)
+
+    def _next_batch(self):
+        """The oldest waiting request plus every other one with the same settings (FIFO otherwise)."""
+        if not self._waiting and not self._closing:
+            self._waiting.append(self._queue.get())
+        try:
+            while True:
+                self._waiting.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        if None in self._waiting:   # close()
+            self._closing = True
+            self._waiting = [request for request in self._waiting if request is not None]
+        if not self._waiting:
+            return []
+        params = self._waiting[0].params
+        batch, rest = [], []
+        for request in self._waiting:
+            (batch if request.params == params and len(batch) < self.max_batch_size else rest).append(request)
+        self._waiting = rest
+        return batch
+
+    def _generate(self, requests):
+        max_new_tokens, num_beams, ngram_size, penalty = requests[0].params
+        width = max(len(r.prompt_ids) for r in requests)
+        pad_lengths = [width - len(r.prompt_ids) for r in requests]
+        pad = self.eos_token_id
+        input_ids = torch.tensor([[pad] * n + r.prompt_ids for n, r in zip(pad_lengths, requests)], device=self.device)
+        attention_mask = torch.tensor([[0] * n + [1] * len(r.prompt_ids) for n, r in zip(pad_lengths, requests)],
+                                      device=self.device)
+
+        # Passed as processors, not as no_repeat_ngram_size / repetition_penalty: generate()'s
+        # own ones would treat the padding as text
+        offsets = torch.tensor(pad_lengths, device=self.device)
+        processors = LogitsProcessorList()
+        if penalty != 1.0:
+            processors.append(RepetitionPenalty(penalty, offsets))
+        if ngram_size:
+            processors.append(NoRepeatNGram(ngram_size, offsets))
+        stopping = StoppingCriteriaList([_RequestStops([r.stopping_criteria for r in requests], pad_lengths),
+                                         DecodeTimer()])
+        outputs = self.model.generate(
+            input_ids=input_ids, attention_mask=attention_mask, max_new_tokens=max_new_tokens,
+            num_beams=num_beams, do_sample=False, pad_token_id=pad,
+            logits_processor=processors, stopping_criteria=stopping
+        )
+        log.debug(f"beam batch: {len(requests)} requests x {num_beams} beams, {width} prompt tokens")
+        rows = outputs[:, width:].tolist()
+        with phase("detokenize"):
+            # Beams that finish early are padded with the end-of-text token
+            texts = self.tokenizer.batch_decode([row[:row.index(pad)] if pad in row else row for row in rows],
+                                                skip_special_tokens=True)
+        for request, text in zip(requests, texts):
+            request.future.set_result(text)
+
+
+def _stock_processors(ngram_size, penalty):
+    from transformers import NoRepeatNGramLogitsProcessor, RepetitionPenaltyLogitsProcessor
+    return LogitsProcessorList([RepetitionPenaltyLogitsProcessor(penalty), NoRepeatNGramLogitsProcessor(ngram_size)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched beam search: per-token overhead before / after")
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--requests", type=int, default=8, help="concurrent beam search requests")
+    parser.add_argument("--num-beams", type=int, default=5)
+    parser.add_argument("--max-new-tokens", type=int, default=40)
+    parser.add_argument("--steps", type=int, default=50, help="processor calls timed per configuration")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from model_utils import load_model
+    from prompting import build_prompt
+    from benchmark import QUESTIONS
+    tok, model = load_model(args.model, device_map=None)
+    vocab_size = model.config.vocab_size
+
+    # 1. The n-gram ban + repetition penalty alone, on one decoding step's scores
+    print(f"{'rows':>6}{'length':>8}{'stock ms':>10}{'batched ms':>12}")
+    for rows, length in [(args.num_beams, 128), (args.num_beams * args.requests, 128),
+                         (args.num_beams * args.requests, 512)]:
+        ids = torch.randint(vocab_size, (rows, length))
+        scores = torch.randn(rows, vocab_size)
+        stock = _stock_processors(2, 1.2)
+        ours = LogitsProcessorList([RepetitionPenalty(1.2), NoRepeatNGram(2)])
+        timings = []
+        for processors in (stock, ours):
+            processors(ids, scores.clone())   # warm-up
+            start = time.perf_counter()
+            for _ in range(args.steps):
+                processors(ids, scores.clone())
+            timings.append((time.perf_counter() - start) / args.steps * 1000)
+        print(f"{rows:>6}{length:>8}{timings[0]:>10.3f}{timings[1]:>12.3f}")
+
+    # 2. Whole requests: one model.generate per request vs every request in one batch
+    prompts = [build_prompt([], QUESTIONS[i % len(QUESTIONS)]) for i in range(args.requests)]
+    gen_kwargs = dict(max_new_tokens=args.max_new_tokens, num_beams=args.num_beams)
+    with torch.no_grad():
+        model.generate(tok.encode(prompts[0], return_tensors="pt"), pad_token_id=tok.eos_token_id, **gen_kwargs)
+        start = time.perf_counter()
+        sequential = []
+        for prompt in prompts:
+            inputs = tok.encode(prompt, return_tensors="pt")
+            outputs = model.generate(inputs, do_sample=False, pad_token_id=tok.eos_token_id,
+                                     no_repeat_ngram_size=2, repetition_penalty=1.2, **gen_kwargs)
+            sequential.append(tok.decode(outputs[0, inputs.shape[1]:], skip_special_tokens=True))
+        sequential_seconds = time.perf_counter() - start
+
+    batcher = BeamBatcher(model, tok, max_batch_size=args.requests)
+    batcher.generate(prompts[0], **gen_kwargs)   # warm-up
+    start = time.perf_counter()
+    futures = [batcher.submit(prompt, **gen_kwargs) for prompt in prompts]
+    batched = [future.result() for future in futures]
+    batched_seconds = time.perf_counter() - start
+
+    tokens = sum(len(tok.encode(text)) for text in sequential)
+    print(f"\n{args.requests} requests x {args.num_beams} beams, {tokens} tokens")
+    print(f"{'sequential':>12}: {sequential_seconds / tokens * 1000:.2f} ms/token")
+    print(f"{'batched':>12}: {batched_seconds / tokens * 1000:.2f} ms/token "
+          f"({sequential_seconds / batched_seconds:.2f}x)")
+    print(f"{'same text':>12}: {sum(a == b for a, b in zip(sequential, batched))}/{args.requests}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+benchmark.py
+Reproducible latency/throughput benchmark for KyleBot's decoding strategies.
+
+    python benchmark.py --out results.json                      # default grid
+    python benchmark.py --engines greedy batched-greedy --concurrency 1 8 --requests 16
+    python benchmark.py --out new.json --baseline results.json  # exit code 1 on regressions
+    python benchmark.py --engines server --server http://localhost:8000
+
+Every configuration (engine x prompt length x max_new_tokens x num_beams x concurrency) runs
+the same fixed prompts, after one warm-up request, and reports:
+- TTFT: time to first generated token (beam search only returns at the end, so TTFT = latency)
+- ITL: time between consecutive tokens
+- end-to-end latency p50/p95/p99 and tokens/sec over the whole run
+- with --isolate, peak RSS: each configuration then runs in a fresh process (which loads the
+  model again), since a process's peak RSS only ever grows and would include earlier configurations
+
+Engines:
+- greedy / sampling / beam:       the engine's strategies, one model.generate per request (engine.py)
+- top-p / typical / contrastive:  the other decoding strategies of engine.py
+- batched-greedy / batched-sampling: the ContinuousBatcher
+- batched-beam:                   the BeamBatcher (concurrent beam searches in one generate call)
+- speculative-greedy / speculative-sampling: draft model + GPT-2 verification (speculative.py)
+- lookup-greedy:                  prompt lookup speculation (n-grams from the prompt, no draft model)
+- server:                         a running server.py, streamed over HTTP (--server URL)
+"""
+
+import argparse, functools, itertools, json, platform, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:   # Windows
+    resource = None
+
+from prompting import build_prompt
+
+ENGINES = ["greedy", "sampling", "beam", "top-p", "typical", "contrastive", "batched-greedy", "batched-sampling",
+           "batched-beam", "speculative-greedy", "speculative-sampling", "lookup-greedy", "server"]
+
+# The fixed corpus: questions are cycled through, the filler pads prompts to the wanted length
+QUESTIONS = [
+    "What is artificial intelligence?",
+    "How does a neural network learn?",
+    "What is the difference between weather and climate?",
+    "Why is the sky blue?",
+    "What is a black hole?",
+    "How do vaccines work?",
+    "What is photosynthesis?",
+    "What is the internet?",
+]
+FILLER = (
+    "Machine learning is a field of computer science in which programs improve at a task by "
+    "learning from examples instead of following hand-written rules. A model is shown many "
+    "inputs together with the answers it should give, and its parameters are adjusted a little "
+    "after each mistake until its predictions become reliable. "
+)
+
+# metric -> +1 if higher is better, -1 if lower is better (used by the baseline comparison)
+METRICS = {
+    "ttft_ms.p50": -1, "ttft_ms.p95": -1,
+    "itl_ms.p50": -1, "itl_ms.p95": -1,
+    "e2e_ms.p50": -1, "e2e_ms.p95": -1, "e2e_ms.p99": -1,
+    "tokens_per_sec": +1,
+    "peak_rss_mb": -1,   # --isolate runs only
+}
+
+
+class TimingStreamer:
+    """Streamer (put/end protocol) that only records when each generated token arrived."""
+
+    def __init__(self):
+        self.token_times = []
+        self._skip_prompt = True
+
+    def put(self, value):
+        if self._skip_prompt:   # the first put is the prompt
+            self._skip_prompt = False
+            return
+        now = time.perf_counter()
+        self.token_times.extend([now] * value.numel())
+
+    def end(self):
+        pass
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) with linear interpolation; None for no values"""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def summarize(values):
+    return {"mean": sum(values) / len(values) if values else None,
+            **{f"p{q}": percentile(values, q) for q in (50, 95, 99)}}
+
+def peak_rss_mb():
+    """This process's peak RSS so far (run one configuration per process to attribute it)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10   # bytes on macOS, KB on Linux
+
+
+def make_conversations(tokenizer, prompt_tokens, n):
+    """
+    n fixed (history, question) pairs whose KyleBot prompt is about `prompt_tokens` tokens long:
+    one previous exchange, with the earlier answer padded with FILLER
+    """
+    filler_ids = tokenizer.encode(FILLER * (prompt_tokens // 40 + 1))
+    conversations = []
+    for i in range(n):
+        question = QUESTIONS[i % len(QUESTIONS)]
+        history = [{"user": QUESTIONS[(i + 1) % len(QUESTIONS)], "bot": ""}]
+        base = len(tokenizer.encode(build_prompt(history, question)))
+        history[0]["bot"] = tokenizer.decode(filler_ids[:max(prompt_tokens - base, 0)])
+        conversations.append((history, question))
+    return conversations
+
+
+def make_engines(server_url=None):
+    """
+    engine name -> fn(history, question, max_new_tokens, num_beams) returning (text, token_times):
+    when each generated token arrived (empty when the engine cannot stream)
+    """
+    from engine import get_engine
+    engine = get_engine()   # the front ends' engine: loads GPT-2 (in the background)
+    engine.wait()
+    from batching import ContinuousBatcher
+    from beam_batching import BeamBatcher
+    batcher = ContinuousBatcher(engine.model, engine.tokenizer, max_batch_size=64, kv_cache=engine.kv_cache)
+    beam_batcher = BeamBatcher(engine.model, engine.tokenizer, max_batch_size=16)
+
+    def direct(generate_fn, **params):
+        def run(history, question, max_new_tokens, num_beams):
+            streamer = TimingStreamer()
+            text = generate_fn(build_prompt(history, question), max_new_tokens=max_new_tokens,
+                               streamer=streamer, **params)
+            return text, streamer.token_times
+        return run
+
+    def strategy(method, **params):
+        # batch=False: one model.generate per request, not the engine's shared batchers
+        return direct(functools.partial(engine.generate, method), **params)
+
+    def beam(history, question, max_new_tokens, num_beams):
+        # generate() cannot stream beams: only end-to-end latency is measured
+        text = engine.generate("beam", build_prompt(history, question), max_new_tokens=max_new_tokens,
+                               num_beams=num_beams, batch=False)
+        return text, []
+
+    def batched_beam(history, question, max_new_tokens, num_beams):
+        text = beam_batcher.generate(build_prompt(history, question), max_new_tokens=max_new_tokens,
+                                     num_beams=num_beams)
+        return text, []
+
+    def batched(do_sample):
+        def run(history, question, max_new_tokens, num_beams):
+            streamer = TimingStreamer()
+            text = batcher.generate(build_prompt(history, question), max_new_tokens=max_new_tokens,
+                                    do_sample=do_sample, temperature=0.8, top_k=50, streamer=streamer)
+            return text, streamer.token_times
+        return run
+
+    engines = {
+        "greedy": strategy("greedy", batch=False),
+        "sampling": strategy("sampling", temperature=0.8, top_k=50, batch=False),
+        "beam": beam,
+        "top-p": strategy("top_p", temperature=0.8, top_p=0.9),
+        "typical": strategy("typical", temperature=0.8, typical_p=0.9),
+        "contrastive": strategy("contrastive", penalty_alpha=0.6, top_k=4),
+        "batched-greedy": batched(False),
+        "batched-sampling": batched(True),
+        "batched-beam": batched_beam,
+        "speculative-greedy": direct(engine.generate_speculative, method="greedy"),
+        "speculative-sampling": direct(engine.generate_speculative, method="sampling",
+                                       temperature=0.8, top_k=50),
+        "lookup-greedy": direct(engine.generate_speculative, method="greedy", speculative="lookup"),
+    }
+    if server_url:
+        from client import KyleBotClient
+        client = KyleBotClient(server_url)
+
+        def served(history, question, max_new_tokens, num_beams):
+            # The same conversation as chat messages: the server builds the same prompt from them.
+            # Times are per streamed chunk, which is one token except around multi-byte characters
+            messages = []
+            for exchange in history:
+                messages += [{"role": "user", "content": exchange["user"]},
+                             {"role": "assistant", "content": exchange["bot"]}]
+            messages.append({"role": "user", "content": question})
+            text, token_times = "", []
+            for delta in client.stream_chat(messages, max_tokens=max_new_tokens, method="greedy"):
+                text += delta
+                token_times.append(time.perf_counter())
+            return text, token_times
+        engines["server"] = served
+    return engine.tokenizer, engines
+
+
+def run_config(engine, conversations, max_new_tokens, num_beams, concurrency, tokenizer):
+    """Run every conversation through `engine` with `concurrency` requests in flight; returns metrics."""
+    engine(*conversations[0], max_new_tokens, num_beams)   # warm-up, not measured
+
+    def one(conversation):
+        start = time.perf_counter()
+        text, times = engine(*conversation, max_new_tokens, num_beams)
+        end = time.perf_counter()
+        return {
+            "e2e": end - start,
+            "ttft": (times[0] - start) if times else end - start,
+            "itl": [b - a for a, b in zip(times, times[1:])],
+            "tokens": len(times) if times else len(tokenizer.encode(text)),
+        }
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        runs = list(pool.map(one, conversations))
+    wall = time.perf_counter() - wall_start
+    ms = lambda values: summarize([v * 1000 for v in values])
+    return {
+        "requests": len(runs),
+        "tokens": sum(r["tokens"] for r in runs),
+        "ttft_ms": ms([r["ttft"] for r in runs]),
+        "itl_ms": ms(list(itertools.chain.from_iterable(r["itl"] for r in runs))),
+        "e2e_ms": ms([r["e2e"] for r in runs]),
+        "tokens_per_sec": sum(r["tokens"] for r in runs) / wall,
+    }
+
+def run_isolated(config, args):
+    """One configuration in a fresh process (see --isolate): its metrics and its own peak RSS"""
+    command = [sys.executable, __file__, "--run-config", json.dumps(config),
+               "--requests", str(args.requests), "--seed", str(args.seed)]
+    if args.server:
+        command += ["--server", args.server]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.splitlines()[-1])   # after the engine's loading messages
+
+
+def config_key(result):
+    return tuple(result[k] for k in ("engine", "prompt_tokens", "max_new_tokens", "num_beams", "concurrency"))
+
+def metric(result, name):
+    value = result
+    for part in name.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+def compare(results, baseline, tolerance):
+    """Configurations whose metrics got worse than the baseline by more than `tolerance`"""
+    old = {config_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = old.get(config_key(result))
+        if before is None:
+            continue
+        for name, direction in METRICS.items():
+            a, b = metric(before, name), metric(result, name)
+            if not a or b is None:
+                continue
+            change = (b - a) / a
+            if change * direction < -tolerance:
+                regressions.append({"config": config_key(result), "metric": name,
+                                    "baseline": a, "current": b, "change": change})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark KyleBot's decoding strategies")
+    parser.add_argument("--engines", nargs="+", default=ENGINES[:-1], choices=ENGINES)
+    parser.add_argument("--prompt-tokens", nargs="+", type=int, default=[32, 256])
+    parser.add_argument("--max-new-tokens", nargs="+", type=int, default=[32, 128])
+    parser.add_argument("--num-beams", nargs="+", type=int, default=[5], help="beam engines only")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--requests", type=int, default=8, help="prompts per configuration")
+    parser.add_argument("--server", help="server.py URL for the 'server' engine")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the results here (JSON)")
+    parser.add_argument("--baseline", help="compare against an earlier --out file")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative slowdown")
+    parser.add_argument("--isolate", action="store_true",
+                        help="run each configuration in a fresh process and record its peak RSS")
+    parser.add_argument("--run-config", help=argparse.SUPPRESS)   # one --isolate configuration (JSON)
+    args = parser.parse_args()
+    if "server" in args.engines and not args.server:
+        parser.error("the server engine needs --server URL")
+
+    import torch
+    if args.run_config:
+        config = json.loads(args.run_config)
+        tokenizer, engines = make_engines(args.server)
+        torch.manual_seed(args.seed)
+        conversations = make_conversations(tokenizer, config["prompt_tokens"], args.requests)
+        result = run_config(engines[config["engine"]], conversations, config["max_new_tokens"], config["num_beams"],
+                            config["concurrency"], tokenizer)
+        print(json.dumps({**result, "peak_rss_mb": peak_rss_mb()}))
+        return 0
+
+    if not args.isolate:
+        tokenizer, engines = make_engines(args.server)
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "machine": platform.machine(),
+        "seed": args.seed,
+    }
+    results = []
+    for engine, prompt_tokens, max_new_tokens, concurrency in itertools.product(
+            args.engines, args.prompt_tokens, args.max_new_tokens, args.concurrency):
+        for num_beams in (args.num_beams if engine.endswith("beam") else [1]):
+            config = {"engine": engine, "prompt_tokens": prompt_tokens, "max_new_tokens": max_new_tokens,
+                      "num_beams": num_beams, "concurrency": concurrency}
+            if args.isolate:
+                result = {**config, **run_isolated(config, args)}
+            else:
+                torch.manual_seed(args.seed)
+                conversations = make_conversations(tokenizer, prompt_tokens, args.requests)
+                result = {**config, **run_config(engines[engine], conversations, max_new_tokens, num_beams,
+                                                 concurrency, tokenizer)}
+            results.append(result)
+            print(f"{engine:20} prompt={prompt_tokens:<5} new={max_new_tokens:<4} beams={num_beams:<2} "
+                  f"conc={concurrency:<3} TTFT p50 {result['ttft_ms']['p50']:8.1f} ms | "
+                  f"e2e p95 {result['e2e_ms']['p95']:8.1f} ms | {result['tokens_per_sec']:7.1f} tok/s",
+                  file=sys.stderr)
+
+    report = {"meta": meta, "results": results}
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.tolerance)
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    for r in report.get("regressions", []):
+        print(f"❌ {' / '.join(map(str, r['config']))}: {r['metric']} {r['baseline']:.1f} -> "
+              f"{r['current']:.1f} ({r['change']:+.0%})", file=sys.stderr)
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
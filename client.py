@@ -0,0 +1,140 @@
+"""
+client.py
+Thin client for server.py (standard library only, no model in this process).
+
+RemoteKyleBot has the same interface as KyleBot, so the CLI and the Gradio app can talk to a
+running server instead of loading GPT-2 themselves: set KYLEBOT_SERVER_URL=http://host:8000.
+"""
+
+import json, urllib.error, urllib.request, uuid
+
+from prompting import clean_response
+from sessions import Exchange
+
+# KyleBot keyword arguments -> request fields understood by server.py
+PARAM_NAMES = {"max_new_tokens": "max_tokens"}
+
+# Decoding strategies the server runs (engine.STRATEGIES), default first
+METHODS = ["sampling", "greedy", "beam", "top_p", "typical", "contrastive"]
+
+# KyleBot.last_stats entries the server passes on in "usage"
+EXTRA_STATS = ("cached", "draft_acceptance", "tokens_per_pass", "best_of", "score", "scores", "tokens_sampled")
+
+# Earlier exchanges sent with each message; the server keeps as many as fit its context
+MAX_EXCHANGES_SENT = 20
+
+
+class KyleBotClient:
+    """Minimal client for the /v1/chat/completions endpoint"""
+
+    def __init__(self, base_url, timeout=120):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _post(self, body):
+        request = urllib.request.Request(
+            f"{self.base_url}/v1/chat/completions", data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json"}
+        )
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as exc:
+            try:
+                message = json.load(exc)["error"]["message"]
+            except Exception:
+                message = exc.reason
+            raise RuntimeError(f"KyleBot server error {exc.code}: {message}") from None
+
+    def chat(self, messages, **params):
+        """Full chat.completion response (dict)"""
+        with self._post({"messages": messages, **params}) as response:
+            return json.load(response)
+
+    def stream_chat(self, messages, usage=None, **params):
+        """Yields content deltas as the server streams them; the final chunk's usage is copied into `usage`"""
+        with self._post({"messages": messages, "stream": True, **params}) as response:
+            for line in response:
+                line = line.decode().strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    raise RuntimeError(f"KyleBot server error: {chunk['error']['message']}")
+                if usage is not None and "usage" in chunk:
+                    usage.update(chunk["usage"])
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    yield content
+
+
+class RemoteKyleBot:
+    """KyleBot whose responses are generated by server.py"""
+    __slots__ = ("client", "name", "conversation_history", "generation_method", "session_id", "last_stats")
+
+    def __init__(self, base_url, name="KyleBot", session_id=None):
+        self.client = KyleBotClient(base_url)
+        self.name = name
+        self.conversation_history = []
+        self.generation_method = "sampling"  # Default method
+        self.session_id = session_id or uuid.uuid4().hex  # Sent as "user", keys the server's KV cache
+        self.last_stats = {}
+
+    def add_to_history(self, user_input, bot_response):
+        """Keep track of conversation for context"""
+        self.conversation_history.append(Exchange(user_input, bot_response))
+
+    def create_messages(self, user_input):
+        """Recent history + the new message, in chat-completion format (the server builds the prompt)"""
+        messages = []
+        for exchange in self.conversation_history[-MAX_EXCHANGES_SENT:]:
+            messages.append({"role": "user", "content": exchange.user})
+            messages.append({"role": "assistant", "content": exchange.bot})
+        messages.append({"role": "user", "content": user_input})
+        return messages
+
+    def _request_params(self, method, kwargs):
+        params = {PARAM_NAMES.get(k, k): v for k, v in kwargs.items()}
+        params.update(method=method or self.generation_method, user=self.session_id)
+        return params
+
+    def generate_response(self, user_input, method=None, **kwargs):
+        """Generate a response using the specified method"""
+        result = self.client.chat(self.create_messages(user_input), **self._request_params(method, kwargs))
+        response = result["choices"][0]["message"]["content"]
+        self._set_stats(result.get("usage", {}))
+        self.add_to_history(user_input, response)
+        return response
+
+    def _set_stats(self, usage):
+        self.last_stats = {"tokens_generated": usage.get("completion_tokens", 0),
+                           "tokens_saved": usage.get("tokens_saved", 0),
+                           "tokens_discarded": usage.get("tokens_discarded", 0)}
+        # Speculative decoding, best-of-N and response cache stats, when the server reports them
+        self.last_stats.update({key: usage[key] for key in EXTRA_STATS if key in usage})
+
+    def stream_response(self, user_input, method=None, **kwargs):
+        """Generate a response piece by piece: yields text deltas as the server sends them"""
+        text = ""
+        usage = {}
+        self.last_stats = {}   # never show the previous reply's stats
+        for delta in self.client.stream_chat(self.create_messages(user_input), usage=usage,
+                                             **self._request_params(method, kwargs)):
+            text += delta
+            yield delta
+        self._set_stats(usage)
+        self.add_to_history(user_input, clean_response(text, self.name))
+
+    def set_generation_method(self, method):
+        """Change the generation method"""
+        if method in METHODS:
+            self.generation_method = method
+            return f"✅ Generation method set to: {method}"
+        return f"❌ Invalid method. Choose from: {METHODS}"
+
+    def clear_history(self):
+        """Clear conversation history"""
+        self.conversation_history = []
+        return "🗑️ Conversation history cleared!"
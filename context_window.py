@@ -0,0 +1,175 @@
+"""
+context_window.py
+Prompts that always fit the model, built from token ids instead of re-tokenized text.
+
+Every exchange is tokenized once, when it is added to the history (Exchange.prompt_ids); a prompt
+is then the persona line's ids + as many recent exchanges' ids as fit the token budget + the new
+message's ids. The budget is the model's context minus room for max_new_tokens, so a long
+conversation (or one long message) never overflows GPT-2's 1024 positions, and short exchanges
+leave room for more of them than a fixed window of 2.
+
+Optionally, exchanges that no longer fit are summarized in one line of earlier topics.
+
+Fragments that come back turn after turn (persona lines, repeated questions) are encoded once,
+through a TokenCache; texts encoded together go through the fast tokenizer in one batch call.
+"""
+
+import logging, threading
+from collections import OrderedDict
+
+from prompting import SYSTEM_PROMPT, Prompt
+
+log = logging.getLogger(__name__)
+
+
+def exchange_text(user, bot, name="KyleBot"):
+    """One earlier exchange as it appears in the prompt (the same lines as prompting.build_prompt)"""
+    return f"User: {user}\n{name}: {bot}\n"
+
+
+class TokenCache:
+    """
+    Memoized tokenizer.encode (LRU) for prompt fragments that repeat, with batched misses.
+    Texts longer than max_chars are encoded but not kept: one-off long messages would crowd out
+    the fragments worth caching.
+    """
+
+    def __init__(self, tokenizer, max_entries=4096, max_chars=2000):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._entries = OrderedDict()   # text -> ids tuple
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def encode(self, text):
+        return self.encode_batch([text])[0]
+
+    def encode_batch(self, texts):
+        """Ids (lists) of every text; the ones not cached are encoded in a single tokenizer call"""
+        with self._lock:
+            found = [self._entries.get(text) for text in texts]
+            for text, ids in zip(texts, found):
+                if ids is not None:
+                    self._entries.move_to_end(text)
+        missing = list(dict.fromkeys(text for text, ids in zip(texts, found) if ids is None))
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            encoded = dict(zip(missing, map(tuple, self.tokenizer(missing, add_special_tokens=False)["input_ids"])))
+            found = [ids if ids is not None else encoded[text] for text, ids in zip(texts, found)]
+            with self._lock:
+                self._entries.update((text, ids) for text, ids in encoded.items() if len(text) <= self.max_chars)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return [list(ids) for ids in found]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ContextWindow:
+    """
+    Token-budgeted prompt assembly.
+    - max_tokens: the model's context size (prompt + generated tokens)
+    - max_exchanges: optional cap on earlier exchanges, whatever the budget
+    - summarize: replace exchanges that did not fit with one "Earlier topics: ..." line of at
+      most summary_tokens tokens
+    """
+
+    def __init__(self, tokenizer, max_tokens=1024, max_exchanges=None, summarize=False, summary_tokens=48):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.max_exchanges = max_exchanges
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self.tokens = TokenCache(tokenizer)
+        # Prompt pieces are encoded without special tokens; a tokenizer that starts every text
+        # with BOS (Llama, ...) gets it once, in front of the whole prompt
+        bos = tokenizer.bos_token_id
+        self.start_ids = [bos] if bos is not None and tokenizer.encode("")[:1] == [bos] else []
+
+    def encode_exchange(self, user, bot, name="KyleBot"):
+        """
+        (ids of the reply, ids of the whole exchange as it appears in prompts), to store with it
+        (Exchange.bot_ids / prompt_ids): one batched tokenizer call
+        """
+        bot_ids, prompt_ids = self.tokenizer([bot, exchange_text(user, bot, name)], add_special_tokens=False)["input_ids"]
+        return bot_ids, prompt_ids
+
+    def _exchange_ids(self, history, name):
+        """Ids of each exchange: stored with it, or encoded (cached, in one batch) for plain dicts"""
+        ids = [list(getattr(exchange, "prompt_ids", None) or ()) for exchange in history]
+        missing = [i for i, exchange_ids in enumerate(ids) if not exchange_ids]
+        texts = [exchange_text(history[i]["user"], history[i]["bot"], name) for i in missing]
+        for i, exchange_ids in zip(missing, self.tokens.encode_batch(texts)):
+            ids[i] = exchange_ids
+        return ids
+
+    def build(self, history, user_input, name="KyleBot", max_new_tokens=50, system_prompt=None):
+        """
+        The prompt for `user_input` after `history` (sessions.Exchange records or {"user", "bot"}
+        dicts), as a prompting.Prompt carrying its ids. Newest exchanges are kept first.
+        """
+        budget = self.max_tokens - max_new_tokens
+        system_text = system_prompt if system_prompt is not None else SYSTEM_PROMPT.format(name=name)
+        system_ids = self.start_ids + self.tokens.encode(system_text)
+        user_input, tail_ids = self._fit_message(user_input, name, budget - len(system_ids))
+        room = budget - len(system_ids) - len(tail_ids)
+
+        limit = len(history) if self.max_exchanges is None else self.max_exchanges
+        candidates = self._exchange_ids(history[max(len(history) - limit, 0):], name)
+        summary_text, summary_ids, summary_room = "", [], 0
+        if self.summarize and (len(candidates) < len(history) or sum(map(len, candidates)) > room):
+            summary_room = min(self.summary_tokens, room)
+            room -= summary_room
+        kept = []
+        for ids in reversed(candidates):
+            if len(ids) > room:
+                break
+            kept.append(ids)
+            room -= len(ids)
+        dropped = len(history) - len(kept)
+        if dropped and summary_room:
+            summary_text, summary_ids = self._summary(history[:dropped], summary_room)
+
+        kept.reverse()
+        shown = history[dropped:]
+        text = system_text + summary_text + "".join(exchange_text(e["user"], e["bot"], name) for e in shown)
+        text += f"User: {user_input}\n{name}: "
+        ids = system_ids + summary_ids + [i for exchange_ids in kept for i in exchange_ids] + tail_ids
+        if dropped:
+            log.debug(f"context window: {len(kept)}/{len(history)} exchanges, {len(ids)} tokens")
+        return Prompt(text, ids)
+
+    def _fit_message(self, user_input, name, room):
+        """(message, ids of its "User: ..." line): a message longer than `room` keeps its end"""
+        ids = self.tokens.encode(f"User: {user_input}\n{name}: ")
+        if len(ids) <= room:
+            return user_input, ids
+        if room <= 0:
+            raise ValueError(f"max_new_tokens leaves no room for the prompt ({self.max_tokens} tokens of context)")
+        message_ids = self.tokenizer.encode(user_input, add_special_tokens=False)
+        keep = len(message_ids) - (len(ids) - room)
+        while keep > 0:
+            # Re-encoded as text, so the ids are exactly the prompt's; the cut may shift a token
+            user_input = self.tokenizer.decode(message_ids[-keep:]).lstrip()
+            ids = self.tokens.encode(f"User: {user_input}\n{name}: ")
+            if len(ids) <= room:
+                log.info(f"context window: message cut to its last {keep} of {len(message_ids)} tokens")
+                return user_input, ids
+            keep -= len(ids) - room
+        raise ValueError("max_new_tokens leaves no room for the message")
+
+    def _summary(self, dropped, max_tokens):
+        """'Earlier topics: ...' from the user messages of dropped exchanges, newest first, in max_tokens"""
+        topics, text, ids = [], "", []
+        for exchange in reversed(dropped):
+            topic = " ".join(exchange["user"].split()[:12]).rstrip("?!. ")
+            candidate = f"Earlier topics: {'; '.join(topics + [topic])}.\n"
+            candidate_ids = self.tokens.encode(candidate)
+            if len(candidate_ids) > max_tokens:
+                break
+            topics.append(topic)
+            text, ids = candidate, candidate_ids
+        return text, ids
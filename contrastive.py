@@ -0,0 +1,60 @@
+"""
+contrastive.py
+Contrastive search (Su et al., 2022, "A Contrastive Framework for Neural Text Generation").
+
+Deterministic like greedy decoding, without greedy's loops: of the top_k most likely next tokens
+it picks the one with the best
+
+    (1 - penalty_alpha) * probability - penalty_alpha * max cosine similarity to earlier tokens
+
+where the similarity compares the candidate's last hidden state with every hidden state of the
+text so far, so a token that would make the model repeat itself scores low. penalty_alpha=0 is
+greedy decoding.
+
+transformers 5 no longer has it in model.generate (it moved to a Hub repository run with
+trust_remote_code), so this is a small local implementation: each step runs the top_k
+candidates through the model as one batch of k rows continuing the same KV state.
+"""
+
+import torch
+import torch.nn.functional as F
+
+from model_utils import cache_from_tensors, cache_to_tensors
+
+
+def contrastive_search(model, input_ids, max_new_tokens=50, penalty_alpha=0.6, top_k=4, eos_token_id=None,
+                       stopping_criteria=None, streamer=None):
+    """
+    input_ids: [1, seq] prompt ids. Returns [1, seq + new] ids, like model.generate.
+    stopping_criteria / streamer follow the model.generate protocols.
+    """
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+    out = model(input_ids, use_cache=True, output_hidden_states=True)
+    past = cache_to_tensors(out.past_key_values)
+    context = out.hidden_states[-1]                  # [1, seq, hidden]: what candidates are compared with
+    logits = out.logits[:, -1]
+    ids = input_ids
+    for _ in range(max_new_tokens):
+        probs, candidates = logits.float().softmax(-1).topk(top_k, dim=-1)        # [1, k]
+        # expand() shares the prompt's keys/values between the k rows; update() concatenates into new tensors
+        shared = cache_from_tensors([(k.expand(top_k, -1, -1, -1), v.expand(top_k, -1, -1, -1)) for k, v in past])
+        out = model(candidates.view(top_k, 1), past_key_values=shared, use_cache=True, output_hidden_states=True)
+        hidden = out.hidden_states[-1][:, -1]                                      # [k, hidden]
+        degeneration = F.cosine_similarity(hidden[:, None].float(), context.float(), dim=-1).max(-1).values
+        best = int(((1 - penalty_alpha) * probs[0] - penalty_alpha * degeneration).argmax())
+
+        token = candidates[:, best:best + 1]
+        ids = torch.cat([ids, token], dim=-1)
+        context = torch.cat([context, hidden[None, best:best + 1]], dim=1)
+        logits = out.logits[best:best + 1, -1]
+        past = [(k[best:best + 1], v[best:best + 1]) for k, v in cache_to_tensors(out.past_key_values)]
+        if streamer is not None:
+            streamer.put(token[0].cpu())
+        if eos_token_id is not None and int(token) == eos_token_id:
+            break
+        if stopping_criteria is not None and bool(stopping_criteria(ids, None).any()):
+            break
+    if streamer is not None:
+        streamer.end()
+    return ids
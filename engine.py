@@ -0,0 +1,770 @@
+"""
+engine.py
+The generation engine behind both front ends (kylebot_fixed.py and kylebot_gradio.py): the model
+with its caches and batchers, the decoding strategies, and the KyleBot chat class.
+
+    from engine import KyleBot
+    kylebot = KyleBot()
+    kylebot.generate_response("What is AI?", method="top_p", top_p=0.9)
+
+get_engine() loads a model once per process, through model_utils.load_model on a background
+thread: front ends imported into one process share one set of weights, and loading options
+(KYLEBOT_MODEL, KYLEBOT_INT8, KYLEBOT_BF16, KYLEBOT_COMPILE) apply to all of them.
+
+Decoding strategies are looked up by name in STRATEGIES; add one with @register_strategy.
+Built in: greedy, sampling, beam, top_p (nucleus sampling), typical (locally typical sampling)
+and contrastive (contrastive search).
+"""
+
+import functools, itertools, logging, os, threading, time, uuid
+from collections import OrderedDict
+
+from metrics import REQUEST_SECONDS, REQUESTS, TOKENS, maybe_profile, phase
+from prompting import SYSTEM_PROMPT, clean_response, encode_prompt, turn_markers
+from response_cache import ResponseCache, cache_key, normalize_question
+from sessions import ConversationStore, Exchange
+from startup import BackgroundLoad, StartupTimer
+from streaming import StopStringFilter, stream_generate
+
+log = logging.getLogger(__name__)
+
+# The chat model, loaded from a local snapshot (or quantized to int8 / bfloat16 on CPU)
+MODEL = os.environ.get("KYLEBOT_MODEL", "gpt2")
+INT8 = os.environ.get("KYLEBOT_INT8", "") not in ("", "0")
+BF16 = os.environ.get("KYLEBOT_BF16", "") not in ("", "0")
+
+# KYLEBOT_COMPILE=1: greedy decoding and sampling run one request at a time through a compiled
+# decode step over pre-allocated KV buffers (static_decode.py; compiled at startup) instead of
+# the continuous batch: faster per token for one user, but concurrent chats no longer share steps
+COMPILE = os.environ.get("KYLEBOT_COMPILE", "") not in ("", "0")
+
+# Models a request can pick (KyleBot.generate_response(..., model="distilgpt2")): each is loaded on
+# first use, and the least recently used ones are unloaded when all weights loaded exceed
+# KYLEBOT_MODEL_MEMORY_MB. KYLEBOT_MODEL is pinned: it stays loaded
+MODELS = [name.strip() for name in os.environ.get("KYLEBOT_MODELS", "gpt2,distilgpt2,gpt2-medium").split(",")
+          if name.strip()]
+MODEL_MEMORY_MB = int(os.environ.get("KYLEBOT_MODEL_MEMORY_MB", "2048"))
+
+# Small model with GPT-2's tokenizer that proposes tokens for speculative decoding
+DRAFT_MODEL = os.environ.get("KYLEBOT_DRAFT_MODEL", "distilgpt2")
+
+# Greedy and beam replies to repeated questions are cached (in memory, plus in this SQLite file
+# if set); KYLEBOT_RESPONSE_SAMPLES=K also caches K sampled replies per question
+RESPONSE_CACHE_PATH = os.environ.get("KYLEBOT_RESPONSE_CACHE")
+RESPONSE_SAMPLES = int(os.environ.get("KYLEBOT_RESPONSE_SAMPLES", "0"))
+
+# Prompts repeat as many earlier exchanges as fit this many tokens (default: the model's context);
+# KYLEBOT_SUMMARIZE_HISTORY=1 sums up the ones that no longer fit in a line of earlier topics
+CONTEXT_TOKENS = int(os.environ.get("KYLEBOT_CONTEXT_TOKENS", "0"))
+SUMMARIZE_HISTORY = os.environ.get("KYLEBOT_SUMMARIZE_HISTORY", "") not in ("", "0")
+
+# KYLEBOT_HISTORY_DB=chats.db keeps conversations across restarts: a bot created with the session
+# id of an earlier one continues it, loading its last KYLEBOT_HISTORY_WINDOW exchanges
+HISTORY_PATH = os.environ.get("KYLEBOT_HISTORY_DB")
+HISTORY_WINDOW = int(os.environ.get("KYLEBOT_HISTORY_WINDOW", "50"))
+
+BATCHABLE_KWARGS = {"streamer", "stopping_criteria"}  # generate() options the batcher also handles
+BEAM_BATCHABLE_KWARGS = {"no_repeat_ngram_size", "repetition_penalty", "stopping_criteria"}  # ... the beam batcher
+
+
+class Engine:
+    """
+    One loaded model and everything that serves it: KV caches, the continuous and beam batchers,
+    the context window, the response cache and (on first use) the speculative draft model.
+    Loading starts in the background right away; generate() waits for it.
+    """
+
+    def __init__(self, model_name=MODEL, int8=INT8, bf16=BF16, compile=COMPILE, quant_4bit=False,
+                 kv_cache_bytes=512 * 1024 ** 2, context_tokens=CONTEXT_TOKENS, summarize_history=SUMMARIZE_HISTORY,
+                 response_cache=None, registry=None):
+        self.model_name = model_name
+        self.int8 = int8
+        self.bf16 = bf16
+        self.compile = compile
+        self.quant_4bit = quant_4bit
+        self.kv_cache_bytes = kv_cache_bytes
+        self.context_tokens = context_tokens
+        self.summarize_history = summarize_history
+        self.response_cache = response_cache or ResponseCache(path=RESPONSE_CACHE_PATH)  # keys include the model
+        self.registry = registry
+        self.nbytes = 0   # weights, once loaded
+        self.draft_model = None
+        self._draft_lock = threading.Lock()
+        self._loading = BackgroundLoad(self._load)
+
+    def _load(self):
+        """
+        Import torch/transformers and load the model. This runs on a background thread while the
+        front end starts up; the first reply waits for it (see wait).
+        """
+        global torch, StoppingCriteriaList, generate_with_session_cache, TurnBoundaryStop
+        global DecodeTimer, PromptLookupDecoder, SpeculativeDecoder, SpeculativeStats, contrastive_search, sweep
+        global decode_forked
+        timer = StartupTimer()
+        with timer.phase("imports"):
+            import torch
+            from transformers import StoppingCriteriaList
+            from batching import ContinuousBatcher, decode_forked
+            from beam_batching import BeamBatcher
+            from kv_cache import PrefixCache, SessionKVCache, generate_with_session_cache
+            from context_window import ContextWindow
+            from contrastive import contrastive_search
+            from stopping import DecodeTimer, TurnBoundaryStop
+            from speculative import PromptLookupDecoder, SpeculativeDecoder, SpeculativeStats
+            from sweep import sweep
+            from model_utils import load_model, model_footprint
+
+        # The system line's keys/values are computed once here and reused by every request.
+        # The snapshot is a local copy of the model: fast tokenizer, memory-mapped weights
+        self.prefix_cache = PrefixCache()
+        self.tokenizer, self.model = load_model(
+            self.model_name, quant_4bit=self.quant_4bit, int8=self.int8, bf16=self.bf16, compile=self.compile,
+            snapshot=True, timer=timer,
+            prefix_cache=self.prefix_cache, prefixes={"KyleBot": SYSTEM_PROMPT.format(name="KyleBot")}
+        )
+        self.device = next(self.model.parameters()).device
+        self.nbytes = model_footprint(self.model)
+        if self.registry is not None:
+            # Models with the same vocabulary share one tokenizer (and so their prompts' token ids)
+            self.tokenizer = self.registry.shared_tokenizer(self.tokenizer)
+        # Without a compiled decoder (not GPT-2), greedy decoding and sampling keep the batcher
+        self.batching = getattr(self.model, "static_decoder", None) is None
+
+        # Prompts are assembled from each exchange's token ids (encoded once) within the context size
+        context = getattr(self.model.config, "n_positions", None) or self.model.config.max_position_embeddings
+        self.context_window = ContextWindow(self.tokenizer, max_tokens=self.context_tokens or context,
+                                            summarize=self.summarize_history)
+
+        # Attention keys/values from each session's previous turn, so a new turn only prefills new text
+        self.kv_cache = SessionKVCache(max_bytes=self.kv_cache_bytes, prefix_cache=self.prefix_cache)
+
+        # Concurrent chats share the model through one continuous batch:
+        # each decoding step runs every in-flight greedy/sampling request together
+        self.batcher = ContinuousBatcher(self.model, self.tokenizer, max_batch_size=32, kv_cache=self.kv_cache)
+        # ... and concurrent beam searches run their beams together in one generate() call
+        self.beam_batcher = BeamBatcher(self.model, self.tokenizer, max_batch_size=8)
+        print(f"✅ {self.model_name} loaded ({self.model.num_parameters():,} parameters) | {timer.summary()}")
+        if self.registry is not None:
+            self.registry.loaded(self)
+
+    def wait(self):
+        """Block until the model has loaded (returns at once after that)"""
+        self._loading.result()
+
+    def ready(self):
+        return self._loading.ready()
+
+    def load_draft_model(self):
+        """DRAFT_MODEL, loaded on first use"""
+        self.wait()
+        with self._draft_lock:
+            if self.draft_model is None:
+                from model_utils import load_model
+                _, self.draft_model = load_model(DRAFT_MODEL, snapshot=True)
+                print(f"✅ Draft model {DRAFT_MODEL} loaded for speculative decoding")
+        return self.draft_model
+
+    def unload(self):
+        """
+        Stop the batchers' workers once their queued requests are done, so the model is freed
+        when the last request holding this engine finishes
+        """
+        if self.ready():
+            self.batcher.close()
+            self.beam_batcher.close()
+
+    def drop_session(self, session_id):
+        """Forget a session's cached keys/values (there are none before the model has loaded)"""
+        if self.ready():
+            self.kv_cache.drop(session_id)
+
+    def encode(self, prompt):
+        """[1, seq] tensor of a prompt's ids, on the model's device"""
+        with phase("tokenize"):
+            return torch.tensor([encode_prompt(self.tokenizer, prompt)], device=self.device)
+
+    def decode_new(self, outputs, inputs):
+        with phase("detokenize"):
+            # Only the new tokens: the prompt is never decoded back to text
+            return self.tokenizer.decode(outputs[0, inputs.shape[1]:], skip_special_tokens=True)
+
+    def generate(self, method, prompt, max_new_tokens=50, session_id=None, **kwargs):
+        """The reply to a prompt (text or prompting.Prompt) decoded with the strategy `method`"""
+        strategy = STRATEGIES.get(method)
+        if strategy is None:
+            raise ValueError(f"unknown decoding strategy {method!r} (choose from {', '.join(STRATEGIES)})")
+        self.wait()
+        return strategy.generate(self, prompt, max_new_tokens=max_new_tokens, session_id=session_id, **kwargs)
+
+    def generate_direct(self, prompt, label, session_id=None, **gen_kwargs):
+        """model.generate() on one prompt, continuing the session's cached keys/values"""
+        inputs = self.encode(prompt)
+        with maybe_profile(label), torch.no_grad():
+            outputs = generate_with_session_cache(self.model, inputs, self.kv_cache, session_id,
+                                                  pad_token_id=self.tokenizer.eos_token_id, **gen_kwargs)
+        return self.decode_new(outputs, inputs)
+
+    def generate_speculative(self, prompt, method="sampling", max_new_tokens=50, temperature=0.8, top_k=50,
+                             session_id=None, speculative=True, ngram_size=3, num_draft_tokens=None, **kwargs):
+        """
+        Speculative decoding: a few guessed tokens are checked by the model in one pass.
+        - speculative=True / "draft": the draft model guesses (num_draft_tokens, default 4)
+        - speculative="lookup": the guesses are what followed the last ngram_size tokens earlier in
+          the prompt, e.g. a definition being repeated (num_draft_tokens, default 10); no second model
+        Same output distribution as greedy decoding / sampling, in fewer passes of the model.
+        """
+        if method not in ("greedy", "sampling"):
+            raise ValueError("speculative decoding works with greedy decoding and sampling only")
+        self.wait()
+        if speculative == "lookup":
+            decoder = PromptLookupDecoder(self.model, ngram_size=ngram_size, num_draft_tokens=num_draft_tokens or 10)
+        else:
+            decoder = SpeculativeDecoder(self.model, self.load_draft_model(), num_draft_tokens=num_draft_tokens or 4)
+        inputs = self.encode(prompt)
+        with maybe_profile("speculative"):
+            outputs = decoder.generate(
+                inputs, max_new_tokens=max_new_tokens,
+                do_sample=method != "greedy",
+                temperature=temperature,
+                top_k=top_k,
+                kv_cache=self.kv_cache,
+                session_id=session_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+                **kwargs
+            )
+        return self.decode_new(outputs, inputs)
+
+    def generate_best_of(self, prompt, n=4, max_new_tokens=50, temperature=0.8, top_k=50, session_id=None,
+                         stops=None, **kwargs):
+        """
+        n sampled replies to one prompt, decoded as one batch after a single prefill (continuing
+        the session's cached keys/values): [{"text", "ids", "logprob"}] in sampling order.
+        stops: one StoppingCriteria per reply, so each stops at its own turn boundary.
+        """
+        if kwargs:
+            raise ValueError(f"best-of-N sampling takes temperature and top_k only, not {', '.join(kwargs)}")
+        self.wait()
+        ids = encode_prompt(self.tokenizer, prompt)
+        past, _ = self.kv_cache.lookup(session_id, ids)
+        with maybe_profile("best_of"):
+            rows, prompt_past = decode_forked(
+                self.model, ids, temperature=[temperature] * n, top_k=[top_k] * n, do_sample=[True] * n,
+                max_new_tokens=[max_new_tokens] * n, stops=stops, eos_token_id=self.tokenizer.eos_token_id,
+                past=past,
+            )
+        self.kv_cache.store(session_id, ids, prompt_past)
+        with phase("detokenize"):
+            texts = self.tokenizer.batch_decode([row["ids"] for row in rows], skip_special_tokens=True)
+        return [{"text": text, "ids": row["ids"], "logprob": row["logprob"]} for text, row in zip(texts, rows)]
+
+
+class ModelRegistry:
+    """
+    The engines of several models in one process, within a memory budget.
+    - models: the names get() accepts; each is loaded on its first request
+    - max_bytes: when the weights loaded add up to more, the least recently used engines are
+      unloaded (never a pinned one, nor the one that just loaded)
+    - pinned: models that stay loaded, e.g. the default one
+    - engine_options: Engine arguments for every model, e.g. int8=True
+    Engines share one response cache, and one tokenizer when their vocabularies match.
+    """
+
+    def __init__(self, models=MODELS, max_bytes=MODEL_MEMORY_MB * 2 ** 20, pinned=(MODEL,), **engine_options):
+        self.models = list(dict.fromkeys([*pinned, *models]))
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.engine_options = engine_options
+        self.response_cache = ResponseCache(path=RESPONSE_CACHE_PATH)
+        self._engines = OrderedDict()   # model name -> Engine, least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, model_name=MODEL):
+        """The Engine for `model_name`, created (and its loading started) on first use"""
+        if model_name not in self.models:
+            raise ValueError(f"unknown model {model_name!r} (choose from {', '.join(self.models)})")
+        with self._lock:
+            engine = self._engines.get(model_name)
+            if engine is None:
+                engine = self._engines[model_name] = Engine(model_name, response_cache=self.response_cache,
+                                                            registry=self, **self.engine_options)
+            self._engines.move_to_end(model_name)
+        return engine
+
+    def pin(self, model_name):
+        self.pinned.add(model_name)
+
+    def unpin(self, model_name):
+        self.pinned.discard(model_name)
+
+    def shared_tokenizer(self, tokenizer):
+        """A loaded engine's tokenizer with the same vocabulary as `tokenizer`, else `tokenizer`"""
+        with self._lock:
+            engines = [engine for engine in self._engines.values() if engine.nbytes]
+        vocab = None
+        for engine in engines:
+            other = engine.tokenizer
+            if other is tokenizer or len(other) != len(tokenizer) or other.eos_token_id != tokenizer.eos_token_id:
+                continue
+            vocab = vocab or tokenizer.get_vocab()
+            if other.get_vocab() == vocab:
+                return other
+        return tokenizer
+
+    def loaded(self, engine):
+        """Called by an engine that finished loading: unload others until the weights fit the budget"""
+        with self._lock:
+            unloading = []
+            total = sum(other.nbytes for other in self._engines.values())
+            for name, other in list(self._engines.items()):
+                if total <= self.max_bytes:
+                    break
+                if other is engine or name in self.pinned or not other.nbytes:
+                    continue
+                del self._engines[name]
+                total -= other.nbytes
+                unloading.append(other)
+        for other in unloading:
+            log.info(f"Unloading {other.model_name} ({other.nbytes / 2 ** 20:.0f} MB) to load {engine.model_name}")
+            other.unload()
+        if total > self.max_bytes:
+            log.warning(f"Loaded models use {total / 2 ** 20:.0f} MB, over the {self.max_bytes / 2 ** 20:.0f} MB "
+                        f"budget (pinned or still loading)")
+
+    def drop_session(self, session_id):
+        """Forget a session's cached keys/values in every loaded model"""
+        with self._lock:
+            engines = list(self._engines.values())
+        for engine in engines:
+            engine.drop_session(session_id)
+
+    @property
+    def nbytes(self):
+        return sum(engine.nbytes for engine in list(self._engines.values()))
+
+    def __contains__(self, model_name):
+        return model_name in self._engines
+
+_registry = None
+_registry_lock = threading.Lock()
+history_store = ConversationStore(HISTORY_PATH, window=HISTORY_WINDOW) if HISTORY_PATH else None
+
+def get_registry():
+    """
+    The process-wide ModelRegistry (KYLEBOT_MODELS), created on first use: a process that builds
+    its own (server.py) never opens a second response cache
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
+
+def get_engine(model_name=MODEL):
+    """The process-wide Engine for `model_name` (see ModelRegistry)"""
+    return get_registry().get(model_name)
+
+
+# ---- decoding strategies ---------------------------------------------------
+class Strategy:
+    __slots__ = ("name", "generate", "description", "deterministic", "streams")
+
+    def __init__(self, name, generate, description, deterministic, streams):
+        self.name = name
+        self.generate = generate
+        self.description = description
+        self.deterministic = deterministic
+        self.streams = streams
+
+STRATEGIES = {}
+
+def register_strategy(name, deterministic=False, streams=True):
+    """
+    Add a decoding strategy: the decorated fn(engine, prompt, max_new_tokens=50, session_id=None,
+    **kwargs) returns the reply text once the engine has loaded. Its docstring's first line
+    describes it.
+    - deterministic: the same prompt always gets the same reply (cached, one per question)
+    - streams: it feeds a `streamer` kwarg token by token; otherwise the reply comes at once
+    """
+    def register(fn):
+        description = (fn.__doc__ or name).strip().splitlines()[0]
+        STRATEGIES[name] = Strategy(name, fn, description, deterministic, streams)
+        return fn
+    return register
+
+@register_strategy("greedy", deterministic=True)
+def greedy(engine, prompt, max_new_tokens=50, session_id=None, batch=True, **kwargs):
+    """Greedy decoding: Always picks the most likely next word"""
+    if batch and engine.batching and set(kwargs) <= BATCHABLE_KWARGS:
+        # Plain greedy requests join the shared batch; extra generate() options take the direct path
+        return engine.batcher.generate(prompt, max_new_tokens=max_new_tokens, do_sample=False,
+                                       session_id=session_id, **kwargs)
+    return engine.generate_direct(prompt, "greedy", session_id, max_new_tokens=max_new_tokens,
+                                  do_sample=False, **kwargs)
+
+@register_strategy("sampling")
+def sampling(engine, prompt, max_new_tokens=50, session_id=None, temperature=0.8, top_k=50, batch=True, **kwargs):
+    """
+    Sampling with temperature and top-k: More creative and diverse responses
+    - temperature: Controls randomness (higher = more random)
+    - top_k: Only considers the top k most likely words
+    """
+    if batch and engine.batching and set(kwargs) <= BATCHABLE_KWARGS:
+        return engine.batcher.generate(prompt, max_new_tokens=max_new_tokens, temperature=temperature,
+                                       top_k=top_k, do_sample=True, session_id=session_id, **kwargs)
+    return engine.generate_direct(prompt, "sampling", session_id, max_new_tokens=max_new_tokens,
+                                  do_sample=True, temperature=temperature, top_k=top_k, **kwargs)
+
+@register_strategy("beam", deterministic=True, streams=False)
+def beam(engine, prompt, max_new_tokens=50, session_id=None, num_beams=5, batch=True, **kwargs):
+    """Beam search: Explores multiple possible sequences"""
+    if batch and set(kwargs) <= BEAM_BATCHABLE_KWARGS:
+        # Beam searches running at the same time are batched; extra generate() options take the direct path
+        return engine.beam_batcher.generate(prompt, max_new_tokens=max_new_tokens, num_beams=num_beams, **kwargs)
+    # Defaults against repetition, unless given
+    kwargs = {"no_repeat_ngram_size": 2, "repetition_penalty": 1.2, **kwargs}
+    return engine.generate_direct(prompt, "beam", session_id, max_new_tokens=max_new_tokens,
+                                  do_sample=False, num_beams=num_beams, **kwargs)
+
+@register_strategy("top_p")
+def top_p(engine, prompt, max_new_tokens=50, session_id=None, temperature=0.8, top_p=0.9, **kwargs):
+    """
+    Nucleus sampling: Samples from the smallest set of words whose probabilities add up to top_p
+    (a short list when the model is sure, a long one when it is not)
+    """
+    return engine.generate_direct(prompt, "top_p", session_id, max_new_tokens=max_new_tokens, do_sample=True,
+                                  temperature=temperature, top_p=top_p, top_k=0, **kwargs)
+
+@register_strategy("typical")
+def typical(engine, prompt, max_new_tokens=50, session_id=None, temperature=0.8, typical_p=0.9, **kwargs):
+    """
+    Typical sampling: Samples from the words whose surprise is closest to the expected one,
+    dropping both the bland and the unlikely (typical_p: probability mass kept)
+    """
+    return engine.generate_direct(prompt, "typical", session_id, max_new_tokens=max_new_tokens, do_sample=True,
+                                  temperature=temperature, typical_p=typical_p, top_k=0, **kwargs)
+
+@register_strategy("contrastive", deterministic=True)
+def contrastive(engine, prompt, max_new_tokens=50, session_id=None, penalty_alpha=0.6, top_k=4,
+                stopping_criteria=None, streamer=None):
+    """
+    Contrastive search: Picks the likely word least similar to what was already said,
+    coherent without repeating itself (see contrastive.py)
+    """
+    # Candidates are compared with the hidden states of the whole prompt, which the session's
+    # cached keys/values do not keep: the prompt is always prefilled
+    inputs = engine.encode(prompt)
+    with maybe_profile("contrastive"), torch.no_grad():
+        outputs = contrastive_search(
+            engine.model, inputs, max_new_tokens=max_new_tokens,
+            penalty_alpha=penalty_alpha,
+            top_k=top_k,
+            eos_token_id=engine.tokenizer.eos_token_id,
+            stopping_criteria=StoppingCriteriaList([*(stopping_criteria or []), DecodeTimer()]),
+            streamer=streamer
+        )
+    return engine.decode_new(outputs, inputs)
+
+
+# ---- best-of-N scorers ---------------------------------------------------------
+# A scorer maps a candidate reply ({"text" (cleaned), "ids", "logprob"}) to a score; the highest wins
+def mean_logprob(candidate):
+    """The model's average log-probability per token: its confidence, not favouring short replies"""
+    return candidate["logprob"] / max(len(candidate["ids"]), 1)
+
+def total_logprob(candidate):
+    """The model's log-probability of the whole reply (prefers short ones)"""
+    return candidate["logprob"]
+
+SCORERS = {"logprob": mean_logprob, "total_logprob": total_logprob}
+
+
+# ---- the chat bot ------------------------------------------------------------
+def response_cache_samples(method):
+    """Replies cached per question: 1 for deterministic methods, RESPONSE_SAMPLES for the others"""
+    strategy = STRATEGIES.get(method)
+    return 1 if strategy is not None and strategy.deterministic else RESPONSE_SAMPLES
+
+class KyleBot:
+    # Fixed attribute set: no per-instance __dict__, so many concurrent sessions stay small
+    __slots__ = ("name", "conversation_history", "generation_method", "session_id",
+                 "turn_markers", "last_stats", "engine", "system_prompt")
+
+    def __init__(self, name="KyleBot", session_id=None, engine=None, store=None, history=None, system_prompt=None):
+        """
+        history: the conversation so far (Exchanges or {"user", "bot"} dicts, e.g. an API request's
+        messages) instead of the stored one
+        system_prompt: replaces the default system line (prompting.SYSTEM_PROMPT)
+        """
+        self.name = name
+        self.generation_method = "sampling"  # Default method
+        self.session_id = session_id or uuid.uuid4().hex  # Key for this conversation's KV cache
+        self.turn_markers = turn_markers(name)  # The model started writing the next turn
+        self.last_stats = {}
+        self.engine = engine or get_engine()  # Shared by every bot of the process
+        self.system_prompt = system_prompt
+        store = store or history_store
+        if history is not None:
+            self.conversation_history = list(history)
+        elif store is not None and session_id is not None:
+            # Continue the session's stored conversation (its tail only); new exchanges are appended
+            self.conversation_history = store.history(self.session_id, model=self.engine.model_name)
+        else:
+            self.conversation_history = []
+
+    def add_to_history(self, user_input, bot_response):
+        """Keep track of conversation for context (token ids are encoded once, here)"""
+        self.engine.wait()
+        bot_ids, prompt_ids = self.engine.context_window.encode_exchange(user_input, bot_response, self.name)
+        self.conversation_history.append(Exchange(user_input, bot_response, bot_ids, prompt_ids))
+
+    def create_context_prompt(self, user_input, max_new_tokens=50, engine=None):
+        """Create a prompt with as much conversation history as fits next to max_new_tokens"""
+        engine = engine or self.engine
+        engine.wait()
+        return engine.context_window.build(self.history_for(engine), user_input, self.name, max_new_tokens,
+                                           self.system_prompt)
+
+    def history_for(self, engine):
+        """
+        The history to build `engine`'s prompts from: its exchanges' stored token ids come from
+        this bot's engine, so a model with another tokenizer re-encodes their text
+        """
+        if not self.conversation_history or engine.tokenizer is self.engine.tokenizer:
+            return self.conversation_history
+        return [{"user": exchange["user"], "bot": exchange["bot"]} for exchange in self.conversation_history]
+
+    def model_engine(self, model):
+        """The engine of `model` (a name in ModelRegistry.models), or this bot's own for None"""
+        if model is None or model == self.engine.model_name:
+            return self.engine
+        return (self.engine.registry or get_registry()).get(model)
+
+    def generate_response(self, user_input, method=None, speculative=False, model=None, best_of=None, scorer=None,
+                          **kwargs):
+        """
+        Generate a response using the specified method (a name in STRATEGIES; others sample).
+        speculative: True / "draft" (draft model) or "lookup" (prompt n-grams) speculative decoding
+        model: answer this one with another model of the registry (e.g. "distilgpt2")
+        best_of: sample this many replies in one batch and keep the best by `scorer` (see best_of_n)
+        """
+        method = self.resolve_method(method)
+        engine = self.model_engine(model)
+        start = time.perf_counter()
+        key, cached = self.cache_lookup(user_input, method, kwargs, engine) if not best_of else (None, None)
+        if cached is not None:
+            self.add_to_history(user_input, cached)
+            self.record_cache_hit(method, time.perf_counter() - start)
+            return cached
+        with phase("prompt"):
+            prompt = self.create_context_prompt(user_input, kwargs.get("max_new_tokens", 50), engine)
+
+        if best_of:
+            best, stop, candidates = self.best_of_n(engine, prompt, method, best_of, scorer, kwargs)
+        else:
+            stop = self.add_early_stopping(kwargs, engine=engine)
+
+        if best_of:
+            response = best["text"]
+        elif speculative:
+            self.add_speculation(kwargs)
+            response = engine.generate_speculative(prompt, method, session_id=self.session_id,
+                                                   speculative=speculative, **kwargs)
+        else:
+            response = engine.generate(method, prompt, session_id=self.session_id, **kwargs)
+
+        with phase("clean"):
+            response = self.clean_response(response)
+        self.add_to_history(user_input, response)
+        self.record_stats(method, stop, kwargs, time.perf_counter() - start)
+        if best_of:
+            self.record_best_of(best, candidates)
+        if key is not None:
+            engine.response_cache.put(key, response, response_cache_samples(method))
+        return response
+
+    def stream_response(self, user_input, method=None, speculative=False, model=None, best_of=None, scorer=None,
+                        **kwargs):
+        """
+        Generate a response piece by piece: yields text deltas as tokens are decoded.
+        Stops as soon as the model starts writing the next turn ("\nUser:" / "\nKyleBot:").
+        Beam search and best-of-N only know their reply at the end, so they yield it at once,
+        as does a cached reply.
+        """
+        method = self.resolve_method(method)
+        engine = self.model_engine(model)
+        start = time.perf_counter()
+        key, cached = self.cache_lookup(user_input, method, kwargs, engine) if not best_of else (None, None)
+        if cached is not None:
+            yield cached
+            self.add_to_history(user_input, cached)
+            self.record_cache_hit(method, time.perf_counter() - start)
+            return
+        with phase("prompt"):
+            prompt = self.create_context_prompt(user_input, kwargs.get("max_new_tokens", 50), engine)
+        if best_of:
+            best, stop, candidates = self.best_of_n(engine, prompt, method, best_of, scorer, kwargs)
+        else:
+            stop = self.add_early_stopping(kwargs, engine=engine)
+
+        tokenizer = engine.tokenizer
+        if best_of:
+            deltas = iter([best["text"]])
+        elif speculative:
+            self.add_speculation(kwargs)
+            deltas = stream_generate(engine.generate_speculative, prompt, tokenizer, method=method,
+                                     session_id=self.session_id, speculative=speculative, **kwargs)
+        elif not STRATEGIES[method].streams:
+            deltas = iter([engine.generate(method, prompt, session_id=self.session_id, **kwargs)])
+        else:
+            deltas = stream_generate(functools.partial(engine.generate, method), prompt, tokenizer,
+                                     session_id=self.session_id, **kwargs)
+
+        stops = StopStringFilter(self.turn_markers)
+        text = ""
+        try:
+            for delta in itertools.chain(deltas, [None]):  # None: generation ended, flush held text
+                piece = stops.feed(delta) if delta is not None else stops.flush()
+                if not text:
+                    piece = piece.lstrip()  # same as clean_response's strip()
+                if piece:
+                    text += piece
+                    yield piece
+                if stops.stopped:
+                    break
+        finally:
+            if hasattr(deltas, "close"):
+                deltas.close()  # stops generation if we broke out early
+
+        with phase("clean"):
+            text = self.clean_response(text)
+        self.add_to_history(user_input, text)
+        self.record_stats(method, stop, kwargs, time.perf_counter() - start)
+        if best_of:
+            self.record_best_of(best, candidates)
+        if key is not None:
+            engine.response_cache.put(key, text, response_cache_samples(method))
+
+    def sweep(self, user_input, grid, max_new_tokens=50, model=None, seed=0):
+        """
+        Answer `user_input` once per config of a parameter grid, e.g. {"temperature": [0.5, 1.0],
+        "top_k": [10, 50]}, in one batched decode (see sweep.py). Nothing is added to the history;
+        returns one row per config with its cleaned response and latency.
+        """
+        engine = self.model_engine(model)
+        prompt = self.create_context_prompt(user_input, max_new_tokens, engine)
+        stop = lambda: TurnBoundaryStop(engine.tokenizer, self.turn_markers, max_chars=500)
+        results = sweep(engine.model, engine.tokenizer, [prompt], grid, max_new_tokens, stopping=stop, seed=seed)
+        for result in results:
+            result["response"] = self.clean_response(result["response"])
+        return results
+
+    def resolve_method(self, method):
+        """The strategy to use: `method`, else this bot's generation method; unknown names sample"""
+        method = method or self.generation_method
+        return method if method in STRATEGIES else "sampling"
+
+    def cache_lookup(self, user_input, method, kwargs, engine=None):
+        """(key, cached reply or None); the key is None when replies of `method` are not cached"""
+        samples = response_cache_samples(method)
+        if not samples:
+            return None, None
+        engine = engine or self.engine
+        engine.wait()
+        prompt = engine.context_window.build(self.history_for(engine), normalize_question(user_input),
+                                             self.name, kwargs.get("max_new_tokens", 50), self.system_prompt)
+        key = cache_key(prompt.ids, method, kwargs, model_id=engine.model_name)
+        return key, engine.response_cache.get(key, samples)
+
+    def add_early_stopping(self, kwargs, max_chars=500, engine=None):
+        """Stop decoding at the turn boundary instead of trimming max_new_tokens of text afterwards"""
+        engine = engine or self.engine
+        engine.wait()
+        engine.prefix_cache.warm(engine.model, engine.tokenizer, self.name,
+                                 SYSTEM_PROMPT.format(name=self.name))  # no-op if cached
+        stop = TurnBoundaryStop(engine.tokenizer, self.turn_markers, max_chars=max_chars)
+        kwargs["stopping_criteria"] = StoppingCriteriaList([stop, *kwargs.get("stopping_criteria", [])])
+        return stop
+
+    def best_of_n(self, engine, prompt, method, n, scorer, kwargs):
+        """
+        Sample n replies in one batch (one prefill; each stops at its own turn boundary) and keep
+        the best: scorer is a name in SCORERS (default "logprob") or a function of a candidate
+        ({"text" (cleaned), "ids", "logprob"}) -> score.
+        Returns (best candidate, its stop criterion, all candidates), each with its "score".
+        """
+        if method != "sampling":
+            raise ValueError("best-of-N works with sampling only")
+        if not callable(scorer):
+            if (scorer or "logprob") not in SCORERS:
+                raise ValueError(f"unknown scorer {scorer!r} (choose from {', '.join(SCORERS)}, or pass a function)")
+            scorer = SCORERS[scorer or "logprob"]
+        engine.wait()
+        engine.prefix_cache.warm(engine.model, engine.tokenizer, self.name,
+                                 SYSTEM_PROMPT.format(name=self.name))  # no-op if cached
+        stops = [TurnBoundaryStop(engine.tokenizer, self.turn_markers, max_chars=500) for _ in range(n)]
+        candidates = engine.generate_best_of(prompt, n, session_id=self.session_id, stops=stops, **kwargs)
+        for candidate in candidates:
+            candidate["text"] = self.clean_response(candidate["text"])
+            candidate["score"] = float(scorer(candidate))
+        best = max(range(n), key=lambda i: candidates[i]["score"])
+        return candidates[best], stops[best], candidates
+
+    def add_speculation(self, kwargs):
+        """Count the guessed tokens the model accepts for this request"""
+        kwargs["speculative_stats"] = SpeculativeStats()
+
+    def record_cache_hit(self, method, seconds):
+        """Stats and metrics for a reply served from the response cache"""
+        self.last_stats = {"tokens_generated": 0, "tokens_saved": 0, "tokens_discarded": 0, "cached": True}
+        REQUESTS.inc(method=method)
+        REQUEST_SECONDS.observe(seconds, method=method)
+
+    def record_best_of(self, best, candidates):
+        """Add the winner's score, every candidate's and the tokens they took (call after record_stats)"""
+        self.last_stats["best_of"] = len(candidates)
+        self.last_stats["score"] = best["score"]
+        self.last_stats["scores"] = [candidate["score"] for candidate in candidates]
+        self.last_stats["tokens_sampled"] = sum(len(candidate["ids"]) for candidate in candidates)
+
+    def record_stats(self, method, stop, kwargs, seconds):
+        """
+        Remember how many tokens the last response took, how many clean_response cut off and how
+        many early stopping saved (call after add_to_history), and add them to the metrics
+        """
+        max_new_tokens = kwargs.get("max_new_tokens", 50)
+        kept = len(self.conversation_history[-1].bot_ids)
+        self.last_stats = {
+            "tokens_generated": stop.tokens_generated,
+            "tokens_saved": stop.tokens_saved(max_new_tokens),
+            "tokens_discarded": max(stop.tokens_generated - kept, 0),
+        }
+        speculation = kwargs.get("speculative_stats")
+        if speculation is not None:
+            self.last_stats["draft_acceptance"] = speculation.acceptance_rate
+            self.last_stats["tokens_per_pass"] = speculation.tokens_per_pass
+        REQUESTS.inc(method=method)
+        REQUEST_SECONDS.observe(seconds, method=method)
+        for outcome in ("generated", "saved", "discarded"):
+            TOKENS.inc(self.last_stats[f"tokens_{outcome}"], outcome=outcome)
+
+    def clean_response(self, response, max_chars=500):
+        """Clean up the generated response"""
+        return clean_response(response, self.name, max_chars)
+
+    def set_generation_method(self, method):
+        """Change the generation method"""
+        valid_methods = list(STRATEGIES)
+        if method in valid_methods:
+            self.generation_method = method
+            return f"✅ Generation method set to: {method}"
+        else:
+            return f"❌ Invalid method. Choose from: {valid_methods}"
+
+    def clear_history(self):
+        """Clear conversation history"""
+        self.conversation_history.clear()
+        self.engine.drop_session(self.session_id)
+        registry = self.engine.registry or _registry
+        if registry is not None:
+            registry.drop_session(self.session_id)  # other models it asked
+        return "🗑️ Conversation history cleared!"
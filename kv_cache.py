@@ -0,0 +1,196 @@
+"""
+kv_cache.py
+KV-cache reuse between requests:
+- PrefixCache: fixed prompt prefixes (the persona's system line), computed once at load time
+- SessionKVCache: each session's last turn, so the next turn prefills only the new tokens
+"""
+
+import logging, threading
+from collections import OrderedDict
+
+import torch
+from transformers import StoppingCriteriaList
+
+from metrics import CACHE_LOOKUPS
+from model_utils import cache_from_tensors, cache_to_tensors
+from stopping import DecodeTimer
+
+log = logging.getLogger(__name__)
+
+
+def common_prefix_length(a, b):
+    """Number of leading token ids shared by sequences a and b."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+def crop_past(past, length):
+    """Keep the first `length` positions of per-layer (key, value) tensors (views, no copy)."""
+    return [(k[:, :, :length], v[:, :, :length]) for k, v in past]
+
+def past_nbytes(past):
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past)
+
+
+class PrefixCache:
+    """
+    KV states for fixed prompt prefixes, e.g. one system line per persona, keyed by name.
+
+    Entries are shared by reference, never copied: DynamicCache.update concatenates into new
+    tensors, so requests that continue from an entry cannot modify it.
+    """
+
+    def __init__(self):
+        self._entries = {}   # key -> (token_ids tuple, past, text)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to worker processes (worker_pool.py): the entries, not the lock
+        with self._lock:
+            return {"_entries": dict(self._entries)}
+
+    def __setstate__(self, state):
+        self._entries = state["_entries"]
+        self._lock = threading.Lock()
+
+    def warm(self, model, tokenizer, key, text):
+        """Compute and store the KV state for `text` under `key` (no-op if already cached)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] == text:
+                return
+        ids = tokenizer.encode(text)
+        device = next(model.parameters()).device
+        with torch.no_grad():
+            out = model(torch.tensor([ids], device=device), use_cache=True)
+        with self._lock:
+            self._entries[key] = (tuple(ids), cache_to_tensors(out.past_key_values), text)
+        log.info(f"Prefix cache: {key!r} warmed ({len(ids)} tokens)")
+
+    def lookup(self, input_ids):
+        """Longest cached prefix that `input_ids` starts with -> (past, n_tokens), or (None, 0)."""
+        with self._lock:
+            entries = list(self._entries.values())
+        best = (None, 0)
+        for ids, past, _ in entries:
+            n = len(ids)
+            if best[1] < n < len(input_ids) and tuple(input_ids[:n]) == ids:
+                best = (past, n)
+        return best
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class SessionKVCache:
+    """
+    LRU store of one KV state per session, bounded by a memory budget.
+
+    Each entry remembers the token ids its keys/values cover. A lookup returns the entry cropped
+    to the longest common prefix with the new prompt. Because every KyleBot prompt starts with
+    the same system line, a turn whose history window slid (oldest exchange dropped) still reuses
+    at least the system-prompt prefix. With a PrefixCache attached, sessions without an entry
+    (first turn, evicted) start from the shared prefix instead of a full prefill.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2, prefix_cache=None):
+        self.max_bytes = max_bytes
+        self.prefix_cache = prefix_cache
+        self._entries = OrderedDict()   # session_id -> (token_ids tuple, past, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def lookup(self, session_id, input_ids):
+        """
+        Returns (past, n_cached): reusable per-layer (key, value) tensors and how many leading ids
+        of `input_ids` they cover. At least one token is always left for the model to prefill.
+        """
+        past, n, source = None, 0, "miss"
+        with self._lock:
+            entry = self._entries.get(session_id) if session_id is not None else None
+            if entry is not None:
+                self._entries.move_to_end(session_id)
+        if entry is not None:
+            cached_ids, cached_past, _ = entry
+            n = min(common_prefix_length(cached_ids, input_ids), len(input_ids) - 1)
+            if n > 0:
+                past, source = crop_past(cached_past, n), "session"
+        if self.prefix_cache is not None:
+            prefix_past, prefix_n = self.prefix_cache.lookup(input_ids)
+            if prefix_n > n:
+                past, n, source = prefix_past, prefix_n, "prefix"
+        CACHE_LOOKUPS.inc(cache="kv", result=source)
+        if past is None:
+            self.misses += 1
+            return None, 0
+        self.hits += 1
+        return past, n
+
+    def store(self, session_id, token_ids, past):
+        """Remember `past` (covering `token_ids`) for the session, evicting LRU sessions over budget."""
+        if session_id is None or past is None:
+            return
+        token_ids = tuple(token_ids)
+        past = crop_past(past, len(token_ids))
+        # Own the memory: a view into a larger (e.g. batched) tensor would pin all of it
+        past = [(k.contiguous().clone(), v.contiguous().clone()) for k, v in past]
+        nbytes = past_nbytes(past)
+        if nbytes > self.max_bytes:
+            self.drop(session_id)
+            return
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[session_id] = (token_ids, past, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                evicted, (_, _, size) = self._entries.popitem(last=False)
+                self._bytes -= size
+                log.debug(f"KV cache evicted session {evicted} ({size / 1e6:.1f} MB)")
+
+    def drop(self, session_id):
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self._bytes -= old[2]
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def generate_with_session_cache(model, inputs, kv_cache, session_id, **gen_kwargs):
+    """
+    model.generate() for a single prompt that reuses (and afterwards refreshes) the session's KV
+    state. `inputs` is a [1, seq] tensor of prompt ids; returns the full output sequences tensor.
+    Beam search expands the batch inside generate(), so it bypasses the cache. A model loaded
+    with load_model(compile=True) decodes through its static_decoder when it can.
+    """
+    # Times prefill and decoding steps into metrics (it never stops generation)
+    gen_kwargs["stopping_criteria"] = StoppingCriteriaList([*(gen_kwargs.get("stopping_criteria") or []),
+                                                            DecodeTimer()])
+    decoder = getattr(model, "static_decoder", None)
+    if decoder is not None and decoder.supports(inputs.shape[1], gen_kwargs):
+        return decoder.generate(inputs, kv_cache=kv_cache, session_id=session_id, **gen_kwargs)
+    if kv_cache is None or gen_kwargs.get("num_beams", 1) > 1:
+        return model.generate(inputs, **gen_kwargs)
+    prompt_ids = inputs[0].tolist()
+    past, n_cached = kv_cache.lookup(session_id, prompt_ids)
+    if past is not None:
+        gen_kwargs["past_key_values"] = cache_from_tensors(past)
+    outputs = model.generate(inputs, return_dict_in_generate=True, use_cache=True, **gen_kwargs)
+    sequences = outputs.sequences
+    new_past = cache_to_tensors(outputs.past_key_values)
+    if new_past is not None and session_id is not None:
+        covered = new_past[0][0].shape[2]
+        kv_cache.store(session_id, sequences[0, :covered].tolist(), new_past)
+    log.debug(f"session {session_id}: reused {n_cached}/{len(prompt_ids)} prompt tokens")
+    return sequences
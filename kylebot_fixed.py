@@ -1,155 +1,44 @@
 # KyleBot: A GPT-2 Chatbot for Learning
 # Fixed version that resolves parameter passing issues
 
-import torch
-from transformers import GPT2Tokenizer, GPT2LMHeadModel
-import random
-import re
+import os
+from metrics import serve_from_env
+from client import RemoteKyleBot
 
-# Load the pre-trained GPT-2 model and tokenizer
-print("Loading GPT-2 model and tokenizer...")
-tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-model = GPT2LMHeadModel.from_pretrained("gpt2")
+# Set KYLEBOT_SERVER_URL (e.g. http://localhost:8000) to use a running server.py
+# instead of loading GPT-2 in this process
+SERVER_URL = os.environ.get("KYLEBOT_SERVER_URL")
 
-# Set the model to evaluation mode (no training)
-model.eval()
+if not SERVER_URL:
+    # The model, its caches and the decoding strategies live in engine.py (shared with the
+    # Gradio app). GPT-2 loads in the background, so the chat is usable straight away; the
+    # first reply waits for it
+    from engine import KyleBot, get_engine
+    engine = get_engine()
+    serve_from_env()  # /metrics on $KYLEBOT_METRICS_PORT, if set
 
-# Add a special token for the end of text
-tokenizer.pad_token = tokenizer.eos_token
-
-print("✅ GPT-2 loaded successfully!")
-print(f"Model parameters: {model.num_parameters():,}")
-
-def generate_response_greedy(prompt, max_new_tokens=50, **kwargs):
-    """Greedy decoding: Always picks the most likely next word"""
-    inputs = tokenizer.encode(prompt, return_tensors="pt")
-    with torch.no_grad():
-        outputs = model.generate(
-            inputs,
-            max_new_tokens=max_new_tokens,
-            num_return_sequences=1,
-            do_sample=False,
-            pad_token_id=tokenizer.eos_token_id,
-            **kwargs
-        )
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    return response[len(prompt):]
-
-def generate_response_sampling(prompt, max_new_tokens=50, temperature=0.8, top_k=50, **kwargs):
-    """
-    Sampling with temperature and top-k: More creative and diverse responses
-    - temperature: Controls randomness (higher = more random)
-    - top_k: Only considers the top k most likely words
-    """
-    inputs = tokenizer.encode(prompt, return_tensors="pt")
-    with torch.no_grad():
-        outputs = model.generate(
-            inputs,
-            max_new_tokens=max_new_tokens,
-            num_return_sequences=1,
-            do_sample=True,
-            temperature=temperature,
-            top_k=top_k,
-            pad_token_id=tokenizer.eos_token_id,
-            **kwargs
-        )
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    return response[len(prompt):]
-
-def generate_response_beam_search(prompt, max_new_tokens=50, num_beams=5, **kwargs):
-    """Beam search: Explores multiple possible sequences"""
-    inputs = tokenizer.encode(prompt, return_tensors="pt")
-    
-    # Set default values for beam search
-    beam_kwargs = {
-        'no_repeat_ngram_size': 2,
-        'repetition_penalty': 1.2
-    }
-    # Update with any provided kwargs
-    beam_kwargs.update(kwargs)
-    
-    with torch.no_grad():
-        outputs = model.generate(
-            inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=False,
-            num_beams=num_beams,
-            pad_token_id=tokenizer.eos_token_id,
-            **beam_kwargs
-        )
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    return response[len(prompt):]
-
-class KyleBot:
-    def __init__(self, name="KyleBot"):
-        self.name = name
-        self.conversation_history = []
-        self.generation_method = "sampling"  # Default method
-        
-    def add_to_history(self, user_input, bot_response):
-        """Keep track of conversation for context"""
-        self.conversation_history.append({
-            "user": user_input,
-            "bot": bot_response
-        })
-        
-    def create_context_prompt(self, user_input):
-        """Create a prompt with conversation history for context"""
-        prompt = f"You are {self.name}, a knowledgeable AI. Provide a clear and concise definition of the user's topic.\n"
-        if len(self.conversation_history) > 0:
-            recent_history = self.conversation_history[-2:]
-            context = "\n".join([
-                f"User: {exchange['user']}\n{self.name}: {exchange['bot']}"
-                for exchange in recent_history
-            ])
-            prompt += context + "\n"
-        prompt += f"User: {user_input}\n{self.name}: "
-        return prompt
-    
-    def generate_response(self, user_input, method=None, **kwargs):
-        """Generate a response using the specified method"""
-        method = method or self.generation_method
-        prompt = self.create_context_prompt(user_input)
-        
-        if method == "greedy":
-            response = generate_response_greedy(prompt, **kwargs)
-        elif method == "sampling":
-            response = generate_response_sampling(prompt, **kwargs)
-        elif method == "beam":
-            response = generate_response_beam_search(prompt, **kwargs)
-        else:
-            response = generate_response_sampling(prompt, **kwargs)
-    
-        response = self.clean_response(response)
-        self.add_to_history(user_input, response)
-        return response
-    
-    def clean_response(self, response, max_chars=500):
-        """Clean up the generated response"""
-        response = response.strip()
-        response = re.sub(rf"^{self.name}:\s*|^User:\s*|\n{self.name}:.*", "", response)
-        if len(response) > max_chars:
-            for char in ['.', '!', '?']:
-                if char in response[:max_chars]:
-                    response = response[:response.index(char) + 1]
-                    break
-        return response
-    
-    def set_generation_method(self, method):
-        """Change the generation method"""
-        valid_methods = ["greedy", "sampling", "beam"]
-        if method in valid_methods:
-            self.generation_method = method
-            print(f"✅ Generation method set to: {method}")
-        else:
-            print(f"❌ Invalid method. Choose from: {valid_methods}")
-
-# Create our chatbot instance
-kylebot = KyleBot()
+# Create our chatbot instance. With KYLEBOT_HISTORY_DB set, KYLEBOT_SESSION_ID=<name> continues
+# that conversation where the last run left it
+kylebot = RemoteKyleBot(SERVER_URL) if SERVER_URL else KyleBot(session_id=os.environ.get("KYLEBOT_SESSION_ID"))
 print("✅ KyleBot created and ready to chat!")
 
+def print_generation_stats():
+    """Show how much decoding early stopping saved on the last response"""
+    stats = kylebot.last_stats
+    if stats.get("cached"):
+        print("Tokens: none, served from the response cache")
+        return
+    print(f"Tokens: {stats['tokens_generated']} generated, {stats['tokens_discarded']} cut by clean_response, "
+          f"{stats['tokens_saved']} saved by early stopping")
+    if "draft_acceptance" in stats:
+        print(f"Speculative: {stats['draft_acceptance']:.0%} of guessed tokens accepted, "
+              f"{stats['tokens_per_pass']:.2f} tokens per GPT-2 pass")
+    if "best_of" in stats:
+        print(f"Best of {stats['best_of']}: score {stats['score']:.2f} "
+              f"(all: {', '.join(f'{score:.2f}' for score in stats['scores'])}), {stats['tokens_sampled']} tokens sampled")
+
 def test_generation_methods():
-    """Test all three generation methods"""
+    """Test the three generation methods, and sampling with speculative decoding and best-of-N"""
     test_prompt = "What is artificial intelligence?"
     
     print("🤖 Testing different generation methods:")
@@ -159,29 +48,60 @@ def test_generation_methods():
     print("\n1. GREEDY DECODING (always picks most likely word):")
     response = kylebot.generate_response(test_prompt, method="greedy", max_new_tokens=100, no_repeat_ngram_size=2, repetition_penalty=1.2)
     print(f"Response: {response}")
+    print_generation_stats()
     
     # Test sampling
     print("\n2. SAMPLING (more creative, uses temperature and top-k):")
     response = kylebot.generate_response(test_prompt, method="sampling", max_new_tokens=100, temperature=0.7, top_k=30)
     print(f"Response: {response}")
+    print_generation_stats()
     
     # Test beam search
     print("\n3. BEAM SEARCH (explores multiple possibilities):")
     response = kylebot.generate_response(test_prompt, method="beam", max_new_tokens=100, num_beams=5, no_repeat_ngram_size=2, repetition_penalty=1.2)
     print(f"Response: {response}")
+    print_generation_stats()
+    
+    # Test speculative decoding
+    print("\n4. SPECULATIVE SAMPLING (a draft model guesses, GPT-2 verifies):")
+    response = kylebot.generate_response(test_prompt, method="sampling", speculative=True, max_new_tokens=100, temperature=0.7, top_k=30)
+    print(f"Response: {response}")
+    print_generation_stats()
+    
+    # Test best-of-N sampling
+    print("\n5. BEST-OF-4 SAMPLING (4 replies in one batch, the most likely one kept):")
+    response = kylebot.generate_response(test_prompt, method="sampling", best_of=4, max_new_tokens=100, temperature=0.7, top_k=30)
+    print(f"Response: {response}")
+    print_generation_stats()
     
     print("\n" + "=" * 50)
     print("💡 Notice how each method produces different styles of responses!")
 
+def experiment_with_parameters():
+    """Show how temperature and top-k change a reply: every setting in one batched decode"""
+    if SERVER_URL:
+        print("🧪 Parameter sweeps run on a local model (unset KYLEBOT_SERVER_URL)")
+        return
+    from sweep import format_table
+    test_prompt = "The future of technology is"
+    
+    print("🧪 Parameter Experimentation")
+    print("=" * 50)
+    grid = [{"method": "greedy"}, *({"temperature": t, "top_k": k} for t in (0.1, 0.5, 1.0, 1.5) for k in (10, 50))]
+    results = kylebot.sweep(test_prompt, grid, max_new_tokens=50)
+    print(format_table(results, width=60))
+    print("\n💡 Lower temperature / top-k = more focused replies; higher = more creative ones")
+
 def chat_with_kylebot():
     """Interactive chat interface"""
     print("🤖 Welcome to KyleBot! Let's chat!")
     print("💡 Commands:")
     print("   - Type 'quit' to exit")
-    print("   - Type 'method: [greedy/sampling/beam]' to change generation method")
+    print("   - Type 'method: [greedy/sampling/beam/top_p/typical/contrastive]' to change generation method")
     print("   - Type 'history' to see conversation history")
     print("   - Type 'help' for this message")
     print("   - Type 'test' to run generation method tests")
+    print("   - Type 'sweep' to compare temperature / top-k settings")
     print("=" * 50)
     
     while True:
@@ -196,14 +116,18 @@ def chat_with_kylebot():
             elif user_input.lower() == 'help':
                 print("💡 Commands:")
                 print("   - Type 'quit' to exit")
-                print("   - Type 'method: [greedy/sampling/beam]' to change generation method")
+                print("   - Type 'method: [greedy/sampling/beam/top_p/typical/contrastive]' to change generation method")
                 print("   - Type 'history' to see conversation history")
                 print("   - Type 'help' for this message")
                 print("   - Type 'test' to run generation method tests")
+                print("   - Type 'sweep' to compare temperature / top-k settings")
                 continue
             elif user_input.lower() == 'test':
                 test_generation_methods()
                 continue
+            elif user_input.lower() == 'sweep':
+                experiment_with_parameters()
+                continue
             elif user_input.lower() == 'history':
                 if kylebot.conversation_history:
                     print("\n📜 Conversation History:")
@@ -215,15 +139,18 @@ def chat_with_kylebot():
                 continue
             elif user_input.lower().startswith('method:'):
                 method = user_input.split(':')[1].strip()
-                kylebot.set_generation_method(method)
+                message = kylebot.set_generation_method(method)
+                if message:
+                    print(message)
                 continue
             elif not user_input:
                 continue
             
             # Generate and display response
-            print(f"\n🤖 KyleBot ({kylebot.generation_method}): ", end="")
-            response = kylebot.generate_response(user_input)
-            print(response)
+            print(f"\n🤖 KyleBot ({kylebot.generation_method}): ", end="", flush=True)
+            for delta in kylebot.stream_response(user_input):
+                print(delta, end="", flush=True)
+            print()
             
         except KeyboardInterrupt:
             print("\n👋 Goodbye! Thanks for chatting with KyleBot!")
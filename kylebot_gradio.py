@@ -1,189 +1,95 @@
 # KyleBot: A GPT-2 Chatbot with Gradio Web Interface
 # Beautiful, modern web interface for your AI chatbot
 
-import torch
-from transformers import GPT2Tokenizer, GPT2LMHeadModel
-import random
-import re
-import gradio as gr
-import time
+import os
+from metrics import serve_from_env
+from client import METHODS as SERVER_METHODS, RemoteKyleBot
+from sessions import SessionManager
 
-# Load the pre-trained GPT-2 model and tokenizer
-print("Loading GPT-2 model and tokenizer...")
-tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-model = GPT2LMHeadModel.from_pretrained("gpt2")
+# Set KYLEBOT_SERVER_URL (e.g. http://localhost:8000) to use a running server.py
+# instead of loading GPT-2 in this process
+SERVER_URL = os.environ.get("KYLEBOT_SERVER_URL")
 
-# Set the model to evaluation mode (no training)
-model.eval()
+if not SERVER_URL:
+    # The model, its caches, batchers and decoding strategies live in engine.py (shared with the
+    # CLI). GPT-2 loads in the background while gradio imports and the interface is built
+    from engine import MODEL, STRATEGIES, KyleBot, get_engine, get_registry
+    engine = get_engine()
+    registry = get_registry()
+    serve_from_env()  # /metrics on $KYLEBOT_METRICS_PORT, if set
 
-# Add a special token for the end of text
-tokenizer.pad_token = tokenizer.eos_token
+# Imported after the model load has started: the two overlap
+import gradio as gr
 
-print("✅ GPT-2 loaded successfully!")
-print(f"Model parameters: {model.num_parameters():,}")
+def drop_kv_cache(bot):
+    """Forget a session's cached keys/values (in every model it used)"""
+    registry.drop_session(bot.session_id)
 
-def generate_response_greedy(prompt, max_new_tokens=50, **kwargs):
-    """Greedy decoding: Always picks the most likely next word"""
-    inputs = tokenizer.encode(prompt, return_tensors="pt")
-    with torch.no_grad():
-        outputs = model.generate(
-            inputs,
-            max_new_tokens=max_new_tokens,
-            num_return_sequences=1,
-            do_sample=False,
-            pad_token_id=tokenizer.eos_token_id,
-            **kwargs
-        )
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    return response[len(prompt):]
+def create_bot(session_id):
+    """A separate chatbot (history + generation method) for each browser session"""
+    if SERVER_URL:
+        return RemoteKyleBot(SERVER_URL, session_id=session_id)
+    return KyleBot(session_id=session_id)
 
-def generate_response_sampling(prompt, max_new_tokens=50, temperature=0.8, top_k=50, **kwargs):
-    """
-    Sampling with temperature and top-k: More creative and diverse responses
-    - temperature: Controls randomness (higher = more random)
-    - top_k: Only considers the top k most likely words
-    """
-    inputs = tokenizer.encode(prompt, return_tensors="pt")
-    with torch.no_grad():
-        outputs = model.generate(
-            inputs,
-            max_new_tokens=max_new_tokens,
-            num_return_sequences=1,
-            do_sample=True,
-            temperature=temperature,
-            top_k=top_k,
-            pad_token_id=tokenizer.eos_token_id,
-            **kwargs
-        )
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    return response[len(prompt):]
+# Decoding strategies offered in the settings panel
+if SERVER_URL:
+    METHODS = SERVER_METHODS
+else:
+    METHODS = ["sampling", "greedy", "beam"]
+    METHODS += [name for name in STRATEGIES if name not in METHODS]
 
-def generate_response_beam_search(prompt, max_new_tokens=50, num_beams=5, **kwargs):
-    """Beam search: Explores multiple possible sequences"""
-    inputs = tokenizer.encode(prompt, return_tensors="pt")
-    
-    # Set default values for beam search
-    beam_kwargs = {
-        'no_repeat_ngram_size': 2,
-        'repetition_penalty': 1.2
-    }
-    # Update with any provided kwargs
-    beam_kwargs.update(kwargs)
-    
-    with torch.no_grad():
-        outputs = model.generate(
-            inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=False,
-            num_beams=num_beams,
-            pad_token_id=tokenizer.eos_token_id,
-            **beam_kwargs
-        )
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    return response[len(prompt):]
+# Models a reply can come from (engine.ModelRegistry: loaded on first use, KYLEBOT_MODELS)
+MODELS = [] if SERVER_URL else registry.models
 
-class KyleBot:
-    def __init__(self, name="KyleBot"):
-        self.name = name
-        self.conversation_history = []
-        self.generation_method = "sampling"  # Default method
-        
-    def add_to_history(self, user_input, bot_response):
-        """Keep track of conversation for context"""
-        self.conversation_history.append({
-            "user": user_input,
-            "bot": bot_response
-        })
-        
-    def create_context_prompt(self, user_input):
-        """Create a prompt with conversation history for context"""
-        prompt = f"You are {self.name}, a knowledgeable AI. Provide a clear and concise definition of the user's topic.\n"
-        if len(self.conversation_history) > 0:
-            recent_history = self.conversation_history[-2:]
-            context = "\n".join([
-                f"User: {exchange['user']}\n{self.name}: {exchange['bot']}"
-                for exchange in recent_history
-            ])
-            prompt += context + "\n"
-        prompt += f"User: {user_input}\n{self.name}: "
-        return prompt
+# One chatbot per browser session, so users never see (or change) each other's conversation.
+# Idle sessions expire after an hour; their KV cache entry goes with them.
+sessions = SessionManager(
+    create_bot, ttl=3600, max_sessions=1000,
+    on_evict=None if SERVER_URL else drop_kv_cache
+)
+
+def chat_with_bot(message, history, method, temperature, top_k, max_tokens, model, request: gr.Request):
+    """Main chat function for Gradio interface (streams the reply as it is generated)"""
+    if not message.strip():
+        yield "", history
+        return
     
-    def generate_response(self, user_input, method=None, **kwargs):
-        """Generate a response using the specified method"""
-        method = method or self.generation_method
-        prompt = self.create_context_prompt(user_input)
+    with sessions.session(request.session_hash) as kylebot:
+        # Update this session's generation method
+        kylebot.set_generation_method(method)
         
+        # Pick generation parameters based on method
         if method == "greedy":
-            response = generate_response_greedy(prompt, **kwargs)
-        elif method == "sampling":
-            response = generate_response_sampling(prompt, **kwargs)
+            params = dict(max_new_tokens=max_tokens)
         elif method == "beam":
-            response = generate_response_beam_search(prompt, **kwargs)
-        else:
-            response = generate_response_sampling(prompt, **kwargs)
-    
-        response = self.clean_response(response)
-        self.add_to_history(user_input, response)
-        return response
-    
-    def clean_response(self, response, max_chars=500):
-        """Clean up the generated response"""
-        response = response.strip()
-        response = re.sub(rf"^{self.name}:\s*|^User:\s*|\n{self.name}:.*", "", response)
-        if len(response) > max_chars:
-            for char in ['.', '!', '?']:
-                if char in response[:max_chars]:
-                    response = response[:response.index(char) + 1]
-                    break
-        return response
-    
-    def set_generation_method(self, method):
-        """Change the generation method"""
-        valid_methods = ["greedy", "sampling", "beam"]
-        if method in valid_methods:
-            self.generation_method = method
-            return f"✅ Generation method set to: {method}"
+            params = dict(num_beams=5, max_new_tokens=max_tokens)
+        elif method in ("top_p", "typical"):
+            # These cut the word list by probability mass instead of top-k
+            params = dict(temperature=temperature, max_new_tokens=max_tokens)
+        elif method == "contrastive":
+            params = dict(max_new_tokens=max_tokens)
         else:
-            return f"❌ Invalid method. Choose from: {valid_methods}"
-    
-    def clear_history(self):
-        """Clear conversation history"""
-        self.conversation_history = []
-        return "🗑️ Conversation history cleared!"
-
-# Create our chatbot instance
-kylebot = KyleBot()
-
-def chat_with_bot(message, history, method, temperature, top_k, max_tokens):
-    """Main chat function for Gradio interface"""
-    if not message.strip():
-        return "", history
-    
-    # Update bot's generation method
-    kylebot.set_generation_method(method)
-    
-    # Generate response based on method
-    if method == "greedy":
-        response = kylebot.generate_response(message, method="greedy", max_new_tokens=max_tokens)
-    elif method == "sampling":
-        response = kylebot.generate_response(message, method="sampling", 
-                                           temperature=temperature, top_k=top_k, 
-                                           max_new_tokens=max_tokens)
-    elif method == "beam":
-        response = kylebot.generate_response(message, method="beam", 
-                                           num_beams=5, max_new_tokens=max_tokens)
-    else:
-        response = kylebot.generate_response(message, method="sampling", 
-                                           temperature=temperature, top_k=top_k, 
-                                           max_new_tokens=max_tokens)
-    
-    # Add to history
-    history.append((message, response))
-    return "", history
+            method = "sampling"
+            params = dict(temperature=temperature, top_k=top_k, max_new_tokens=max_tokens)
+        if MODELS:
+            params["model"] = model
+        
+        # Show the reply growing in the chat window
+        history.append((message, ""))
+        response = ""
+        for delta in kylebot.stream_response(message, method=method, **params):
+            response += delta
+            history[-1] = (message, response)
+            yield "", history
+        
+        # Finish with the cleaned-up text (what is stored in the conversation history)
+        history[-1] = (message, kylebot.conversation_history[-1].bot)
+        yield "", history
 
-def clear_chat():
+def clear_chat(request: gr.Request):
     """Clear the chat interface"""
-    kylebot.clear_history()
+    with sessions.session(request.session_hash) as kylebot:
+        kylebot.clear_history()
     return []
 
 def get_method_info(method):
@@ -191,10 +97,33 @@ def get_method_info(method):
     info = {
         "greedy": "🤖 **Greedy Decoding**: Always picks the most likely next word. Fast and predictable, good for factual responses.",
         "sampling": "🎲 **Sampling**: Uses temperature and top-k for creative, diverse responses. More random and creative.",
-        "beam": "🔍 **Beam Search**: Explores multiple possible sequences. Balanced quality and coherence."
+        "beam": "🔍 **Beam Search**: Explores multiple possible sequences. Balanced quality and coherence.",
+        "top_p": "🎯 **Top-p (Nucleus) Sampling**: Samples from the smallest set of words covering 90% of the probability. Creative, but adapts to how sure the model is.",
+        "typical": "📐 **Typical Sampling**: Samples the words that are about as surprising as expected, skipping both bland and odd ones. Natural-sounding variety.",
+        "contrastive": "🧭 **Contrastive Search**: Picks likely words that are least similar to what was already said. Coherent like greedy, without the loops."
     }
     return info.get(method, "Select a generation method to see its description.")
 
+def get_model_info(wait=True):
+    """Model details for the info panel (wait=False: don't block on the background load)"""
+    if SERVER_URL:
+        return f"""
+            - **Model**: GPT-2 (served)
+            - **Server**: {SERVER_URL}
+            - **Status**: ✅ Ready
+            """
+    if not wait and not engine.ready():
+        return """
+            - **Model**: GPT-2
+            - **Status**: ⏳ Loading...
+            """
+    engine.wait()
+    return f"""
+            - **Model**: GPT-2
+            - **Parameters**: {engine.model.num_parameters():,}
+            - **Status**: ✅ Ready
+            """
+
 # Create the Gradio interface
 with gr.Blocks(
     title="KyleBot - AI Chatbot",
@@ -235,6 +164,7 @@ with gr.Blocks(
     - **Greedy**: Fast, predictable responses
     - **Sampling**: Creative, diverse responses  
     - **Beam Search**: Balanced quality and coherence
+    - **Top-p / Typical / Contrastive**: More ways to pick words (when GPT-2 runs in this app)
     """)
     
     with gr.Row():
@@ -265,7 +195,7 @@ with gr.Blocks(
             gr.Markdown("### ⚙️ Settings")
             
             method = gr.Dropdown(
-                choices=["sampling", "greedy", "beam"],
+                choices=METHODS,
                 value="sampling",
                 label="Generation Method",
                 info="Choose how KyleBot generates responses"
@@ -273,6 +203,14 @@ with gr.Blocks(
             
             method_info = gr.Markdown(get_method_info("sampling"))
             
+            model = gr.Dropdown(
+                choices=MODELS or ["gpt2"],
+                value=MODEL if MODELS else "gpt2",
+                label="Model",
+                info="Checkpoint that answers (loaded on first use)",
+                visible=bool(MODELS)
+            )
+            
             temperature = gr.Slider(
                 minimum=0.1,
                 maximum=2.0,
@@ -301,29 +239,28 @@ with gr.Blocks(
             )
             
             gr.Markdown("### 📊 Model Info")
-            gr.Markdown(f"""
-            - **Model**: GPT-2
-            - **Parameters**: {model.num_parameters():,}
-            - **Status**: ✅ Ready
-            """)
+            model_info = gr.Markdown(get_model_info(wait=False))
     
     # Event handlers
-    def handle_message(message, history, method_val, temp, top_k_val, max_tok):
-        return chat_with_bot(message, history, method_val, temp, top_k_val, max_tok)
+    def handle_message(message, history, method_val, temp, top_k_val, max_tok, model_val, request: gr.Request):
+        yield from chat_with_bot(message, history, method_val, temp, top_k_val, max_tok, model_val, request)
     
     def update_method_info(method_val):
         return get_method_info(method_val)
     
+    # Fill in the model details once GPT-2 has finished loading
+    demo.load(get_model_info, outputs=[model_info])
+    
     # Connect events
     send_btn.click(
         handle_message,
-        inputs=[msg, chatbot, method, temperature, top_k, max_tokens],
+        inputs=[msg, chatbot, method, temperature, top_k, max_tokens, model],
         outputs=[msg, chatbot]
     )
     
     msg.submit(
         handle_message,
-        inputs=[msg, chatbot, method, temperature, top_k, max_tokens],
+        inputs=[msg, chatbot, method, temperature, top_k, max_tokens, model],
         outputs=[msg, chatbot]
     )
     
@@ -350,6 +287,8 @@ if __name__ == "__main__":
     print("📱 Open your browser to the URL shown below")
     print("💡 You can also access it from other devices on your network")
     
+    # Let several browser sessions generate at once so the batcher can group them
+    demo.queue(default_concurrency_limit=32)
     demo.launch(
         server_name="0.0.0.0",  # Allow external connections
         server_port=7860,       # Default Gradio port
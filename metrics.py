@@ -0,0 +1,221 @@
+"""
+metrics.py
+Generation metrics in the Prometheus text format (standard library only, no client package).
+
+Every request is split into phases, each timed into kylebot_phase_seconds{phase=...}:
+    prompt -> tokenize -> prefill -> decode (per token) -> detokenize -> clean
+plus counters/gauges for requests, tokens (generated, discarded by clean_response, saved by
+early stopping), queue depth, batch size and cache lookups.
+
+- server.py serves them at GET /metrics
+- the CLI and the Gradio app serve them at http://localhost:$KYLEBOT_METRICS_PORT/metrics
+- KYLEBOT_PROFILE_RATE=0.01 writes a torch.profiler trace for 1% of requests to
+  $KYLEBOT_PROFILE_DIR (default ./traces); open them in chrome://tracing or Perfetto
+"""
+
+import bisect, logging, os, random, threading, time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+# Seconds: from a single decoding step up to a long beam search
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _format_labels(self, key, extra=""):
+        parts = [f'{name}="{value}"' for name, value in zip(self.labels, key)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return lines + self._samples()
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._format_labels(k)} {v}" for k, v in values]
+
+
+class Gauge(_Metric):
+    """Current value; either set explicitly or read from a function at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+        self._functions = {}
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, fn, **labels):
+        self._functions[self._key(labels)] = fn
+
+    def _samples(self):
+        values = dict(self._values)
+        for key, fn in self._functions.items():
+            try:
+                values[key] = fn()
+            except Exception:   # the owner went away
+                continue
+        return [f"{self.name}{self._format_labels(k)} {v}" for k, v in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}   # label key -> [count per bucket..., count above the last, sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * (len(self.buckets) + 3))
+            series[bisect.bisect_left(self.buckets, value)] += 1   # the bucket is cumulated on exposition
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        series = self._series.get(self._key(labels))
+        return series[-1] if series else 0
+
+    def _samples(self):
+        with self._lock:
+            all_series = sorted((key, list(series)) for key, series in self._series.items())
+        lines = []
+        for key, series in all_series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), series):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def exposition(self):
+        """All metrics in the Prometheus text format (version 0.0.4)"""
+        return "\n".join(line for metric in self._metrics for line in metric.expose()) + "\n"
+
+
+REGISTRY = Registry()
+
+PHASE_SECONDS = Histogram("kylebot_phase_seconds", "Time spent in each phase of a request "
+                          "(decode: per generated token)", labels=("phase",))
+REQUEST_SECONDS = Histogram("kylebot_request_seconds", "End-to-end generation time", labels=("method",))
+REQUESTS = Counter("kylebot_requests_total", "Generation requests", labels=("method",))
+TOKENS = Counter("kylebot_tokens_total", "Tokens by outcome: generated, discarded (cut by "
+                 "clean_response) or saved (not generated thanks to early stopping)", labels=("outcome",))
+QUEUE_DEPTH = Gauge("kylebot_queue_depth", "Requests waiting to start generating", labels=("queue",))
+BATCH_SIZE = Gauge("kylebot_batch_size", "Requests in the continuous batch")
+CACHE_LOOKUPS = Counter("kylebot_cache_lookups_total", "Cache lookups by cache and result",
+                        labels=("cache", "result"))
+SPECULATIVE_TOKENS = Counter("kylebot_speculative_tokens_total", "Draft-model tokens proposed / "
+                             "accepted by speculative decoding", labels=("result",))
+
+
+def phase(name):
+    """Time a block into kylebot_phase_seconds{phase=name}"""
+    return PHASE_SECONDS.time(phase=name)
+
+
+# ---- torch profiler for sampled requests --------------------------------
+PROFILE_RATE = float(os.environ.get("KYLEBOT_PROFILE_RATE", "0"))
+PROFILE_DIR = os.environ.get("KYLEBOT_PROFILE_DIR", "traces")
+
+def maybe_profile(label="request"):
+    """Profile the block with torch.profiler for a PROFILE_RATE fraction of calls (Chrome trace)."""
+    if PROFILE_RATE <= 0 or random.random() >= PROFILE_RATE:
+        return nullcontext()
+    return _profile(label)
+
+@contextmanager
+def _profile(label):
+    from torch.profiler import ProfilerActivity, profile
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with profile(activities=[ProfilerActivity.CPU], record_shapes=True) as prof:
+        yield
+    path = os.path.join(PROFILE_DIR, f"{label}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{random.randrange(1 << 16):04x}.json")
+    prof.export_chrome_trace(path)
+    log.info(f"Profiler trace written to {path}")
+
+
+# ---- standalone endpoint (CLI / Gradio) ----------------------------------
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port, host="127.0.0.1"):
+    """Serve /metrics on a daemon thread; returns the server (call .shutdown() to stop it)."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="kylebot-metrics", daemon=True).start()
+    log.info(f"Metrics on http://{host}:{port}/metrics")
+    return server
+
+def serve_from_env():
+    """serve() on $KYLEBOT_METRICS_PORT, if it is set"""
+    port = os.environ.get("KYLEBOT_METRICS_PORT")
+    return serve(int(port)) if port else None
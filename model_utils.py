@@ -1,24 +1,62 @@
 """
 model_utils.py
-Utility loader that supports any HF causal-LM and optional 4-bit quant (bitsandbytes).
+Utility loader that supports any HF causal-LM and optional 4-bit quant (bitsandbytes) on GPU,
+or dynamic int8 quantization / bf16 on CPU.
+
+    python model_utils.py --model gpt2 --int8     # footprint and tokens/sec vs fp32
 """
 
-import logging, torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+import argparse, hashlib, logging, os, shutil, tempfile, time, warnings, torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, DynamicCache
+from transformers import __version__ as transformers_version
+from transformers.pytorch_utils import Conv1D
+from transformers.utils import cached_file
+
+from startup import StartupTimer
 
 log = logging.getLogger(__name__)
 
-def load_model(model_name="gpt2", quant_4bit=False, device_map="auto"):
-    """Returns (tokenizer, model) ready for inference."""
-    log.info(f"Loading {model_name}  |  4-bit={quant_4bit}")
-    tok = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-    tok.pad_token = tok.eos_token
+# Quantized checkpoints and model snapshots are cached here (set KYLEBOT_CACHE_DIR to move it)
+CACHE_DIR = os.environ.get("KYLEBOT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "kylebot"))
+
+def load_model(model_name="gpt2", quant_4bit=False, device_map="auto", prefix_cache=None, prefixes=None,
+               int8=False, bf16=False, cache_dir=CACHE_DIR, snapshot=False, timer=None, compile=False):
+    """
+    Returns (tokenizer, model) ready for inference.
+    prefixes: optional {key: text} whose KV states are computed once into `prefix_cache`
+              (a kv_cache.PrefixCache), e.g. {"KyleBot": system_prompt}.
+    int8:     CPU only - dynamic int8 quantization of every linear/Conv1D layer; the quantized
+              model is cached under `cache_dir` (None disables the cache).
+    bf16:     CPU only - bfloat16 weights, if the CPU has native bf16 support.
+    snapshot: load through a local snapshot under `cache_dir` (see load_snapshot).
+    timer:    optional startup.StartupTimer recording how long each loading phase took.
+    compile:  GPT-2 only - decode from pre-allocated KV buffers with a torch.compile'd step
+              (static_decode.StaticDecoder, compiled here, stored as model.static_decoder);
+              generate_with_session_cache uses it for greedy decoding and sampling.
+    """
+    if prefixes and prefix_cache is None:
+        raise ValueError("prefixes need a prefix_cache (a kv_cache.PrefixCache) to be warmed into")
+    log.info(f"Loading {model_name}  |  4-bit={quant_4bit}  |  int8={int8}  |  bf16={bf16}")
+    timer = timer or StartupTimer()
     use_cuda = torch.cuda.is_available()
 
     if quant_4bit and not use_cuda:
         log.warning("--quant ignored (no CUDA)"); quant_4bit = False
+    if (int8 or bf16) and use_cuda:
+        log.warning("--int8/--bf16 ignored (CUDA uses fp16 or --quant)"); int8 = bf16 = False
+    if int8 and bf16:
+        log.warning("--bf16 ignored (int8 layers compute in fp32)"); bf16 = False
+    if bf16 and not cpu_supports_bf16():
+        log.warning("--bf16 ignored (no native bf16 on this CPU)"); bf16 = False
+    snapshot = bool(snapshot and cache_dir) and not (int8 or quant_4bit)
 
-    if quant_4bit:
+    if not snapshot:
+        with timer.phase("tokenizer"):
+            tok = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+            tok.pad_token = tok.eos_token
+    if int8:
+        model = load_int8_model(model_name, cache_dir)
+    elif quant_4bit:
         bnb_cfg = BitsAndBytesConfig(
             load_in_4bit=True, bnb_4bit_quant_type="nf4",
             bnb_4bit_compute_dtype=torch.float16, bnb_4bit_use_double_quant=True
@@ -30,8 +68,196 @@ def load_model(model_name="gpt2", quant_4bit=False, device_map="auto"):
     else:
         kwargs = dict(device_map=device_map, trust_remote_code=True)
         if use_cuda: kwargs["torch_dtype"] = torch.float16
-        model = AutoModelForCausalLM.from_pretrained(model_name, **kwargs)
+        elif bf16: kwargs["torch_dtype"] = torch.bfloat16
+        if snapshot:
+            tok, model = load_snapshot(model_name, cache_dir, timer, **kwargs)
+        else:
+            with timer.phase("weights"):
+                model = AutoModelForCausalLM.from_pretrained(model_name, **kwargs)
 
     model.eval()
-    log.info(f"{sum(p.numel() for p in model.parameters())/1e6:.1f} M params loaded")
+    log.info(f"{sum(p.numel() for p in model.parameters())/1e6:.1f} M params loaded "
+             f"({model_footprint(model)/2**20:.0f} MB)")
+    with timer.phase("prefix cache"):
+        for key, text in (prefixes or {}).items():
+            prefix_cache.warm(model, tok, key, text)
+    if compile:
+        from static_decode import StaticDecoder, is_gpt2   # it imports this module
+        if not is_gpt2(model):
+            log.warning("--compile ignored (the static decode step is written for GPT-2)")
+        else:
+            with timer.phase("compile"):
+                model.static_decoder = StaticDecoder(model)
+                model.static_decoder.warmup()
     return tok, model
+
+
+# ---- fast cold start -----------------------------------------------------
+def load_snapshot(model_name="gpt2", cache_dir=CACHE_DIR, timer=None, **kwargs):
+    """
+    (tokenizer, model) from a local copy of `model_name`, made on first use: the fast tokenizer
+    (tokenizer.json) and safetensors weights, which are memory-mapped into the model instead of
+    being read into a second buffer. No Hub requests and no slow-tokenizer conversion on startup.
+    kwargs go to from_pretrained (device_map, torch_dtype, ...).
+    """
+    timer = timer or StartupTimer()
+    path = os.path.join(cache_dir, "snapshots", model_name.strip("/").replace("/", "--"))
+    if not os.path.exists(os.path.join(path, "config.json")):
+        with timer.phase("snapshot"):
+            save_snapshot(model_name, path)
+    with timer.phase("tokenizer"):
+        tok = AutoTokenizer.from_pretrained(path, use_fast=True, local_files_only=True)
+        tok.pad_token = tok.eos_token
+    with timer.phase("weights"):
+        model = AutoModelForCausalLM.from_pretrained(
+            path, local_files_only=True, use_safetensors=True, low_cpu_mem_usage=True, **kwargs
+        )
+    return tok, model.eval()
+
+def save_snapshot(model_name, path):
+    """Store `model_name` at `path` as safetensors + fast tokenizer (atomically, so workers can race)"""
+    log.info(f"Building snapshot of {model_name} in {path}")
+    tok = AutoTokenizer.from_pretrained(model_name, use_fast=True, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+    model.save_pretrained(tmp)
+    tok.save_pretrained(tmp)
+    try:
+        os.replace(tmp, path)
+    except OSError:   # another process finished first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def cache_to_tensors(past):
+    """KV cache object -> list of (key, value) tensors per layer, each [batch, heads, seq, head_dim]."""
+    if past is None: return None
+    if hasattr(past, "layers"):                       # transformers >= 4.56
+        return [(l.keys, l.values) for l in past.layers]
+    if hasattr(past, "key_cache"):
+        return list(zip(past.key_cache, past.value_cache))
+    return [tuple(layer[:2]) for layer in past]       # legacy tuple format
+
+def cache_from_tensors(layers):
+    """Inverse of cache_to_tensors: wrap per-layer (key, value) tensors in a fresh DynamicCache."""
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(layers)
+
+
+# ---- CPU quantization ----------------------------------------------------
+def cpu_supports_bf16():
+    """True when the CPU runs bf16 matmuls natively (AVX512-BF16 / AMX) rather than emulating them."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+def conv1d_to_linear(model):
+    """
+    Replace GPT-2's Conv1D layers (a linear layer with transposed weights) by nn.Linear,
+    which is what torch's dynamic quantization knows how to quantize.
+    """
+    for parent in list(model.modules()):
+        for name, child in parent.named_children():
+            if isinstance(child, Conv1D):
+                n_in, n_out = child.weight.shape
+                linear = torch.nn.Linear(n_in, n_out, bias=child.bias is not None)
+                linear.weight.data = child.weight.data.t().contiguous()
+                if child.bias is not None:
+                    linear.bias.data = child.bias.data
+                setattr(parent, name, linear)
+    return model
+
+def quantize_int8(model):
+    """Dynamic int8 quantization: int8 weights, activations quantized on the fly at each matmul."""
+    from torch.ao.quantization import quantize_dynamic
+    with warnings.catch_warnings():   # torch marks the eager-mode API deprecated in favour of torchao
+        warnings.simplefilter("ignore")
+        return quantize_dynamic(conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_int8_model(model_name, cache_dir=CACHE_DIR):
+    """
+    fp32 checkpoint -> int8 model, reusing the quantized model saved by a previous run of the same
+    torch and transformers versions on the same source weights.
+    """
+    path = None
+    if cache_dir:
+        name = model_name.strip("/").replace("/", "--")
+        path = os.path.join(cache_dir, f"{name}-int8-torch{torch.__version__}-transformers{transformers_version}-"
+                                       f"{checkpoint_fingerprint(model_name)}.pt")
+        if os.path.exists(path):
+            log.info(f"Loading quantized checkpoint {path}")
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                return torch.load(path, weights_only=False)
+    model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
+    model = quantize_int8(model.eval())
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(model, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        log.info(f"Saved quantized checkpoint {path}")
+    return model
+
+def checkpoint_fingerprint(model_name):
+    """
+    Short hash of the checkpoint `model_name` resolves to: its directory (for a Hub download, the
+    revision's snapshot) and the size and modification time of its config and weight files
+    """
+    path = os.path.abspath(os.path.dirname(cached_file(model_name, "config.json")))
+    files = sorted(f for f in os.listdir(path) if f == "config.json" or f.endswith((".safetensors", ".bin")))
+    stats = [(f, os.stat(os.path.join(path, f)).st_size, os.stat(os.path.join(path, f)).st_mtime_ns) for f in files]
+    return hashlib.sha1(repr((path, stats)).encode()).hexdigest()[:12]
+
+def model_footprint(model):
+    """Bytes held by the model's weights, including quantized (packed) ones."""
+    def nbytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(nbytes(v) for v in value)
+        return 0
+    seen, total = set(), 0
+    for value in model.state_dict(keep_vars=True).values():
+        if isinstance(value, torch.Tensor):
+            if value.data_ptr() in seen:   # tied weights (lm_head / wte) are stored once
+                continue
+            seen.add(value.data_ptr())
+        total += nbytes(value)
+    return total
+
+def tokens_per_second(model, tok, prompt="User: What is artificial intelligence?\nKyleBot: ", max_new_tokens=64):
+    """Greedy decoding speed (after one warm-up run)."""
+    inputs = tok(prompt, return_tensors="pt").to(model.device)
+    kwargs = dict(max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False,
+                  pad_token_id=tok.eos_token_id)
+    with torch.no_grad():
+        model.generate(**inputs, **kwargs)
+        start = time.perf_counter()
+        model.generate(**inputs, **kwargs)
+    return max_new_tokens / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CPU load options against fp32")
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--int8", action="store_true")
+    parser.add_argument("--bf16", action="store_true")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    options = [("fp32", {})]
+    if args.int8: options.append(("int8", {"int8": True}))
+    if args.bf16: options.append(("bf16", {"bf16": True}))
+    print(f"{'':6}{'weights':>12}{'tokens/s':>12}")
+    for label, kwargs in options:
+        tok, model = load_model(args.model, device_map=None, **kwargs)
+        print(f"{label:6}{model_footprint(model)/2**20:>9.0f} MB"
+              f"{tokens_per_second(model, tok, max_new_tokens=args.max_new_tokens):>12.1f}")
+        del model
+
+
+if __name__ == "__main__":
+    main()
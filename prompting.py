@@ -0,0 +1,93 @@
+"""
+prompting.py
+The KyleBot prompt format, shared by the front ends and the inference server so that every
+entry point builds (and cleans up) conversations the same way.
+"""
+
+import re
+
+# Every prompt starts with this persona line (filled in with the bot's name)
+SYSTEM_PROMPT = "You are {name}, a knowledgeable AI. Provide a clear and concise definition of the user's topic.\n"
+
+# How many previous exchanges build_prompt repeats for context (context_window.ContextWindow
+# fits as many as a token budget allows instead)
+HISTORY_WINDOW = 2
+
+
+class Prompt(str):
+    """Prompt text that carries its token ids, so the generate helpers do not tokenize it again"""
+
+    def __new__(cls, text, ids=None):
+        prompt = super().__new__(cls, text)
+        prompt.ids = list(ids) if ids is not None else None
+        return prompt
+
+def encode_prompt(tokenizer, prompt):
+    """Token ids of a prompt: the ones a Prompt carries, else the tokenizer's"""
+    ids = getattr(prompt, "ids", None)
+    return list(ids) if ids is not None else tokenizer.encode(prompt)
+
+
+def turn_markers(name):
+    """Text that means the model started writing the next turn"""
+    return ["\nUser:", f"\n{name}:"]
+
+def build_prompt(history, user_input, name="KyleBot", system_prompt=None):
+    """
+    Create a prompt with conversation history for context.
+    history: list of sessions.Exchange records, or {"user": ..., "bot": ...} dicts
+             (only the last HISTORY_WINDOW are used)
+    """
+    prompt = system_prompt if system_prompt is not None else SYSTEM_PROMPT.format(name=name)
+    recent_history = history[-HISTORY_WINDOW:] if HISTORY_WINDOW else []
+    if recent_history:
+        context = "\n".join([
+            f"User: {exchange['user']}\n{name}: {exchange['bot']}"
+            for exchange in recent_history
+        ])
+        prompt += context + "\n"
+    prompt += f"User: {user_input}\n{name}: "
+    return prompt
+
+def messages_to_prompt(messages, name="KyleBot"):
+    """
+    OpenAI-style chat messages ([{"role": "user" | "assistant" | "system", "content": ...}])
+    -> KyleBot prompt. A leading system message replaces the persona line.
+    """
+    system_prompt, history, user_input = parse_messages(messages)
+    return build_prompt(history, user_input, name, system_prompt)
+
+def parse_messages(messages):
+    """Chat messages -> (system prompt or None, [{"user": ..., "bot": ...}], new user message)"""
+    system_prompt = None
+    history, pending_user = [], None
+    for message in messages:
+        role, content = message.get("role"), message.get("content") or ""
+        if role == "system":
+            system_prompt = content.rstrip("\n") + "\n"
+        elif role == "user":
+            if pending_user is not None:   # two user turns in a row: keep them together
+                content = f"{pending_user}\n{content}"
+            pending_user = content
+        elif role == "assistant" and pending_user is not None:
+            history.append({"user": pending_user, "bot": content})
+            pending_user = None
+    if pending_user is None:
+        raise ValueError("messages must end with a user message")
+    return system_prompt, history, pending_user
+
+def trim_at_stop_strings(text, stop_strings):
+    """Cut `text` at the first occurrence of any stop string."""
+    cut = min((text.find(s) for s in stop_strings if s and s in text), default=len(text))
+    return text[:cut]
+
+def clean_response(response, name="KyleBot", max_chars=500):
+    """Clean up the generated response"""
+    response = trim_at_stop_strings(response, turn_markers(name)).strip()
+    response = re.sub(rf"^{name}:\s*|^User:\s*|\n{name}:.*", "", response)
+    if len(response) > max_chars:
+        for char in ['.', '!', '?']:
+            if char in response[:max_chars]:
+                response = response[:response.index(char) + 1]
+                break
+    return response
@@ -0,0 +1,124 @@
+"""
+response_cache.py
+Replies to repeated questions, so "What is artificial intelligence?" costs one model.generate
+instead of one per user.
+
+- the key is the prompt's token ids (with the question normalized: case, spacing and trailing
+  punctuation do not matter) plus the method and generation parameters
+- deterministic methods (greedy, beam) store one reply; sampling can opt in to a pool of K
+  samples per key, served at random once the pool is full
+- an in-memory LRU in front of an optional SQLite file, both with a TTL and an entry limit
+- lookups are counted in kylebot_cache_lookups_total{cache="response"}
+"""
+
+import hashlib, json, logging, random, re, sqlite3, threading, time
+from array import array
+from collections import OrderedDict
+
+from metrics import CACHE_LOOKUPS
+
+log = logging.getLogger(__name__)
+
+# Options that change how a reply is produced, not which reply (speculative decoding keeps the
+# output distribution), plus per-request objects
+IGNORED_PARAMS = {"streamer", "stopping_criteria", "speculative_stats", "speculative", "ngram_size",
+                  "num_draft_tokens"}
+
+
+def normalize_question(text):
+    """'  What is  AI?? ' -> 'what is ai': questions that only differ in form share a cache entry"""
+    return re.sub(r"\s+", " ", text).strip().rstrip("?!. ").lower()
+
+def cache_key(prompt_ids, method, params, model_id="gpt2"):
+    """Hex digest of the prompt token ids, the method and the generation parameters"""
+    params = {k: v for k, v in params.items() if k not in IGNORED_PARAMS}
+    digest = hashlib.sha256(array("I", prompt_ids).tobytes())
+    digest.update(json.dumps([model_id, method, sorted(params.items())], default=str).encode())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    key -> list of replies (one for deterministic methods, up to `samples` for sampling).
+    path: optional SQLite file shared by processes and restarts; memory misses fall through to it.
+    """
+
+    def __init__(self, max_entries=1024, ttl=24 * 3600, path=None, max_disk_entries=100_000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()   # key -> (expires, replies)
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                             "(key TEXT PRIMARY KEY, replies TEXT NOT NULL, created REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+
+    def get(self, key, samples=1):
+        """A cached reply, or None when there is none yet (or the sample pool is not full)"""
+        with self._lock:
+            replies, source = self._load(key, time.time())
+        if len(replies) < samples:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(cache="response", result="miss")
+            return None
+        self.hits += 1
+        CACHE_LOOKUPS.inc(cache="response", result=source)
+        return random.choice(replies) if samples > 1 else replies[0]
+
+    def put(self, key, reply, samples=1):
+        """Store `reply` (added to the key's pool while it holds fewer than `samples`)"""
+        now = time.time()
+        with self._lock:
+            replies = list(self._load(key, now)[0])
+            if len(replies) >= samples:
+                return
+            replies.append(reply)
+            self._remember(key, (now + self.ttl, replies))
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                                 (key, json.dumps(replies), now))
+                if random.random() < 0.01:   # trimming scans the table: do it now and then
+                    self._trim_disk(now)
+
+    def _load(self, key, now):
+        """(replies, "memory" | "disk") for a live entry, ([], None) otherwise; hold the lock"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < now:
+            del self._entries[key]
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry[1], "memory"
+        if self._db is not None:
+            row = self._db.execute("SELECT replies, created FROM responses WHERE key = ? AND created > ?",
+                                   (key, now - self.ttl)).fetchone()
+            if row is not None:
+                replies = json.loads(row[0])
+                self._remember(key, (row[1] + self.ttl, replies))
+                return replies, "disk"
+        return [], None
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _trim_disk(self, now):
+        self._db.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+        self._db.execute("DELETE FROM responses WHERE key NOT IN "
+                         "(SELECT key FROM responses ORDER BY created DESC LIMIT ?)", (self.max_disk_entries,))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,434 @@
+"""
+server.py
+Asynchronous inference server: the chat engine (engine.py) shared by every front end over HTTP.
+
+    python server.py --model gpt2 --port 8000
+    curl localhost:8000/v1/chat/completions -H 'Content-Type: application/json' \\
+         -d '{"messages": [{"role": "user", "content": "What is AI?"}], "stream": true}'
+
+- POST /v1/chat/completions: OpenAI-style request/response, or Server-Sent Events with "stream"
+- bounded request queue: when it is full, new requests get 429 instead of piling up
+- per-request timeout (504) and cancellation as soon as the client disconnects
+- every request is answered by a KyleBot on the process's Engine, exactly as in the front ends:
+  the same strategies, response cache, speculative decoding, continuous/beam batching and models
+- on CPU nodes, --workers N starts N inference processes that share the weights (worker_pool.py)
+- GET /metrics: Prometheus-style latency/token/queue metrics (metrics.py)
+
+Besides the OpenAI fields (messages, max_tokens, temperature, stream, user, model) a request may
+set KyleBot's own options: method (a name in engine.STRATEGIES), speculative (true | "draft" |
+"lookup"), best_of, scorer, and the strategies' settings (top_k, top_p, typical_p, penalty_alpha,
+num_beams, no_repeat_ngram_size, repetition_penalty, ngram_size, num_draft_tokens).
+Any other field is rejected with 400. "user" keys the per-session KV cache; "model" picks one of
+--models. The prompt keeps the most recent messages that fit the context next to max_tokens.
+"""
+
+import argparse, asyncio, contextlib, inspect, json, logging, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+from engine import MODEL, MODELS, SCORERS, STRATEGIES, KyleBot, ModelRegistry
+from metrics import PHASE_SECONDS, QUEUE_DEPTH, REGISTRY, phase
+from prompting import parse_messages
+from speculative import Speculator
+from startup import StartupTimer
+from streaming import GenerationCancelled
+
+log = logging.getLogger(__name__)
+
+REQUEST_FIELDS = {"messages", "max_tokens", "max_new_tokens", "temperature", "stream", "user", "timeout",
+                  "model", "method", "speculative", "best_of", "scorer"}
+GENERATION_OPTIONS = {"top_k", "top_p", "typical_p", "penalty_alpha", "num_beams", "no_repeat_ngram_size",
+                      "repetition_penalty"}
+SPECULATIVE_OPTIONS = {"ngram_size", "num_draft_tokens"}
+DETERMINISTIC_METHODS = {"greedy", "beam", "contrastive"}  # temperature does not apply
+# Stats of the reply passed on in "usage" when present
+USAGE_STATS = ("tokens_saved", "tokens_discarded", "cached", "draft_acceptance", "tokens_per_pass",
+               "best_of", "score", "scores", "tokens_sampled")
+
+
+class ServerBusy(Exception):
+    """The request queue is full."""
+
+
+class AsyncTextStream:
+    """Hands the reply's text pieces from the generating thread to the event loop."""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self.cancelled = False
+
+    def put(self, piece):
+        if self.cancelled:
+            raise GenerationCancelled()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, piece)
+
+    def end(self):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    def cancel(self):
+        self.cancelled = True
+
+    async def __aiter__(self):
+        while True:
+            piece = await self._queue.get()
+            if piece is None:
+                return
+            yield piece
+
+
+class Job:
+    """One queued chat completion."""
+
+    def __init__(self, request, stream):
+        self.request = request   # InferenceServer.parse_request
+        self.max_new_tokens = request["options"]["max_new_tokens"]
+        self.session_id = request["session_id"]
+        self.stream = stream
+        self.stats = {}
+        self.prompt_tokens = 0
+        self.queued_at = time.perf_counter()
+        self.done = asyncio.get_running_loop().create_future()
+
+    def cancel(self):
+        self.stream.cancel()
+        if not self.done.done():
+            self.done.cancel()
+
+
+class InferenceServer:
+    """
+    Owns the engine and the request queue. `concurrency` consumer tasks take jobs off the queue
+    and run them on worker threads, so up to that many requests decode together in the
+    continuous batch while the event loop stays free for I/O.
+    """
+
+    def __init__(self, engine, name="KyleBot", max_queue=64, concurrency=32, timeout=120.0):
+        self.engine = engine
+        self.registry = engine.registry
+        self.models = self.registry.models if self.registry is not None else [engine.model_name]
+        self.name = name
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(concurrency, thread_name_prefix="kylebot-job")
+        self.queue = None
+        self.workers = []
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.max_queue)
+        self.workers = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.engine.unload()
+
+    # ---- queue ---------------------------------------------------------
+    def submit(self, job):
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise ServerBusy()
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            if job.done.done():      # cancelled or timed out while waiting in the queue
+                continue
+            PHASE_SECONDS.observe(time.perf_counter() - job.queued_at, phase="queue")
+            try:
+                text = await loop.run_in_executor(self.executor, self._run, job)
+                if not job.done.done():
+                    job.done.set_result(text)
+            except GenerationCancelled:
+                pass
+            except Exception as exc:
+                if not isinstance(exc, ValueError):
+                    log.exception("generation failed")
+                if not job.done.done():
+                    job.done.set_exception(exc)
+            finally:
+                job.stream.end()
+
+    # ---- generation (runs on a worker thread) --------------------------
+    def _run(self, job):
+        """The reply of a KyleBot holding the request's conversation, streamed into job.stream"""
+        request = job.request
+        bot = KyleBot(self.name, session_id=job.session_id, engine=self.engine, history=request["history"],
+                      system_prompt=request["system_prompt"])
+        engine = bot.model_engine(request["model"])
+        with phase("prompt"):
+            job.prompt_tokens = len(bot.create_context_prompt(request["user_input"], job.max_new_tokens, engine).ids)
+        pieces = bot.stream_response(request["user_input"], method=request["method"], model=request["model"],
+                                     **request["options"])
+        try:
+            for piece in pieces:
+                job.stream.put(piece)   # raises GenerationCancelled once the request is cancelled
+        finally:
+            pieces.close()   # stops generation if the request was cancelled
+            if job.session_id is None:
+                engine.drop_session(bot.session_id)   # nobody continues an anonymous conversation
+        job.stats = bot.last_stats
+        return bot.conversation_history[-1].bot
+
+    # ---- request handling ------------------------------------------------
+    def parse_request(self, body):
+        """OpenAI-style JSON body -> the request a Job runs; anything it cannot run raises ValueError"""
+        if not isinstance(body, dict):
+            raise ValueError("the request body must be a JSON object")
+        unknown = set(body) - REQUEST_FIELDS - GENERATION_OPTIONS - SPECULATIVE_OPTIONS
+        if unknown:
+            raise ValueError(f"unknown field(s): {', '.join(sorted(unknown))}")
+        system_prompt, history, user_input = parse_messages(body.get("messages") or [])
+        temperature = float(body.get("temperature", 0.8))
+        method = body.get("method") or ("greedy" if temperature == 0 else "sampling")
+        if method not in STRATEGIES:
+            raise ValueError(f"unknown method {method!r} (choose from {', '.join(STRATEGIES)})")
+        model = body.get("model") or None
+        if model is not None and model not in self.models:
+            raise ValueError(f"unknown model {model!r} (choose from {', '.join(self.models)})")
+
+        options = {"max_new_tokens": int(body.get("max_tokens") or body.get("max_new_tokens") or 100)}
+        if method not in DETERMINISTIC_METHODS:
+            options["temperature"] = temperature
+        options.update({k: body[k] for k in GENERATION_OPTIONS & set(body)})
+        unsupported = set(options) - strategy_options(method)
+        if body.get("speculative"):
+            if method not in ("greedy", "sampling"):
+                raise ValueError("speculative decoding works with greedy decoding and sampling only")
+            unsupported = set(options) - keyword_options(Speculator.generate)
+            options["speculative"] = body["speculative"]
+            options.update({k: int(body[k]) for k in SPECULATIVE_OPTIONS & set(body)})
+        elif SPECULATIVE_OPTIONS & set(body):
+            raise ValueError(f"{', '.join(sorted(SPECULATIVE_OPTIONS & set(body)))}: set speculative to use them")
+        if body.get("best_of"):
+            if method != "sampling" or body.get("speculative"):
+                raise ValueError("best_of works with sampling only")
+            unsupported = set(options) - {"max_new_tokens", "temperature", "top_k"}
+            if body.get("scorer", "logprob") not in SCORERS:
+                raise ValueError(f"unknown scorer {body['scorer']!r} (choose from {', '.join(SCORERS)})")
+            options.update(best_of=int(body["best_of"]), scorer=body.get("scorer"))
+        elif "scorer" in body:
+            raise ValueError("scorer needs best_of")
+        if unsupported:
+            raise ValueError(f"{', '.join(sorted(unsupported))} cannot be used with {method!r}"
+                             + (" and best_of" if body.get("best_of") else "")
+                             + (" and speculative decoding" if body.get("speculative") else ""))
+        return {"system_prompt": system_prompt, "history": history, "user_input": user_input, "method": method,
+                "model": model, "options": options, "session_id": body.get("user")}
+
+    def usage(self, job):
+        generated = job.stats.get("tokens_generated", 0)
+        usage = {
+            "prompt_tokens": job.prompt_tokens,
+            "completion_tokens": generated,
+            "total_tokens": job.prompt_tokens + generated,
+        }
+        usage.update({key: job.stats[key] for key in USAGE_STATS if key in job.stats})
+        return usage
+
+    def completion(self, job, text):
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model_id(job),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": self.finish_reason(job),
+            }],
+            "usage": self.usage(job),
+        }
+
+    def model_id(self, job):
+        return job.request["model"] or self.engine.model_name
+
+    def finish_reason(self, job):
+        return "length" if job.stats.get("tokens_generated", 0) >= job.max_new_tokens else "stop"
+
+
+def strategy_options(method):
+    """Request options a strategy takes (see keyword_options)"""
+    return keyword_options(STRATEGIES[method].generate)
+
+def keyword_options(fn):
+    """Request options `fn` takes: its keyword arguments, or any with **kwargs (model.generate's)"""
+    parameters = inspect.signature(fn).parameters.values()
+    if any(parameter.kind is parameter.VAR_KEYWORD for parameter in parameters):
+        return {"max_new_tokens", "temperature"} | GENERATION_OPTIONS
+    return {parameter.name for parameter in parameters}
+
+
+def create_app(server):
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        await server.start()
+        yield
+        await server.stop()
+
+    app = FastAPI(title="KyleBot inference server", lifespan=lifespan)
+
+    @app.get("/health")
+    async def health():
+        active = server.engine.batcher.active_requests if server.engine.ready() else 0
+        return {"status": "ok" if server.engine.ready() else "loading", "queued": server.queue.qsize(),
+                "active": active}
+
+    @app.get("/metrics")
+    async def metrics():
+        return PlainTextResponse(REGISTRY.exposition(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list",
+                "data": [{"id": model, "object": "model", "owned_by": "kylebot"} for model in server.models]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        try:
+            body = await request.json()
+            parsed = server.parse_request(body)
+            timeout = float(body.get("timeout", server.timeout))
+        except (ValueError, TypeError) as exc:
+            return error_response(400, str(exc))
+        job = Job(parsed, AsyncTextStream(asyncio.get_running_loop()))
+        try:
+            server.submit(job)
+        except ServerBusy:
+            return error_response(429, "server busy, retry later", headers={"Retry-After": "1"})
+
+        if body.get("stream"):
+            return StreamingResponse(stream_events(server, job, timeout), media_type="text/event-stream")
+
+        # Non-streaming: wait for the result, but give up if the client goes away
+        async def watch_disconnect():
+            while not job.done.done():
+                if await request.is_disconnected():
+                    job.cancel()
+                    return
+                await asyncio.sleep(0.25)
+
+        watcher = asyncio.create_task(watch_disconnect())
+        try:
+            text = await asyncio.wait_for(asyncio.shield(job.done), timeout)
+        except asyncio.TimeoutError:
+            job.cancel()
+            return error_response(504, f"generation took longer than {timeout:g}s")
+        except asyncio.CancelledError:
+            job.cancel()
+            return error_response(499, "client closed request")
+        except ValueError as exc:   # options the engine rejected
+            return error_response(400, str(exc))
+        finally:
+            watcher.cancel()
+        return server.completion(job, text)
+
+    return app
+
+
+async def stream_events(server, job, timeout):
+    """SSE chat.completion.chunk events; cancelled by Starlette when the client disconnects."""
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+    def event(delta, finish_reason=None, usage=None):
+        chunk = {
+            "id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": server.model_id(job),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        if usage is not None:
+            chunk["usage"] = usage
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    def error(message, code):
+        return f"data: {json.dumps({'error': {'message': message, 'code': code}})}\n\n"
+
+    deadline = time.monotonic() + timeout
+    try:
+        yield event({"role": "assistant"})
+        pieces = job.stream.__aiter__()
+        while True:
+            try:
+                piece = await asyncio.wait_for(pieces.__anext__(), max(deadline - time.monotonic(), 0))
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                job.cancel()
+                yield error("timeout", 504)
+                return
+            yield event({"content": piece})
+        try:
+            await job.done
+        except Exception as exc:
+            yield error(str(exc), 400 if isinstance(exc, ValueError) else 500)
+            return
+        yield event({}, server.finish_reason(job), server.usage(job))   # usage rides on the final chunk
+        yield "data: [DONE]\n\n"
+    finally:
+        job.cancel()   # no-op when generation already finished
+
+
+def error_response(status, message, headers=None):
+    return JSONResponse({"error": {"message": message, "code": status}}, status_code=status, headers=headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KyleBot inference server")
+    parser.add_argument("--model", default=MODEL, help="default model, always loaded")
+    parser.add_argument("--models", nargs="+", default=MODELS,
+                        help="models a request can pick with \"model\" (loaded on first use)")
+    parser.add_argument("--name", default="KyleBot", help="persona used in the system prompt")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-queue", type=int, default=64, help="queued requests before answering 429")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests decoding at the same time")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--quant", action="store_true", help="4-bit weights (CUDA only)")
+    parser.add_argument("--int8", action="store_true", help="dynamic int8 quantization (CPU only)")
+    parser.add_argument("--bf16", action="store_true", help="bfloat16 weights (CPUs with native bf16)")
+    parser.add_argument("--compile", action="store_true",
+                        help="compiled one-request-at-a-time decoding instead of the continuous batch")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="CPU inference processes sharing the weights (0: run in the server process)")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="intra-op threads per worker (default: cores / workers)")
+    parser.add_argument("--context-tokens", type=int, default=0,
+                        help="prompt + reply token budget (default: the model's context size)")
+    parser.add_argument("--summarize-history", action="store_true",
+                        help="sum up messages that no longer fit in a line of earlier topics")
+    args = parser.parse_args()
+    if args.workers and args.compile:
+        parser.error("--compile decodes one request at a time in this process: it cannot be used with --workers")
+
+    logging.basicConfig(level=logging.INFO)
+    import uvicorn
+
+    timer = StartupTimer()
+    registry = ModelRegistry(models=args.models, pinned=(args.model,), quant_4bit=args.quant, int8=args.int8,
+                             bf16=args.bf16, compile=args.compile, context_tokens=args.context_tokens,
+                             summarize_history=args.summarize_history)
+    engine = registry.get(args.model)
+    with timer.phase("model"):
+        engine.wait()
+    if args.workers:
+        # Greedy and sampling requests go to the worker processes instead of the in-process batch
+        from worker_pool import WorkerPool
+        with timer.phase("workers"):
+            engine.batcher = WorkerPool(engine.model, engine.tokenizer, num_workers=args.workers,
+                                        threads_per_worker=args.threads_per_worker,
+                                        max_batch_size=args.concurrency, prefix_cache=engine.prefix_cache)
+    server = InferenceServer(engine, name=args.name, max_queue=args.max_queue, concurrency=args.concurrency,
+                             timeout=args.timeout)
+    QUEUE_DEPTH.set_function(lambda: server.queue.qsize() if server.queue else 0, queue="server")
+    log.info(f"Startup: {timer.summary()}")
+    uvicorn.run(create_app(server), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
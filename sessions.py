@@ -0,0 +1,237 @@
+"""
+sessions.py
+Per-user chat state for multi-user front ends: one bot (with its own history and generation
+method) per session instead of a single global KyleBot shared by every browser tab.
+
+ConversationStore keeps histories across restarts: every exchange is appended to a SQLite log,
+with its token ids next to the text, and a bot loads only the last `window` exchanges of its
+session (StoredHistory), so memory stays flat however long a conversation runs.
+"""
+
+import logging, sqlite3, threading, time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class Exchange:
+    """
+    One user message and the bot's reply, plus token ids encoded once and stored compactly:
+    the reply's, and the whole exchange's as it appears in prompts (see context_window.py)
+    """
+    __slots__ = ("user", "bot", "bot_ids", "prompt_ids")
+
+    def __init__(self, user, bot, bot_ids=(), prompt_ids=()):
+        self.user = user
+        self.bot = bot
+        self.bot_ids = array("I", bot_ids)
+        self.prompt_ids = array("I", prompt_ids)
+
+    def __getitem__(self, key):
+        # History used to be a list of {"user": ..., "bot": ...} dicts; keep exchange["user"] working
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f"Exchange(user={self.user!r}, bot={self.bot!r})"
+
+
+class ConversationStore:
+    """
+    Append-only log of exchanges per session in a SQLite file, shared by processes and restarts.
+    - window: exchanges a session loads (and keeps in memory); the prompt never uses more
+    - max_exchanges / ttl: a background compaction every `compact_interval` seconds deletes all
+      but a session's newest max_exchanges, and sessions idle for longer than ttl seconds
+    Token ids are stored with the model they were encoded for; other models re-encode the text.
+    """
+
+    def __init__(self, path, window=50, max_exchanges=1000, ttl=30 * 24 * 3600, compact_interval=3600):
+        self.path = path
+        self.window = window
+        self.max_exchanges = max_exchanges
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")   # takes effect on a new file
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS exchanges (id INTEGER PRIMARY KEY, session TEXT NOT NULL, "
+                         "user TEXT NOT NULL, bot TEXT NOT NULL, model TEXT, bot_ids BLOB, prompt_ids BLOB, "
+                         "created REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS exchanges_session ON exchanges (session, id)")
+        self._stop = threading.Event()
+        if compact_interval:
+            threading.Thread(target=self._compact_loop, args=(compact_interval,), daemon=True,
+                             name="conversation-compaction").start()
+
+    def history(self, session_id, model=None):
+        """The session's StoredHistory: its last `window` exchanges, loaded now"""
+        return StoredHistory(self, session_id, model, self.tail(session_id, model))
+
+    def tail(self, session_id, model=None, n=None):
+        """The session's last n (default: window) exchanges, oldest first"""
+        with self._lock:
+            rows = self._db.execute("SELECT user, bot, model, bot_ids, prompt_ids FROM exchanges WHERE session = ? "
+                                    "ORDER BY id DESC LIMIT ?", (session_id, n or self.window)).fetchall()
+        exchanges = []
+        for user, bot, encoded_for, bot_ids, prompt_ids in reversed(rows):
+            if encoded_for == model:
+                exchanges.append(Exchange(user, bot, _unpack(bot_ids), _unpack(prompt_ids)))
+            else:
+                exchanges.append(Exchange(user, bot))   # encoded again when a prompt needs it
+        return exchanges
+
+    def append(self, session_id, exchange, model=None):
+        with self._lock:
+            self._db.execute("INSERT INTO exchanges (session, user, bot, model, bot_ids, prompt_ids, created) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (session_id, exchange.user, exchange.bot, model, _pack(exchange.bot_ids),
+                              _pack(exchange.prompt_ids), time.time()))
+
+    def clear(self, session_id):
+        with self._lock:
+            self._db.execute("DELETE FROM exchanges WHERE session = ?", (session_id,))
+
+    def compact(self):
+        """Delete what no session will load again, then give the space back to the file system"""
+        start = time.perf_counter()
+        with self._lock:
+            deleted = self._db.execute("DELETE FROM exchanges WHERE session IN (SELECT session FROM exchanges "
+                                       "GROUP BY session HAVING MAX(created) < ?)", (time.time() - self.ttl,)).rowcount
+            deleted += self._db.execute("DELETE FROM exchanges WHERE id IN (SELECT id FROM (SELECT id, ROW_NUMBER() "
+                                        "OVER (PARTITION BY session ORDER BY id DESC) AS n FROM exchanges) "
+                                        "WHERE n > ?)", (self.max_exchanges,)).rowcount
+            self._db.execute("PRAGMA incremental_vacuum")
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        log.info(f"Conversation store compacted: {deleted} exchanges deleted in {time.perf_counter() - start:.2f}s")
+        return deleted
+
+    def _compact_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.compact()
+            except sqlite3.Error as exc:   # e.g. another process holds the write lock
+                log.warning(f"Conversation store compaction failed: {exc}")
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM exchanges").fetchone()[0]
+
+def _pack(ids):
+    return array("I", ids).tobytes() if ids else None
+
+def _unpack(blob):
+    ids = array("I")
+    if blob:
+        ids.frombytes(blob)
+    return ids
+
+
+class StoredHistory(list):
+    """
+    A conversation_history backed by a ConversationStore: append() also writes the exchange to
+    the store, clear() forgets the session there too, and only the last `window` exchanges stay
+    in memory. Other list operations change the in-memory window only.
+    """
+
+    def __init__(self, store, session_id, model=None, exchanges=()):
+        super().__init__(exchanges)
+        self.store = store
+        self.session_id = session_id
+        self.model = model
+
+    def append(self, exchange):
+        self.store.append(self.session_id, exchange, self.model)
+        super().append(exchange)
+        if len(self) > self.store.window:
+            del self[:-self.store.window]
+
+    def clear(self):
+        self.store.clear(self.session_id)
+        super().clear()
+
+
+class _Session:
+    __slots__ = ("bot", "lock", "last_seen")
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.lock = threading.Lock()
+        self.last_seen = time.monotonic()
+
+
+class SessionManager:
+    """
+    Thread-safe map of session id -> bot, created on first use by `factory(session_id)`.
+
+    - sessions idle for longer than `ttl` seconds are evicted
+    - at most `max_sessions` are kept (least recently used go first)
+    - each session keeps its last `max_exchanges` exchanges, so memory stays bounded by
+      max_sessions * max_exchanges however long people chat
+    `on_evict(bot)` runs for every evicted session, e.g. to drop its KV cache entry.
+    """
+
+    def __init__(self, factory, ttl=3600, max_sessions=1000, max_exchanges=50, on_evict=None):
+        self.factory = factory
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_exchanges = max_exchanges
+        self.on_evict = on_evict
+        self._sessions = OrderedDict()   # least recently used first
+        self._lock = threading.Lock()
+
+    def _get(self, session_id):
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            # Least recently used sessions sit at the front: drop the expired ones, and make
+            # room when a new session would go over max_sessions
+            while self._sessions:
+                oldest_id, oldest = next(iter(self._sessions.items()))
+                expired = now - oldest.last_seen > self.ttl
+                full = len(self._sessions) >= self.max_sessions and session_id not in self._sessions
+                if not (expired or full):
+                    break
+                evicted.append(self._sessions.pop(oldest_id))
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _Session(self.factory(session_id))
+            session.last_seen = now
+            self._sessions.move_to_end(session_id)
+        for old in evicted:
+            self._evicted(old)
+        return session
+
+    @contextmanager
+    def session(self, session_id):
+        """Use a session's bot; concurrent requests from the same session wait their turn."""
+        session = self._get(session_id)
+        with session.lock:
+            yield session.bot
+            history = session.bot.conversation_history
+            if len(history) > self.max_exchanges:
+                del history[:-self.max_exchanges]
+            session.last_seen = time.monotonic()
+
+    def get(self, session_id):
+        """The session's bot, without taking its lock."""
+        return self._get(session_id).bot
+
+    def drop(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._evicted(session)
+
+    def _evicted(self, session):
+        if self.on_evict is not None:
+            self.on_evict(session.bot)
+
+    def __len__(self):
+        return len(self._sessions)
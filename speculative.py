@@ -0,0 +1,282 @@
+"""
+speculative.py
+Speculative decoding: a small draft model (e.g. distilgpt2, which shares GPT-2's tokenizer)
+guesses the next few tokens one at a time, then GPT-2 checks all of the guesses in a single
+forward pass. Every pass yields between 1 and num_draft_tokens + 1 tokens for the price of one
+GPT-2 step plus a few cheap draft steps.
+
+The output is distributed exactly as if GPT-2 had decoded on its own:
+- greedy: a guess is kept while it equals GPT-2's argmax, so the text is plain greedy decoding
+- sampling: a guess x is kept with probability min(1, p(x) / q(x)) (p: GPT-2, q: draft, both
+  after temperature and top-k); the first rejected one is replaced by a sample from
+  max(p - q, 0), renormalized. After all guesses are kept, one more token comes from p.
+
+    python speculative.py --model gpt2 --draft distilgpt2     # acceptance rate and speedup
+    python speculative.py --model gpt2 --draft lookup         # prompt lookup, no draft model
+"""
+
+import argparse, logging, time
+
+import torch
+import torch.nn.functional as F
+
+from kv_cache import crop_past
+from metrics import SPECULATIVE_TOKENS
+from model_utils import cache_from_tensors, cache_to_tensors
+
+log = logging.getLogger(__name__)
+
+
+def token_probs(logits, temperature=1.0, top_k=0, do_sample=False):
+    """
+    [n, vocab] logits -> next-token distributions, with the same temperature / top-k rules as
+    model.generate. Greedy decoding is the one-hot distribution on the argmax, which turns the
+    acceptance test into "guess == argmax".
+    """
+    if not do_sample:
+        return F.one_hot(logits.argmax(dim=-1), logits.shape[-1]).float()
+    scores = logits.float() / max(temperature, 1e-5)
+    if top_k:
+        kth = scores.topk(min(top_k, scores.shape[-1]), dim=-1).values[..., -1:]
+        scores = scores.masked_fill(scores < kth, float("-inf"))
+    return F.softmax(scores, dim=-1)
+
+
+class SpeculativeStats:
+    """Draft tokens proposed / accepted and GPT-2 forward passes, for one request or many"""
+
+    def __init__(self):
+        self.proposed = self.accepted = self.target_passes = self.tokens = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_pass(self):
+        """Tokens per GPT-2 forward pass: the speedup over plain decoding, ignoring draft cost"""
+        return self.tokens / self.target_passes if self.target_passes else 0.0
+
+
+class Speculator:
+    """
+    The verification loop shared by every way of guessing tokens: generate() for one prompt.
+    Subclasses implement _propose (and _rewind, if they keep per-request state). Reuses (and
+    refreshes) the session's entry in a kv_cache.SessionKVCache for GPT-2.
+    """
+
+    def __init__(self, model, num_draft_tokens=4):
+        self.model = model
+        self.num_draft_tokens = num_draft_tokens
+
+    def _start(self):
+        """Per-request drafting state"""
+        return None
+
+    def _propose(self, state, ids, k, sampling):
+        """Up to k guesses following `ids` -> (tokens, their draft distributions or None if exact)"""
+        raise NotImplementedError
+
+    def _rewind(self, state, length):
+        """Only the first `length` ids are still valid"""
+
+    @staticmethod
+    def _forward(model, cache, ids, device):
+        out = model(input_ids=torch.tensor([ids], device=device), past_key_values=cache, use_cache=True)
+        return out.logits[0], out.past_key_values
+
+    @staticmethod
+    def _crop(cache, length):
+        return cache_from_tensors(crop_past(cache_to_tensors(cache), length))
+
+    def generate(self, inputs, max_new_tokens=50, do_sample=False, temperature=1.0, top_k=0,
+                 kv_cache=None, session_id=None, eos_token_id=None, stopping_criteria=None,
+                 streamer=None, speculative_stats=None):
+        """
+        `inputs` is a [1, seq] tensor of prompt ids; returns the [1, seq + new] sequences tensor,
+        like generate_with_session_cache. streamer/stopping_criteria follow model.generate.
+        """
+        stats = speculative_stats or SpeculativeStats()
+        device = inputs.device
+        ids = inputs[0].tolist()
+        prompt_length = len(ids)
+        sampling = dict(temperature=temperature, top_k=top_k, do_sample=do_sample)
+
+        # The cache covers at most len(ids) - 1 tokens: the last token is always fed again
+        target_cache, n_target = None, 0
+        if kv_cache is not None:
+            past, n_target = kv_cache.lookup(session_id, ids)
+            target_cache = cache_from_tensors(past) if past is not None else None
+        state = self._start()
+        if streamer is not None:
+            streamer.put(inputs.cpu())
+
+        finished = False
+        with torch.no_grad():
+            while not finished:
+                k = min(self.num_draft_tokens, max_new_tokens - (len(ids) - prompt_length) - 1)
+                guesses, draft_probs = self._propose(state, ids, k, sampling) if k > 0 else ([], None)
+                k = len(guesses)
+
+                # One GPT-2 pass scores every guess, plus the position after the last one
+                logits, target_cache = self._forward(self.model, target_cache, (ids + guesses)[n_target:], device)
+                p = token_probs(logits[-(k + 1):], **sampling)
+                stats.target_passes += 1
+
+                new_tokens = []
+                for i, x in enumerate(guesses):
+                    q = draft_probs[i] if draft_probs is not None else None   # None: q(x) = 1
+                    if torch.rand(()) < p[i, x] / (q[x] if q is not None else 1.0):
+                        new_tokens.append(x)
+                        continue
+                    residual = (p[i] - q).clamp(min=0) if q is not None else p[i].index_fill(0, torch.tensor(x), 0)
+                    total = residual.sum()
+                    # Nothing left to correct (p == q, rejected only by rounding): sample from p itself
+                    new_tokens.append(int(torch.multinomial(residual / total if total > 0 else p[i], 1)))
+                    break
+                else:
+                    new_tokens.append(int(torch.multinomial(p[k], 1)))
+                n_kept = len(new_tokens) - 1   # the last one was resampled (or is the bonus token)
+                stats.proposed += k
+                stats.accepted += n_kept
+                SPECULATIVE_TOKENS.inc(k, result="proposed")
+                SPECULATIVE_TOKENS.inc(n_kept, result="accepted")
+
+                base = len(ids)
+                for token in new_tokens:
+                    ids.append(token)
+                    stats.tokens += 1
+                    if streamer is not None:
+                        streamer.put(torch.tensor([token]))
+                    stop = (stopping_criteria is not None
+                            and bool(stopping_criteria(torch.tensor([ids], device=device), None).any()))
+                    finished = stop or token == eos_token_id or len(ids) - prompt_length >= max_new_tokens
+                    if finished:
+                        break
+
+                # Forget the keys/values of rejected guesses
+                n_target = len(ids) - 1
+                target_cache = self._crop(target_cache, n_target)
+                self._rewind(state, min(base + n_kept, len(ids) - 1))
+
+        if streamer is not None:
+            streamer.end()
+        if kv_cache is not None and session_id is not None:
+            kv_cache.store(session_id, ids[:n_target], cache_to_tensors(target_cache))
+        log.debug(f"{type(self).__name__}: {stats.accepted}/{stats.proposed} draft tokens accepted, "
+                  f"{stats.tokens_per_pass:.2f} tokens per pass")
+        return torch.tensor([ids], device=device)
+
+
+class SpeculativeDecoder(Speculator):
+    """Guesses come from a small draft model, which prefills the prompt itself (cheaply)"""
+
+    def __init__(self, model, draft_model, num_draft_tokens=4):
+        if model.config.vocab_size != draft_model.config.vocab_size:
+            raise ValueError("the draft model must use the same tokenizer as the main model")
+        super().__init__(model, num_draft_tokens)
+        self.draft_model = draft_model
+
+    def _start(self):
+        return {"cache": None, "covered": 0}
+
+    def _propose(self, state, ids, k, sampling):
+        device = next(self.draft_model.parameters()).device
+        guesses, draft_probs = [], []
+        for _ in range(k):
+            logits, state["cache"] = self._forward(self.draft_model, state["cache"],
+                                                   (ids + guesses)[state["covered"]:], device)
+            state["covered"] = len(ids) + len(guesses)
+            q = token_probs(logits[-1:], **sampling)[0]
+            guesses.append(int(torch.multinomial(q, 1)))
+            draft_probs.append(q)
+        return guesses, draft_probs
+
+    def _rewind(self, state, length):
+        if state["cache"] is not None and state["covered"] > length:
+            state["cache"], state["covered"] = self._crop(state["cache"], length), length
+
+
+def lookup_ngram(ids, ngram_size=3, max_tokens=10):
+    """
+    Tokens that followed the first earlier occurrence of the last `ngram_size` ids (falling
+    back to shorter n-grams down to a single token), at most `max_tokens` of them. The first
+    occurrence has the longest continuation, which is what gets copied from the prompt.
+    """
+    last = len(ids) - 1
+    for n in range(min(ngram_size, last), 0, -1):
+        tail = ids[-n:]
+        for start in range(last - n + 1):
+            if ids[start + n - 1] == ids[-1] and ids[start:start + n] == tail:
+                return ids[start + n:start + n + max_tokens]
+    return []
+
+
+class PromptLookupDecoder(Speculator):
+    """
+    Draft-free speculation ("prompt lookup decoding"): definitions and follow-up answers often
+    copy spans of the question or of earlier turns, so the guesses are whatever followed the
+    first n-gram in the prompt (or the reply so far) that matches the last generated tokens.
+    No second model, no extra memory; a wrong guess only costs a slightly longer GPT-2 pass.
+    """
+
+    def __init__(self, model, ngram_size=3, num_draft_tokens=10):
+        super().__init__(model, num_draft_tokens)
+        self.ngram_size = ngram_size
+
+    def _propose(self, state, ids, k, sampling):
+        return lookup_ngram(ids, self.ngram_size, k), None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speculative decoding: acceptance rate and speedup")
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--draft", default="distilgpt2", help="draft model, or 'lookup' for prompt lookup")
+    parser.add_argument("--num-draft-tokens", type=int, nargs="+", default=None)
+    parser.add_argument("--ngram-size", type=int, default=3, help="prompt lookup only")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--sample", action="store_true", help="temperature 0.8 / top-k 50 instead of greedy")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from model_utils import load_model
+    from prompting import build_prompt
+    tok, model = load_model(args.model, device_map=None)
+    if args.draft == "lookup":
+        make_decoder = lambda k: PromptLookupDecoder(model, ngram_size=args.ngram_size, num_draft_tokens=k)
+    else:
+        _, draft_model = load_model(args.draft, device_map=None)
+        make_decoder = lambda k: SpeculativeDecoder(model, draft_model, num_draft_tokens=k)
+    # A follow-up question, so the answer can copy from the earlier one
+    history = [{"user": "What is machine learning?",
+                "bot": "Machine learning is a field of computer science in which programs improve at a task "
+                       "by learning from examples instead of following hand-written rules."}]
+    prompt = build_prompt(history, "Can you explain machine learning again?")
+    inputs = tok.encode(prompt, return_tensors="pt")
+    sampling = dict(do_sample=args.sample, temperature=0.8, top_k=50 if args.sample else 0)
+
+    def timed(fn):
+        fn()   # warm-up
+        start = time.perf_counter()
+        outputs = fn()
+        return outputs.shape[1] - inputs.shape[1], time.perf_counter() - start
+
+    gen_kwargs = dict(sampling) if args.sample else {"do_sample": False}
+    with torch.no_grad():
+        n, seconds = timed(lambda: model.generate(inputs, max_new_tokens=args.max_new_tokens,
+                                                  pad_token_id=tok.eos_token_id, **gen_kwargs))
+    baseline = n / seconds
+    print(f"{'draft tokens':>12}{'accepted':>10}{'tok/pass':>10}{'tokens/s':>10}{'speedup':>9}")
+    print(f"{'-':>12}{'-':>10}{1:>10.2f}{baseline:>10.1f}{1:>8.2f}x")
+    for k in args.num_draft_tokens or ([5, 10] if args.draft == "lookup" else [2, 4, 6]):
+        decoder = make_decoder(k)
+        stats = SpeculativeStats()
+        n, seconds = timed(lambda: decoder.generate(inputs, max_new_tokens=args.max_new_tokens,
+                                                    eos_token_id=tok.eos_token_id,
+                                                    speculative_stats=stats, **sampling))
+        print(f"{k:>12}{stats.acceptance_rate:>10.0%}{stats.tokens_per_pass:>10.2f}"
+              f"{n / seconds:>10.1f}{n / seconds / baseline:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
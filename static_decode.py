@@ -0,0 +1,246 @@
+"""
+static_decode.py
+Compiled decoding over a pre-allocated KV cache, for GPT-2 models.
+
+model.generate grows its KV cache by concatenation: every step allocates new key/value tensors
+one position longer and copies the old ones over. Here each request decodes into fixed buffers
+(one [layers, heads, positions, head_dim] pair per cache size bucket, e.g. 256 / 512 / 1024
+positions), written in place, and the one-token decode step is a torch.compile'd function of
+fixed shapes: one graph per bucket, compiled by warmup() at startup instead of on the first
+request.
+
+The prompt is prefilled eagerly (continuing the session's cached keys/values, like
+generate_with_session_cache) and copied into the buffer once; every later token is one call of
+the compiled step. Greedy decoding gives the same tokens as model.generate.
+
+    python static_decode.py --model gpt2        # per-token latency and allocations vs eager
+"""
+
+import argparse, logging, threading, time
+
+import torch
+import torch.nn.functional as F
+
+from model_utils import cache_from_tensors, cache_to_tensors
+
+log = logging.getLogger(__name__)
+
+# generate() options the compiled loop implements; others (beams, repetition penalty,
+# top_p, ...) go through model.generate
+SUPPORTED_KWARGS = {"max_new_tokens", "do_sample", "temperature", "top_k", "pad_token_id", "eos_token_id",
+                    "stopping_criteria", "streamer", "num_return_sequences"}
+
+
+def is_gpt2(model):
+    """The decode step below reimplements GPT-2's blocks; other architectures use model.generate"""
+    blocks = getattr(getattr(model, "transformer", None), "h", None)
+    return blocks is not None and hasattr(blocks[0], "attn") and hasattr(blocks[0].attn, "c_attn")
+
+
+class StaticDecoder:
+    """
+    Single-sequence decoding with pre-allocated KV buffers and a compiled decode step.
+    - buckets: cache sizes; a request uses the smallest that holds prompt + max_new_tokens
+    - compile: torch.compile the step (False: the same static buffers, run eagerly)
+    Buffers are pooled per bucket, so concurrent requests never share one.
+    """
+
+    def __init__(self, model, buckets=(256, 512, 1024), compile=True):
+        config = model.config
+        self.model = model
+        self.buckets = tuple(sorted(b for b in buckets if b <= config.n_positions)) or (config.n_positions,)
+        self.n_heads = config.n_head
+        self.head_dim = config.n_embd // config.n_head
+        self.dtype = next(model.parameters()).dtype
+        if self.dtype not in (torch.float16, torch.bfloat16, torch.float32):
+            self.dtype = torch.float32   # int8 layers take and return fp32
+        self.device = next(model.parameters()).device
+        # GPT-2 variants scale attention by 1 / sqrt(head_dim) and, optionally, 1 / layer number
+        self.scales = [
+            (self.head_dim ** -0.5 if config.scale_attn_weights else 1.0)
+            / (i + 1 if config.scale_attn_by_inverse_layer_idx else 1)
+            for i in range(config.n_layer)
+        ]
+        self._pools = {bucket: [] for bucket in self.buckets}
+        self._lock = threading.Lock()
+        self.step = torch.compile(self._step, dynamic=False) if compile else self._step
+        self.compiled = compile
+
+    def supports(self, input_length, gen_kwargs):
+        """True when a model.generate call with these options can run here"""
+        return (set(gen_kwargs) <= SUPPORTED_KWARGS and gen_kwargs.get("num_return_sequences", 1) == 1
+                and input_length + gen_kwargs.get("max_new_tokens", 20) <= self.buckets[-1])
+
+    def warmup(self):
+        """Compile the step for every bucket now, rather than on the first request of each size"""
+        start = time.perf_counter()
+        try:
+            for bucket in self.buckets:
+                keys, values = self._acquire(bucket)
+                with torch.no_grad():
+                    for position in (0, 1):
+                        self.step(keys, values, torch.zeros(1, 1, dtype=torch.long, device=self.device),
+                                  torch.tensor([position], device=self.device))
+                self._release(bucket, (keys, values))
+        except Exception as exc:   # e.g. no C++ compiler, or int8 layers inductor cannot lower
+            if not self.compiled:
+                raise
+            log.warning(f"torch.compile failed ({exc!r}); decoding with static buffers in eager mode")
+            self.step, self.compiled = self._step, False
+            return self.warmup()
+        log.info(f"Static decode warmed up for {self.buckets} positions "
+                 f"({'compiled' if self.compiled else 'eager'}, {time.perf_counter() - start:.1f}s)")
+
+    def _acquire(self, bucket):
+        with self._lock:
+            if self._pools[bucket]:
+                return self._pools[bucket].pop()
+        # One tensor per layer, not views of one big buffer: torch.compile updates each in place
+        shape = (1, self.n_heads, bucket, self.head_dim)
+        return ([torch.zeros(shape, dtype=self.dtype, device=self.device) for _ in self.model.transformer.h],
+                [torch.zeros(shape, dtype=self.dtype, device=self.device) for _ in self.model.transformer.h])
+
+    def _release(self, bucket, buffers):
+        with self._lock:
+            self._pools[bucket].append(buffers)
+
+    def _step(self, keys, values, token, position):
+        """
+        One token through GPT-2: writes its keys/values at `position` of the buffers and returns
+        the next-token logits [1, vocab]. Every shape is fixed for a given bucket.
+        """
+        transformer = self.model.transformer
+        x = transformer.wte(token) + transformer.wpe(position).unsqueeze(0)    # [1, 1, embd]
+        # Causal mask: the buffers hold this token and the ones before it, then unused zeros
+        visible = (torch.arange(keys[0].shape[2], device=position.device) <= position).view(1, 1, 1, -1)
+        for i, block in enumerate(transformer.h):
+            q, k, v = block.attn.c_attn(block.ln_1(x)).split(x.shape[-1], dim=2)
+            q, k, v = (t.view(1, 1, self.n_heads, self.head_dim).transpose(1, 2) for t in (q, k, v))
+            keys[i].index_copy_(2, position, k)
+            values[i].index_copy_(2, position, v)
+            attn = F.scaled_dot_product_attention(q, keys[i], values[i], attn_mask=visible, scale=self.scales[i])
+            x = x + block.attn.c_proj(attn.transpose(1, 2).reshape(x.shape))
+            x = x + block.mlp(block.ln_2(x))
+        return self.model.lm_head(transformer.ln_f(x))[:, -1]
+
+    def generate(self, inputs, max_new_tokens=20, do_sample=False, temperature=None, top_k=None, kv_cache=None,
+                 session_id=None, eos_token_id=None, stopping_criteria=None, streamer=None, **kwargs):
+        """
+        `inputs` is a [1, seq] tensor of prompt ids; returns the [1, seq + new] sequences tensor,
+        like generate_with_session_cache (whose kv_cache / session_id it takes, too). Options
+        left out default to the model's generation_config, as in model.generate.
+        """
+        defaults = self.model.generation_config
+        temperature = temperature if temperature is not None else defaults.temperature or 1.0
+        top_k = top_k if top_k is not None else defaults.top_k or 0
+        eos_token_id = eos_token_id if eos_token_id is not None else defaults.eos_token_id
+        ids = inputs[0].tolist()
+        prompt_length = len(ids)
+        bucket = next(b for b in self.buckets if b >= prompt_length + max_new_tokens)
+        if streamer is not None:
+            streamer.put(inputs.cpu())
+
+        # Eager prefill of the part of the prompt the session cache does not cover
+        past, n_cached = kv_cache.lookup(session_id, ids) if kv_cache is not None else (None, 0)
+        with torch.no_grad():
+            out = self.model(input_ids=inputs[:, n_cached:], use_cache=True,
+                             past_key_values=cache_from_tensors(past) if past is not None else None)
+        logits = out.logits[:, -1]
+        keys, values = self._acquire(bucket)
+        try:
+            for i, (k, v) in enumerate(cache_to_tensors(out.past_key_values)):
+                keys[i][:, :, :prompt_length] = k
+                values[i][:, :, :prompt_length] = v
+            position = torch.tensor([prompt_length], device=self.device)
+            with torch.no_grad():
+                while True:
+                    token = self._pick(logits, do_sample, temperature, top_k)
+                    ids.append(token)
+                    if streamer is not None:
+                        streamer.put(torch.tensor([token]))
+                    done = token == eos_token_id or len(ids) - prompt_length >= max_new_tokens
+                    if stopping_criteria is not None:   # called for every token, as in model.generate
+                        done = bool(stopping_criteria(torch.tensor([ids], device=self.device), None).any()) or done
+                    if done:
+                        break
+                    logits = self.step(keys, values, torch.tensor([[token]], device=self.device), position)
+                    position += 1
+            if kv_cache is not None and session_id is not None:
+                # The last token was never fed through the model: the buffers cover len(ids) - 1
+                covered = len(ids) - 1
+                kv_cache.store(session_id, ids[:covered],
+                               [(k[:, :, :covered], v[:, :, :covered]) for k, v in zip(keys, values)])
+        finally:
+            self._release(bucket, (keys, values))
+            if streamer is not None:
+                streamer.end()
+        return torch.tensor([ids], device=inputs.device)
+
+    @staticmethod
+    def _pick(logits, do_sample, temperature, top_k):
+        """The next token, with the same temperature / top-k rules as model.generate"""
+        if not do_sample:
+            return int(logits.argmax(dim=-1))
+        scores = logits.float() / max(temperature, 1e-5)
+        if top_k:
+            kth = scores.topk(min(top_k, scores.shape[-1]), dim=-1).values[..., -1:]
+            scores = scores.masked_fill(scores < kth, float("-inf"))
+        return int(torch.multinomial(F.softmax(scores, dim=-1), 1))
+
+
+# ---- benchmark -------------------------------------------------------------
+def count_allocations(fn):
+    """(allocations, bytes allocated) on the CPU while fn() runs, from torch.profiler"""
+    from torch.profiler import ProfilerActivity, profile
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    sizes = [event.cpu_memory_usage for event in prof.events() if event.cpu_memory_usage > 0]
+    return len(sizes), sum(sizes)
+
+def main():
+    from model_utils import load_model
+
+    parser = argparse.ArgumentParser(description="Static-cache compiled decoding vs model.generate")
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--prompt", default="User: What is artificial intelligence?\nKyleBot: ")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    tok, model = load_model(args.model, device_map=None)
+    inputs = torch.tensor([tok.encode(args.prompt)])
+    n = args.max_new_tokens
+    eager = lambda: model.generate(inputs, max_new_tokens=n, min_new_tokens=n, do_sample=False,
+                                   pad_token_id=tok.eos_token_id)
+    static = StaticDecoder(model, compile=False)
+    compiled = StaticDecoder(model)
+    start = time.perf_counter()
+    compiled.warmup()
+    print(f"warm-up (compiling {len(compiled.buckets)} buckets): {time.perf_counter() - start:.1f}s")
+
+    reference = None
+    print(f"{'':18}{'ms/token':>10}{'allocs/token':>14}{'KB/token':>10}  same tokens")
+    for label, run in [("eager generate", eager),
+                       ("static, eager", lambda: static.generate(inputs, max_new_tokens=n)),
+                       ("static, compiled", lambda: compiled.generate(inputs, max_new_tokens=n))]:
+        with torch.no_grad():
+            output = run()   # warm-up
+            times = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start)
+            allocations, nbytes = count_allocations(run)
+        tokens = output.shape[1] - inputs.shape[1]
+        reference = output if reference is None else reference
+        same = output.shape == reference.shape and bool((output == reference).all())
+        print(f"{label:18}{sorted(times)[len(times) // 2] / tokens * 1000:>10.2f}"
+              f"{allocations / tokens:>14.1f}{nbytes / tokens / 1024:>10.1f}  {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+stopping.py
+Stop decoding as soon as the reply is complete, instead of generating max_new_tokens and
+trimming afterwards in clean_response.
+"""
+
+import time
+
+import torch
+from transformers import StoppingCriteria
+
+from metrics import PHASE_SECONDS
+
+
+class TurnBoundaryStop(StoppingCriteria):
+    """
+    Per-sequence stopping criterion for model.generate (greedy, sampling and beam search).
+
+    A sequence is finished once either:
+    - its generated text contains a turn marker such as "\\nUser:" (the model started writing
+      the next turn, which clean_response would throw away), or
+    - it is longer than max_chars and has a sentence end within the first max_chars characters,
+      so clean_response is going to cut it there whatever comes next.
+
+    The prompt length is taken from the first call (made right after the first new token), so
+    the same object works with or without a cached prefix. Use one instance per request.
+    """
+
+    def __init__(self, tokenizer, stop_strings=(), max_chars=None):
+        self.tokenizer = tokenizer
+        self.stop_strings = [s for s in stop_strings if s]
+        self.max_chars = max_chars
+        # Every token decodes to at least one character, so this many tokens cover any stop string
+        self.tail_tokens = max((len(s) for s in self.stop_strings), default=0) + 1
+        # ...and this many cover max_chars, after which more tokens cannot change the answer
+        self.head_tokens = max_chars + 1 if max_chars else None
+        self.prompt_length = None
+        self.tokens_generated = 0
+        self.triggered = False
+
+    def __call__(self, input_ids, scores=None, **kwargs):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1] - 1
+        self.tokens_generated = input_ids.shape[1] - self.prompt_length
+        done = [self._is_done(row[self.prompt_length:]) for row in input_ids.tolist()]
+        self.triggered = self.triggered or any(done)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    def _is_done(self, generated):
+        if self.stop_strings:
+            tail = self.tokenizer.decode(generated[-self.tail_tokens:], skip_special_tokens=True)
+            if any(s in tail for s in self.stop_strings):
+                return True
+        if self.max_chars:
+            # Decoding only the head keeps each step O(max_chars) instead of O(tokens generated);
+            # it is widened only when stripped whitespace or skipped special tokens left it short
+            head = self.head_tokens
+            text = self.tokenizer.decode(generated[:head], skip_special_tokens=True).strip()
+            while len(text) <= self.max_chars and len(generated) > head:
+                head *= 2
+                text = self.tokenizer.decode(generated[:head], skip_special_tokens=True).strip()
+            return len(text) > self.max_chars and any(c in text[:self.max_chars] for c in ".!?")
+        return False
+
+    def tokens_saved(self, max_new_tokens):
+        """Decoding steps skipped compared to running the full max_new_tokens budget."""
+        return max(max_new_tokens - self.tokens_generated, 0) if self.triggered else 0
+
+
+class DecodeTimer(StoppingCriteria):
+    """
+    Never stops anything: stopping criteria run once per generated token, which makes them a
+    convenient clock for model.generate. The first call ends the prefill (prompt forward pass and
+    first token); every later call times one decoding step. Create it right before generate().
+    """
+
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.prefilled = False
+
+    def __call__(self, input_ids, scores=None, **kwargs):
+        now = time.perf_counter()
+        PHASE_SECONDS.observe(now - self.last, phase="decode" if self.prefilled else "prefill")
+        self.prefilled, self.last = True, now
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,155 @@
+"""
+streaming.py
+Token streaming: show the reply while it is being generated instead of after max_new_tokens.
+
+TokenStream speaks the Hugging Face streamer protocol (put()/end()), so it can be handed to
+model.generate(streamer=...) or to the ContinuousBatcher. stream_generate() runs a generate
+helper in a background thread and yields decoded text deltas.
+"""
+
+import queue, threading
+
+
+class GenerationCancelled(Exception):
+    """Raised inside the generating thread once the consumer stops listening."""
+
+
+class TokenStream:
+    """Queue of generated token ids between the generating thread and the consumer."""
+
+    def __init__(self, skip_prompt=True):
+        self._queue = queue.Queue()
+        self._skip_prompt = skip_prompt
+        self.cancelled = False
+
+    # ---- streamer protocol (called by the generating thread) -------
+    def put(self, value):
+        if self.cancelled:
+            # generate() has no cancel hook, but it calls put() every step: bail out from here
+            raise GenerationCancelled()
+        if self._skip_prompt:
+            self._skip_prompt = False   # the first put() is the prompt itself
+            return
+        for token in value.reshape(-1).tolist():
+            self._queue.put(token)
+
+    def end(self):
+        self._queue.put(None)
+
+    def fail(self, exc):
+        self._queue.put(exc)
+
+    # ---- consumer side --------------------------------------------
+    def cancel(self):
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class IncrementalDecoder:
+    """
+    Turns token ids into text deltas one token at a time.
+
+    GPT-2's byte-level BPE can split one character (emoji, accented letters) over several tokens,
+    and decoding a lone token can differ from decoding it in context. So we re-decode a short
+    window of recent tokens and only emit text once it no longer ends in an incomplete
+    character (shown by the decoder as U+FFFD).
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.ids = []
+        self.prefix_offset = 0   # start of the decode window
+        self.read_offset = 0     # tokens before this have been emitted
+
+    def _decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens=True)
+
+    def push(self, token_id):
+        """Add one token id; returns the newly completed text (possibly empty)."""
+        self.ids.append(token_id)
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset, self.read_offset = self.read_offset, len(self.ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self):
+        """Whatever is still held back at the end of generation."""
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+
+class StopStringFilter:
+    """
+    Passes streamed text through until one of `stop_strings` (e.g. "\\nUser:") appears.
+    Text that might be the start of a stop string is held back until it is clear that it is not.
+    """
+
+    def __init__(self, stop_strings):
+        self.stop_strings = [s for s in stop_strings if s]
+        self.text = ""
+        self.emitted = 0
+        self.stopped = False
+
+    def feed(self, delta):
+        """Returns the text that is safe to show; sets .stopped once a stop string is seen."""
+        if self.stopped:
+            return ""
+        self.text += delta
+        hits = [self.text.find(s) for s in self.stop_strings if s in self.text]
+        if hits:
+            self.stopped = True
+            return self._emit_until(min(hits))
+        held = max((k for s in self.stop_strings for k in range(1, len(s))
+                    if self.text.endswith(s[:k])), default=0)
+        return self._emit_until(len(self.text) - held)
+
+    def flush(self):
+        return "" if self.stopped else self._emit_until(len(self.text))
+
+    def _emit_until(self, end):
+        out = self.text[self.emitted:end] if end > self.emitted else ""
+        self.emitted = max(self.emitted, end)
+        return out
+
+
+def stream_generate(generate_fn, prompt, tokenizer, **kwargs):
+    """
+    Call generate_fn(prompt, streamer=..., **kwargs) in a background thread and yield text deltas.
+    Closing the generator (e.g. breaking out of a for loop and calling .close()) cancels generation.
+    """
+    stream = TokenStream()
+
+    def run():
+        try:
+            generate_fn(prompt, streamer=stream, **kwargs)
+        except GenerationCancelled:
+            pass
+        except Exception as exc:
+            stream.fail(exc)
+        finally:
+            stream.end()
+
+    threading.Thread(target=run, name="kylebot-stream", daemon=True).start()
+    decoder = IncrementalDecoder(tokenizer)
+    try:
+        for token in stream:
+            delta = decoder.push(token)
+            if delta:
+                yield delta
+        tail = decoder.flush()
+        if tail:
+            yield tail
+    finally:
+        stream.cancel()
@@ -0,0 +1,210 @@
+"""
+sweep.py
+Parameter sweeps in one batched decode: every setting of a grid answers the same prompt side by side.
+
+Trying temperature / top-k settings one model.generate at a time prefills the same prompt
+again for each setting and decodes one row at a time. Here each prompt is prefilled once,
+its keys/values are shared by one batch row per greedy / sampling setting (expanded, not copied), and
+every decoding step is one forward pass over all of them, each row with its own temperature and
+top-k (batching.decode_forked). Rows leave the batch as they finish. Settings that cannot
+share that loop (beam search, top_p, ...) run through model.generate one at a time.
+
+    from sweep import format_table, sweep
+    rows = sweep(model, tokenizer, ["The future of technology is"],
+                 {"temperature": [0.1, 0.5, 1.0, 1.5], "top_k": [10, 50]})
+    print(format_table(rows))
+
+    python sweep.py --temperature 0.1 0.5 1.0 1.5 --top-k 10 20 50 100    # vs one at a time
+"""
+
+import argparse, itertools, logging, time
+
+import torch
+from transformers import StoppingCriteriaList
+
+from batching import decode_forked
+from prompting import encode_prompt
+
+log = logging.getLogger(__name__)
+
+# Settings the batched loop implements; a config with anything else runs through model.generate
+BATCHED_KEYS = {"method", "do_sample", "temperature", "top_k", "max_new_tokens"}
+BATCHED_METHODS = {"greedy", "sampling"}
+
+# model.generate's own defaults for settings the model's generation_config leaves unset
+GENERATE_DEFAULTS = {"temperature": 1.0, "top_k": 50}
+
+COLUMNS = ("prompt", "method", "temperature", "top_k", "tokens", "seconds", "tokens_per_second", "response")
+
+
+def parameter_grid(grid):
+    """
+    Configs to sweep: a dict of setting -> list of values becomes every combination of them
+    ({"temperature": [0.5, 1.0], "top_k": [10, 50]} -> 4 configs); a list of dicts is used as is
+    """
+    if not isinstance(grid, dict):
+        return [dict(config) for config in grid]
+    values = [value if isinstance(value, (list, tuple)) else [value] for value in grid.values()]
+    return [dict(zip(grid, combination)) for combination in itertools.product(*values)]
+
+def generation_kwargs(config, max_new_tokens=50):
+    """model.generate() options for one config; "method" picks the same defaults as the chat"""
+    kwargs = {key: value for key, value in config.items() if key != "method"}
+    kwargs.setdefault("max_new_tokens", max_new_tokens)
+    method = config.get("method", "sampling")
+    if method == "beam":
+        kwargs.setdefault("num_beams", 5)
+    if method == "greedy" or method == "beam":
+        kwargs.setdefault("do_sample", False)
+    else:
+        kwargs.setdefault("do_sample", True)
+    return kwargs
+
+def is_batched(config):
+    return set(config) <= BATCHED_KEYS and config.get("method", "sampling") in BATCHED_METHODS
+
+
+def sweep(model, tokenizer, prompts, grid, max_new_tokens=50, stopping=None, seed=0):
+    """
+    Answer every prompt with every config of `grid` (see parameter_grid); returns one result
+    dict per (prompt, config): the config's settings, "response", "tokens", "seconds" (prefill
+    + decoding until that row finished) and "tokens_per_second".
+    - prompts: strings or prompting.Prompt objects
+    - stopping: optional factory returning a new StoppingCriteria per row, e.g.
+      lambda: TurnBoundaryStop(tokenizer, turn_markers("KyleBot"))
+    - seed: each prompt's sampling starts from this seed, so a sweep can be repeated; the global
+      torch RNG is left as it was
+    """
+    configs = parameter_grid(grid)
+    results = []
+    for index, prompt in enumerate(prompts):
+        prompt_ids = encode_prompt(tokenizer, prompt)
+        batched = [i for i, config in enumerate(configs) if is_batched(config)]
+        generator = torch.Generator(device=model.device).manual_seed(seed)
+        rows = dict(zip(batched, _sweep_batch(model, tokenizer, prompt_ids, [configs[i] for i in batched],
+                                              max_new_tokens, stopping, generator))) if batched else {}
+        for i, config in enumerate(configs):
+            row = rows[i] if i in rows else _sweep_one(model, tokenizer, prompt_ids, config, max_new_tokens,
+                                                       stopping, seed)
+            kwargs = generation_kwargs(config, max_new_tokens)
+            results.append({
+                "prompt": index,
+                "method": config.get("method", "sampling"),
+                **{key: value for key, value in kwargs.items() if key != "do_sample"},
+                **row,
+                "tokens_per_second": row["tokens"] / row["seconds"] if row["seconds"] else 0.0,
+            })
+    return results
+
+def _sweep_batch(model, tokenizer, prompt_ids, configs, max_new_tokens, stopping, generator=None):
+    """
+    Greedy / sampling configs decoded as one batch continuing one prefill: a result per config.
+    Settings a config leaves out default to the model's generation_config, as in model.generate
+    """
+    kwargs = [generation_kwargs(config, max_new_tokens) for config in configs]
+    defaults = model.generation_config
+
+    def setting(k, key):
+        for value in (k.get(key), getattr(defaults, key, None), GENERATE_DEFAULTS[key]):
+            if value is not None:
+                return value
+
+    rows, _ = decode_forked(
+        model, prompt_ids,
+        temperature=[setting(k, "temperature") or 1.0 for k in kwargs],
+        top_k=[setting(k, "top_k") for k in kwargs],
+        do_sample=[k["do_sample"] for k in kwargs],
+        max_new_tokens=[int(k["max_new_tokens"]) for k in kwargs],
+        stops=[stopping() if stopping is not None else None for _ in kwargs],
+        eos_token_id=tokenizer.eos_token_id,
+        generator=generator,
+    )
+    texts = tokenizer.batch_decode([row["ids"] for row in rows], skip_special_tokens=True)
+    return [{"response": text, "tokens": len(row["ids"]), "seconds": row["seconds"]} for text, row in zip(texts, rows)]
+
+def _sweep_one(model, tokenizer, prompt_ids, config, max_new_tokens, stopping, seed=None):
+    """
+    A config the batch cannot run (beam search, top_p, ...), through model.generate. It samples
+    with the global RNG, so with a seed that RNG is seeded inside fork_rng and restored afterwards
+    """
+    kwargs = generation_kwargs(config, max_new_tokens)
+    if stopping is not None:
+        kwargs["stopping_criteria"] = StoppingCriteriaList([stopping()])
+    devices = [model.device] if model.device.type == "cuda" else []
+    start = time.perf_counter()
+    with torch.no_grad(), torch.random.fork_rng(devices, enabled=seed is not None):
+        if seed is not None:
+            torch.manual_seed(seed)
+        outputs = model.generate(torch.tensor([prompt_ids], device=model.device),
+                                 pad_token_id=tokenizer.eos_token_id, **kwargs)
+    seconds = time.perf_counter() - start
+    generated = [token for token in outputs[0, len(prompt_ids):].tolist() if token != tokenizer.eos_token_id]
+    return {"response": tokenizer.decode(generated, skip_special_tokens=True), "tokens": len(generated),
+            "seconds": seconds}
+
+
+def format_table(results, columns=None, width=40):
+    """
+    Results as a text table, one line per (prompt, config); long responses are cut to `width`.
+    Default columns: COLUMNS, plus any other setting the grid varies (e.g. num_beams, top_p)
+    """
+    if columns is None:
+        settings = [key for key in dict.fromkeys(key for result in results for key in result)
+                    if key not in COLUMNS and key != "max_new_tokens"]
+        columns = [*COLUMNS[:4], *settings, *COLUMNS[4:]]
+    columns = [column for column in columns if any(column in result for result in results)]
+
+    def cell(value):
+        if isinstance(value, float):
+            return f"{value:.3f}"
+        text = str(value if value is not None else "").replace("\n", " ")
+        return text if len(text) <= width else text[:width - 1] + "…"
+
+    cells = [[cell(result.get(column)) for column in columns] for result in results]
+    widths = [max([len(column)] + [len(row[i]) for row in cells]) for i, column in enumerate(columns)]
+    lines = ["  ".join(column.ljust(w) for column, w in zip(columns, widths))]
+    lines += ["  ".join(value.ljust(w) for value, w in zip(row, widths)) for row in cells]
+    return "\n".join(lines)
+
+
+# ---- benchmark -------------------------------------------------------------
+def main():
+    from model_utils import load_model
+
+    parser = argparse.ArgumentParser(description="Batched parameter sweep vs one model.generate per setting")
+    parser.add_argument("--model", default="gpt2")
+    parser.add_argument("--prompt", nargs="+", default=["The future of technology is"])
+    parser.add_argument("--method", nargs="+", default=["sampling"], choices=["greedy", "sampling", "beam"])
+    parser.add_argument("--temperature", type=float, nargs="+", default=[0.1, 0.5, 1.0, 1.5])
+    parser.add_argument("--top-k", type=int, nargs="+", default=[10, 20, 50, 100])
+    parser.add_argument("--max-new-tokens", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    tokenizer, model = load_model(args.model, device_map=None)
+    grid = []
+    for method in args.method:
+        if method == "sampling":
+            grid += [dict(config, method=method)
+                     for config in parameter_grid({"temperature": args.temperature, "top_k": args.top_k})]
+        else:
+            grid.append({"method": method})
+
+    start = time.perf_counter()
+    results = sweep(model, tokenizer, args.prompt, grid, args.max_new_tokens, seed=args.seed)
+    batched = time.perf_counter() - start
+    print(format_table(results))
+
+    start = time.perf_counter()
+    torch.manual_seed(args.seed)
+    for prompt in args.prompt:
+        for config in grid:
+            _sweep_one(model, tokenizer, encode_prompt(tokenizer, prompt), config, args.max_new_tokens, None)
+    sequential = time.perf_counter() - start
+    print(f"\n{len(args.prompt)} prompts x {len(grid)} configs: {batched:.2f}s batched, "
+          f"{sequential:.2f}s one at a time ({sequential / batched:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+worker_pool.py
+Multi-process CPU inference: one PyTorch process stops scaling long before a 32-64 core node
+runs out of cores, so the server can start N workers instead, each running its own
+ContinuousBatcher with a fixed share of the cores.
+
+- the weights are moved to shared memory and handed to the workers as shared-memory handles, so
+  every worker maps the same pages (RAM grows by the activations and KV caches of each worker,
+  not by a copy of the model)
+- workers are spawned, not forked: the parent has already run the model, and forking a process
+  whose OpenMP thread pool is running can hang the child
+- each worker sets its own intra-op thread count (cores // workers by default)
+- requests with a session id always go to the same worker, where that session's KV cache lives;
+  anonymous requests go to the least busy worker
+- a worker that dies (OOM kill, crash) fails its pending requests with RuntimeError; new requests
+  go to the workers still running
+"""
+
+import itertools, logging, os, queue, threading, time, zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+import torch.multiprocessing as mp
+from transformers import StoppingCriteriaList
+
+from batching import ContinuousBatcher
+from kv_cache import SessionKVCache, generate_with_session_cache
+from prompting import encode_prompt
+from stopping import TurnBoundaryStop
+from streaming import GenerationCancelled
+
+log = logging.getLogger(__name__)
+
+# Arguments the ContinuousBatcher handles; anything else (beam search, penalties...) runs model.generate
+BATCHABLE_KWARGS = {"temperature", "top_k", "do_sample"}
+
+
+class WorkerPool:
+    """
+    Drop-in replacement for a ContinuousBatcher (submit / generate / active_requests) that spreads
+    requests over `num_workers` worker processes. generate() also accepts the other
+    model.generate keyword arguments, e.g. num_beams.
+
+    Streamers work as usual (tokens are forwarded from the worker; raising from put() cancels the
+    request there). Stopping criteria must be TurnBoundaryStop instances: they are rebuilt inside
+    the worker and their counters are copied back when the request finishes.
+    """
+
+    def __init__(self, model, tokenizer, num_workers=None, threads_per_worker=None,
+                 max_batch_size=32, prefix_cache=None, kv_cache_bytes=256 * 2**20):
+        if model.device.type != "cpu":
+            raise ValueError("WorkerPool is for CPU inference; on a GPU use a single ContinuousBatcher")
+        cores = os.cpu_count() or 1
+        self.num_workers = num_workers or max(cores // 4, 1)
+        self.threads_per_worker = threads_per_worker or max(cores // self.num_workers, 1)
+        model.share_memory()
+
+        # Fresh interpreters rather than forks of this one, whose torch thread pools are already
+        # running; torch.multiprocessing passes the shared weights as handles, not copies
+        ctx = mp.get_context("spawn")
+        self._results = ctx.Queue()
+        self._inboxes = [ctx.Queue() for _ in range(self.num_workers)]
+        self._processes = [
+            ctx.Process(target=_worker_main, name=f"kylebot-worker-{i}", daemon=True,
+                        args=(model, tokenizer, prefix_cache, self.threads_per_worker,
+                              max_batch_size, kv_cache_bytes, inbox, self._results))
+            for i, inbox in enumerate(self._inboxes)
+        ]
+        for process in self._processes:
+            process.start()
+        log.info(f"{self.num_workers} inference workers x {self.threads_per_worker} threads")
+
+        self._pending = {}       # request id -> (future, streamer, stopping criteria, worker)
+        self._load = [0] * self.num_workers
+        self._alive = [True] * self.num_workers
+        self._closing = False
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="kylebot-pool", daemon=True)
+        self._dispatcher.start()
+
+    # ---- public API (same as ContinuousBatcher) ------------------------
+    def submit(self, prompt, max_new_tokens=50, session_id=None, streamer=None,
+               stopping_criteria=None, **generate_kwargs):
+        """Queue a prompt on one of the workers; returns a Future with the generated text."""
+        criteria = list(stopping_criteria or [])
+        if not all(isinstance(c, TurnBoundaryStop) for c in criteria):
+            raise ValueError("only TurnBoundaryStop criteria can be sent to pool workers")
+        specs = [(c.stop_strings, c.max_chars) for c in criteria]
+        future = Future()
+        with self._lock:
+            if not any(self._alive):
+                raise RuntimeError("every inference worker has died")
+            request_id = next(self._ids)
+            worker = self._pick_worker(session_id)
+            self._pending[request_id] = (future, streamer, criteria, worker)
+            self._load[worker] += 1
+        self._inboxes[worker].put((
+            "generate", request_id, prompt, session_id, streamer is not None, specs,
+            dict(generate_kwargs, max_new_tokens=max_new_tokens)
+        ))
+        return future
+
+    def generate(self, prompt, **params):
+        """Blocking version of submit()"""
+        return self.submit(prompt, **params).result()
+
+    @property
+    def active_requests(self):
+        return len(self._pending)
+
+    def close(self):
+        self._closing = True
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+        self._results.put(None)
+
+    # ---- routing -------------------------------------------------------
+    def _pick_worker(self, session_id):
+        workers = [i for i in range(self.num_workers) if self._alive[i]]
+        if session_id is not None:   # sticky: the session's KV cache lives in that worker
+            return workers[zlib.crc32(str(session_id).encode()) % len(workers)]
+        return min(workers, key=self._load.__getitem__)
+
+    def _check_workers(self):
+        """Fail the requests of workers that died: no result will ever come back for them"""
+        for worker, process in enumerate(self._processes):
+            if not self._alive[worker] or process.is_alive() or self._closing:
+                continue
+            with self._lock:
+                self._alive[worker] = False
+                lost = [(request_id, entry) for request_id, entry in self._pending.items() if entry[3] == worker]
+                for request_id, _ in lost:
+                    del self._pending[request_id]
+                self._load[worker] = 0
+            log.error(f"Inference worker {worker} died (exit code {process.exitcode}), "
+                      f"failing {len(lost)} requests")
+            for _, (future, streamer, _, _) in lost:
+                if streamer is not None:
+                    streamer.end()
+                future.set_exception(RuntimeError(f"worker {worker} died (exit code {process.exitcode})"))
+
+    def _dispatch(self):
+        """Hand tokens and results coming back from the workers to the waiting callers."""
+        checked = time.monotonic()
+        while True:
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                message = ()
+            if time.monotonic() - checked >= 1.0:   # also while other workers keep sending
+                self._check_workers()
+                checked = time.monotonic()
+            if message is None:
+                return
+            if not message:
+                continue
+            kind, request_id = message[:2]
+            with self._lock:
+                entry = self._pending.get(request_id)
+            if entry is None:
+                continue
+            future, streamer, criteria, worker = entry
+            if kind == "token":
+                try:
+                    streamer.put(torch.tensor(message[2]))
+                except Exception:
+                    self._inboxes[worker].put(("cancel", request_id))
+                continue
+            with self._lock:
+                del self._pending[request_id]
+                self._load[worker] -= 1
+            if streamer is not None:
+                streamer.end()
+            if kind == "done":
+                text, states = message[2:]
+                for stop, (prompt_length, tokens_generated, triggered) in zip(criteria, states):
+                    stop.prompt_length, stop.tokens_generated, stop.triggered = prompt_length, tokens_generated, triggered
+                future.set_result(text)
+            elif kind == "cancelled":
+                future.set_exception(GenerationCancelled())
+            else:
+                future.set_exception(RuntimeError(f"worker {worker}: {message[2]}"))
+
+
+class _WorkerStreamer:
+    """Streamer inside a worker: forwards tokens to the parent, raises once the request is cancelled."""
+
+    def __init__(self, request_id, results, cancelled):
+        self.request_id = request_id
+        self.results = results
+        self.cancelled = cancelled
+
+    def put(self, value):
+        if self.request_id in self.cancelled:
+            raise GenerationCancelled()
+        self.results.put(("token", self.request_id, value.tolist()))
+
+    def end(self):
+        pass
+
+
+def _worker_main(model, tokenizer, prefix_cache, threads, max_batch_size, kv_cache_bytes, inbox, results):
+    """Worker process: runs requests from `inbox` on the shared model, replies on `results`."""
+    torch.set_num_threads(threads)
+    kv_cache = SessionKVCache(max_bytes=kv_cache_bytes, prefix_cache=prefix_cache)
+    batcher = ContinuousBatcher(model, tokenizer, max_batch_size=max_batch_size, kv_cache=kv_cache)
+    executor = ThreadPoolExecutor(max_batch_size, thread_name_prefix="kylebot-generate")
+    active, cancelled = set(), set()
+
+    def generate(prompt, session_id, streamer, stopping, kwargs):
+        """Everything the batcher cannot do: beam search, penalties, ..."""
+        inputs = torch.tensor([encode_prompt(tokenizer, prompt)])
+        beam = kwargs.get("num_beams", 1) > 1
+        with torch.no_grad():
+            outputs = generate_with_session_cache(
+                model, inputs, kv_cache, session_id, pad_token_id=tokenizer.eos_token_id,
+                stopping_criteria=stopping, streamer=None if beam else streamer, **kwargs
+            )
+        if beam and streamer is not None:   # generate() cannot stream beams: send the winner in one piece
+            streamer.put(inputs[0])
+            streamer.put(outputs[0, inputs.shape[1]:])
+        return tokenizer.decode(outputs[0, inputs.shape[1]:], skip_special_tokens=True)
+
+    def finished(request_id, stopping, future):
+        active.discard(request_id)
+        was_cancelled = request_id in cancelled
+        cancelled.discard(request_id)
+        try:
+            text = future.result()
+        except GenerationCancelled:
+            results.put(("cancelled", request_id))
+        except Exception as exc:
+            results.put(("cancelled" if was_cancelled else "error", request_id, repr(exc)))
+        else:
+            states = [(stop.prompt_length, stop.tokens_generated, stop.triggered) for stop in stopping]
+            results.put(("done", request_id, text, states))
+
+    while True:
+        message = inbox.get()
+        if message is None:
+            return
+        if message[0] == "cancel":
+            if message[1] in active:
+                cancelled.add(message[1])
+            continue
+        _, request_id, prompt, session_id, stream, specs, kwargs = message
+        stopping = StoppingCriteriaList(TurnBoundaryStop(tokenizer, stop_strings, max_chars)
+                                        for stop_strings, max_chars in specs)
+        streamer = _WorkerStreamer(request_id, results, cancelled) if stream else None
+        active.add(request_id)
+        if set(kwargs) - {"max_new_tokens"} <= BATCHABLE_KWARGS:
+            future = batcher.submit(prompt, session_id=session_id, streamer=streamer,
+                                    stopping_criteria=stopping or None, **kwargs)
+        else:
+            future = executor.submit(generate, prompt, session_id, streamer, stopping or None, kwargs)
+        future.add_done_callback(lambda f, r=request_id, s=stopping: finished(r, s, f))